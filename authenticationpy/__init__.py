@@ -1,6 +1,7 @@
 import web
 
-def user_cache_hook():
-    # Set empty cache if not already set
-    web.ctx.auth_user_cache = {}
+from authenticationpy.identity import IdentityMap
 
+def user_cache_hook():
+    # Set up an empty identity map for the request
+    web.ctx.auth_user_cache = IdentityMap()
@@ -0,0 +1,258 @@
+""" API keys for service accounts
+
+An API key looks like ``<prefix>.<secret>``. The prefix is stored in an
+indexed column, and only a SHA-256 hash of the secret is stored. Secrets are
+long random strings, so a fast hash is as safe as a password hash would be.
+Verifying a key is therefore one indexed lookup by prefix and one
+constant-time comparison of hashes, and recently used keys are cached in
+memory for ``web.config.authapikey_ttl`` seconds, so hot keys don't touch the
+database at all. Because of that cache, a revoked key may still be accepted
+by other processes until their cached copy expires. The time a key was last
+used is kept in memory and written periodically, at most once per key per
+flush, if usage tracking is enabled.
+
+The following table is used (PostgreSQL syntax)::
+
+    CREATE TABLE authenticationpy_api_keys (
+      id               SERIAL PRIMARY KEY,
+      user_id          INTEGER NOT NULL,
+      prefix           CHAR(12) NOT NULL UNIQUE,
+      secret_hash      CHAR(64) NOT NULL,
+      scopes           VARCHAR(255) NOT NULL DEFAULT '',
+      created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+      expires_at       TIMESTAMP,
+      last_used        TIMESTAMP
+    );
+
+"""
+
+import os
+import hmac
+import time
+import atexit
+import hashlib
+import binascii
+import datetime
+import threading
+import collections
+
+import web
+
+from authenticationpy import auth
+
+KEYS_TABLE = 'authenticationpy_api_keys'
+PREFIX_LENGTH = 12
+
+db = auth.db
+
+# Number of seconds verified keys are cached, and the maximum number of
+# cached keys
+try:
+    cache_ttl = web.config.authapikey_ttl
+except AttributeError:
+    cache_ttl = 60
+try:
+    cache_size = web.config.authapikey_cache_size
+except AttributeError:
+    cache_size = 10000
+
+
+class UsageTracker(object):
+    """ Write-coalesced ``last_used`` tracking
+
+    The last use of each key is kept in memory, and written to the ``table``
+    every ``flush_interval`` seconds (once the timer is started using the
+    ``start`` method), so a busy key causes at most one update per flush.
+
+    """
+
+    def __init__(self, db, table=KEYS_TABLE, flush_interval=5):
+        self.db = db
+        self.table = table
+        self.flush_interval = flush_interval
+        self._used = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._timer = None
+        self._atexit_registered = False
+
+    def record(self, key_id):
+        """ Records a use of key ``key_id`` """
+        self._lock.acquire()
+        try:
+            self._used[key_id] = datetime.datetime.now()
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """ Writes the recorded uses to the database """
+        self._lock.acquire()
+        try:
+            used, self._used = self._used, {}
+        finally:
+            self._lock.release()
+
+        if not used:
+            return
+
+        transaction = self.db.transaction()
+        try:
+            for key_id, at in used.items():
+                self.db.update(self.table, where='id = $id',
+                               vars={'id': key_id}, last_used=at)
+        except:
+            transaction.rollback()
+            raise
+        else:
+            transaction.commit()
+
+    def start(self):
+        """ Starts flushing every ``flush_interval`` seconds """
+        if self._timer is not None:
+            return
+        self._stopped.clear()
+        self._timer = threading.Thread(target=self._run)
+        self._timer.setDaemon(True)
+        self._timer.start()
+        if not self._atexit_registered:
+            atexit.register(self.stop)
+            self._atexit_registered = True
+
+    def stop(self):
+        """ Stops the timer and writes any remaining uses """
+        self._stopped.set()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._stopped.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # Usage times are informative only, verification must not be
+                # affected
+                pass
+
+
+# Last use of keys is only tracked if ``web.config.authapikey_usage`` is set.
+# It should be a dictionary of ``UsageTracker`` options (can be empty).
+try:
+    usage_conf = web.config.authapikey_usage
+except AttributeError:
+    usage_conf = None
+
+if usage_conf is not None:
+    usage = UsageTracker(db, **usage_conf)
+    usage.start()
+else:
+    usage = None
+
+# Recently verified keys by prefix, as (expiry, record)
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+def _hash_secret(secret):
+    return hashlib.sha256(web.utf8(secret)).hexdigest()
+
+def _record(row):
+    return web.storage(id=row.id,
+                       user_id=row.user_id,
+                       prefix=row.prefix,
+                       secret_hash=row.secret_hash,
+                       scopes=frozenset((row.scopes or '').split()),
+                       expires_at=row.expires_at)
+
+def _lookup(prefix):
+    _cache_lock.acquire()
+    try:
+        cached = _cache.pop(prefix, None)
+        if cached is not None and cached[0] > time.time():
+            _cache[prefix] = cached
+            return cached[1]
+    finally:
+        _cache_lock.release()
+
+    rows = db.where(KEYS_TABLE, prefix=prefix, limit=1)
+    if not rows:
+        return None
+    record = _record(rows[0])
+    _cache_lock.acquire()
+    try:
+        _cache[prefix] = (time.time() + cache_ttl, record)
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    finally:
+        _cache_lock.release()
+    return record
+
+def create_key(user, scopes=(), expires_at=None):
+    """ Creates an API key for ``user`` (``User`` or id) and returns it
+
+    ``scopes`` is a list of scope names (without spaces). The returned key is
+    the only copy of the secret, so it must be handed to the client right
+    away.
+
+    """
+
+    if isinstance(user, auth.User):
+        user = user.id
+    prefix = binascii.hexlify(os.urandom(PREFIX_LENGTH // 2))
+    secret = binascii.hexlify(os.urandom(32))
+    db.insert(KEYS_TABLE, user_id=user, prefix=prefix,
+              secret_hash=_hash_secret(secret), scopes=' '.join(scopes),
+              expires_at=expires_at)
+    return '%s.%s' % (prefix, secret)
+
+def verify(key, scope=None):
+    """ Returns the key record for a valid ``key``, or None
+
+    The key is invalid if it doesn't exist, has expired, or doesn't have the
+    ``scope`` (if given). The record has the ``id``, ``user_id``, ``prefix``,
+    ``scopes`` (a set), and ``expires_at`` of the key.
+
+    """
+
+    prefix, dot, secret = key.partition('.')
+    if len(prefix) != PREFIX_LENGTH or not secret:
+        return None
+    record = _lookup(prefix)
+    if record is None:
+        return None
+    if not hmac.compare_digest(_hash_secret(secret), record.secret_hash):
+        return None
+    if record.expires_at and record.expires_at <= datetime.datetime.now():
+        return None
+    if scope is not None and scope not in record.scopes:
+        return None
+    if usage:
+        usage.record(record.id)
+    return record
+
+def revoke(prefix):
+    """ Deletes the key with ``prefix``
+
+    The key stops working in this process right away. Other processes keep
+    their cached copy of the key, and may accept it for up to ``cache_ttl``
+    seconds (``web.config.authapikey_ttl``). Set it to 0 to disable the cache
+    if revocation must take effect at once.
+
+    """
+    db.delete(KEYS_TABLE, where='prefix = $prefix', vars={'prefix': prefix})
+    _cache_lock.acquire()
+    try:
+        _cache.pop(prefix, None)
+    finally:
+        _cache_lock.release()
+
+def keys(user):
+    """ Returns the keys of ``user`` (``User`` or id), without their hashes """
+    if isinstance(user, auth.User):
+        user = user.id
+    return [web.storage(id=r.id, prefix=r.prefix,
+                        scopes=frozenset(r.scopes.split()),
+                        created_at=r.created_at, expires_at=r.expires_at,
+                        last_used=r.last_used)
+            for r in db.where(KEYS_TABLE, user_id=user, order='id')]
@@ -0,0 +1,180 @@
+import datetime
+import threading
+import atexit
+
+import web
+
+AUDIT_TABLE = 'authenticationpy_logins'
+
+
+class AuditLog(object):
+    """ Buffered log of authentication attempts
+
+    Events are kept in memory, and written to the ``table`` using a single
+    multi-row insert when either ``flush_size`` events have been recorded, or
+    ``flush_interval`` seconds have passed since the last flush (once the
+    timer is started using the ``start`` method). While the timer runs, full
+    buffers are written by the timer thread, so logins never wait for the
+    database.
+
+    If a flush fails, its events are put back into the buffer and written by
+    the next flush. At most ``max_buffer`` events are kept, and the oldest
+    ones are dropped first.
+
+    Successful attempts also update the ``last_login`` column of the accounts
+    in ``users_table``. The updates are coalesced, so each account is updated
+    at most once per flush. If the accounts are not stored in ``db``,
+    ``route`` should be a callable that returns the database for a user id,
+    or None for accounts that no longer exist (which are skipped). Each
+    database is updated in its own transaction.
+
+    """
+
+    def __init__(self, db, users_table, table=AUDIT_TABLE, flush_size=100,
+                 flush_interval=5, route=None, max_buffer=10000):
+        self.db = db
+        self.users_table = users_table
+        self.route = route
+        self.table = table
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._events = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self._timer = None
+
+    def record(self, user_id, username, success, ip=None):
+        """ Records an authentication attempt
+
+        ``user_id`` may be ``None`` for attempts on nonexistent accounts. If
+        ``ip`` is omitted, the address of the current web.py request is used.
+
+        """
+
+        if ip is None:
+            ip = web.ctx.get('ip')
+        event = {'user_id': user_id,
+                 'username': username,
+                 'success': success,
+                 'ip': ip,
+                 'at': datetime.datetime.now()}
+        self._lock.acquire()
+        try:
+            self._events.append(event)
+            full = len(self._events) >= self.flush_size
+        finally:
+            self._lock.release()
+        if not full:
+            return
+        if self._timer is not None:
+            self._wake.set()
+            return
+        try:
+            self.flush()
+        except Exception:
+            # The events are back in the buffer, and logins must not fail
+            pass
+
+    def flush(self):
+        """ Writes buffered events to the database """
+        self._lock.acquire()
+        try:
+            events, self._events = self._events, []
+        finally:
+            self._lock.release()
+
+        if not events:
+            return
+
+        last_logins = {}
+        for event in events:
+            if event['success'] and event['user_id'] is not None:
+                last_logins[event['user_id']] = event['at']
+
+        updates = {}
+        for user_id, at in last_logins.items():
+            if self.route is None:
+                users_db = self.db
+            else:
+                users_db = self.route(user_id)
+                if users_db is None:
+                    # The account was deleted since the attempt
+                    continue
+            updates.setdefault(users_db, {})[user_id] = at
+
+        try:
+            # Other databases are updated first, each in its own transaction.
+            # Setting ``last_login`` again is harmless, so a flush that fails
+            # later can be repeated.
+            for users_db, times in updates.items():
+                if users_db is not self.db:
+                    self._update_last_login(users_db, times)
+            transaction = self.db.transaction()
+            try:
+                self.db.multiple_insert(self.table, events, seqname=False)
+                self._update_last_login(self.db, updates.get(self.db, {}))
+            except:
+                transaction.rollback()
+                raise
+            else:
+                transaction.commit()
+        except:
+            self._requeue(events)
+            raise
+
+    def _update_last_login(self, users_db, times):
+        """ Sets ``last_login`` of accounts in ``users_db`` to ``times`` """
+        if not times:
+            return
+        transaction = users_db.transaction()
+        try:
+            for user_id, at in times.items():
+                users_db.update(self.users_table, where='id = $id',
+                                vars={'id': user_id}, last_login=at)
+        except:
+            transaction.rollback()
+            raise
+        else:
+            transaction.commit()
+
+    def _requeue(self, events):
+        """ Puts the events of a failed flush back into the buffer """
+        self._lock.acquire()
+        try:
+            self._events[:0] = events
+            del self._events[:-self.max_buffer]
+        finally:
+            self._lock.release()
+
+    def start(self):
+        """ Starts flushing the buffer every ``flush_interval`` seconds """
+        if self._timer is not None:
+            return
+        self._stopped.clear()
+        self._wake.clear()
+        self._timer = threading.Thread(target=self._run)
+        self._timer.setDaemon(True)
+        self._timer.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ Stops the timer and flushes any remaining events """
+        self._stopped.set()
+        self._wake.set()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Keep the timer alive, the events are retried by the next
+                # flush
+                pass
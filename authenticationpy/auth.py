@@ -3,9 +3,29 @@ import random
 import hashlib
 import datetime
 import string
+import time
+import threading
+import Queue
+import socket
+import smtplib
+import contextlib
+import weakref
+import struct
+import copy
 
 import web
 
+from authenticationpy import audit
+from authenticationpy import shard
+from authenticationpy import hashing
+from authenticationpy import purge
+from authenticationpy import trace
+from authenticationpy import breach
+from authenticationpy import domains
+from authenticationpy import credentials
+from authenticationpy import outbox
+from authenticationpy.identity import IdentityMap
+
 class ConfigurationError(Exception):
     pass
 
@@ -36,6 +56,91 @@ except:
 
 TABLE = 'authenticationpy_users'
 
+# If ``web.config.authshards`` is set to a list of databases, user records are
+# distributed among them, and ``web.config.authdb`` holds the global index.
+try:
+    authshards = web.config.authshards
+except AttributeError:
+    authshards = None
+
+if authshards:
+    router = shard.ShardRouter(db, authshards, TABLE)
+else:
+    router = None
+
+# Login audit trail is only kept if ``web.config.authaudit`` is set. It should
+# be a dictionary of ``AuditLog`` options (can be empty).
+try:
+    authaudit_conf = web.config.authaudit
+except AttributeError:
+    authaudit_conf = None
+
+if authaudit_conf is not None:
+    audit_log = audit.AuditLog(db, TABLE,
+                               route=router and router.db_for_id,
+                               **authaudit_conf)
+    audit_log.start()
+else:
+    audit_log = None
+
+# Optional cache shared between workers (see ``cache.SharedCache``), which is
+# checked by ``User.get_user`` before querying the database
+try:
+    shared_cache = web.config.authcache
+except AttributeError:
+    shared_cache = None
+
+# Number of seconds invalidated shared cache entries are held by a tombstone,
+# so that records read from the database before a change can't be cached
+# again. It should exceed the time a lookup takes.
+try:
+    shared_cache_hold = web.config.authcache_hold
+except AttributeError:
+    shared_cache_hold = 10
+
+# Value of shared cache tombstones, which can't be a serialized record
+_TOMBSTONE = '\0'
+
+# Keep cached ``User.stats`` results up to date as accounts are changed by
+# this process, instead of only recomputing them when they expire
+try:
+    incremental_stats = web.config.authstats_incremental
+except AttributeError:
+    incremental_stats = False
+
+# If ``web.config.authsoftdelete`` is set, deleted accounts are only marked as
+# deleted, and removed later by a background purger. The setting is a
+# dictionary of ``Purger`` options (can be empty).
+try:
+    authsoftdelete_conf = web.config.authsoftdelete
+except AttributeError:
+    authsoftdelete_conf = None
+
+soft_delete = authsoftdelete_conf is not None
+
+# Use server-side prepared statements for the fixed lookup queries (PostgreSQL
+# only)
+try:
+    prepare_queries = web.config.authdb_prepare
+except AttributeError:
+    prepare_queries = True
+
+# Account events are written to an outbox table if ``web.config.authoutbox``
+# is set to True (see the ``outbox`` module)
+try:
+    outbox_enabled = web.config.authoutbox
+except AttributeError:
+    outbox_enabled = False
+
+def _outbox_events(user, names):
+    """ Returns outbox events ``names`` for the changes made to ``user`` """
+    fields = []
+    for name, column in user._dirty_fields:
+        if column not in fields:
+            fields.append(column)
+    return [outbox.event(name, user._account_id, user.username, user.email,
+                         user.active, fields) for name in names]
+
 PASSWORD_CHARS = 'abcdefghjkmnpqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ234567890'
 
 # Usernames must start with a letter, and can contain letters, numbers, dots,
@@ -49,9 +154,13 @@ email_re = re.compile(
     r')@(?:[A-Z0-9]+(?:-*[A-Z0-9]+)*\.)+[A-Z]{2,6}$', # domain
     re.IGNORECASE)
 
+# Passwords and salts use the operating system's random source, which is
+# unpredictable, and not shared by forked processes
+_random = random.SystemRandom()
+
 def _generate_password():
     """ Generates a random 8-character string using characters from PASSWORD_CHARS """
-    return ''.join([random.choice(PASSWORD_CHARS) for i in range(8)])
+    return ''.join([_random.choice(PASSWORD_CHARS) for i in range(8)])
 
 def _password_hexdigest(username, salt, password):
     return hashlib.sha256('%s%s%s' % (username, salt, password)).hexdigest()
@@ -60,7 +169,7 @@ def _encrypt_password(username, cleartext):
     """ Encrypts the ``cleartext`` password and returns it """
 
     # TODO: maybe find a better salt generation code, or use longer salt
-    salt = ''.join([random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for i in range(16)])
+    salt = ''.join([_random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for i in range(16)])
     hexdigest = _password_hexdigest(username, salt, cleartext) 
     return '%s$%s' % (salt, hexdigest)
 
@@ -82,6 +191,733 @@ def _generate_interaction_code(username):
     hexdigest = hashlib.sha256('%s%s' % (username, timestamp)).hexdigest()
     return (timestamp, hexdigest)
 
+def _sendmail(sender, to_address, subject, body):
+    """ Sends an e-mail message ignoring delivery errors """
+    try:
+        web.utils.sendmail(from_address=sender,
+                           to_address=to_address,
+                           subject=subject,
+                           message=body)
+    except OSError:
+        pass
+
+class _Transactions(object):
+    """ Transactions on several databases
+
+    A transaction is opened on each of the ``databases`` (once per database),
+    and they are committed in the order the databases were added. Writes
+    that span databases can't be atomic, so the order decides what an error
+    between two commits leaves behind.
+
+    """
+
+    def __init__(self, *databases):
+        self._transactions = []
+        self.add(*databases)
+
+    def add(self, *databases):
+        """ Opens transactions on ``databases`` that don't have one yet """
+        for database in databases:
+            if not [d for d, t in self._transactions if d is database]:
+                self._transactions.append((database, database.transaction()))
+
+    def commit(self):
+        while self._transactions:
+            try:
+                self._transactions[0][1].commit()
+            except:
+                self.rollback()
+                raise
+            self._transactions.pop(0)
+
+    def rollback(self):
+        while self._transactions:
+            database, transaction = self._transactions.pop()
+            transaction.rollback()
+
+# Per-thread unit of work used by ``batch``
+_unit_of_work = threading.local()
+
+@contextlib.contextmanager
+def batch():
+    """ Unit of work for storing many accounts in a single transaction
+
+    Inside the ``with batch():`` block, ``User.store`` calls on existing
+    accounts are queued instead of being written immediately. When the block
+    exits, the queued accounts are written in one transaction, and accounts
+    that have the same columns modified are updated by a single ``UPDATE``
+    statement. New accounts are still inserted immediately (within the same
+    transaction), since their ids are needed right away.
+
+    Outbox events are written to each database right before it is
+    committed, so the lock that orders them is only held while committing.
+
+    If the block raises an exception, or the commit fails, nothing is
+    written, and the stored accounts get back the state they had before
+    (their versions, ids of new accounts, and modified fields), so they can
+    be stored again. Nested ``batch`` blocks join the outermost one. With
+    sharding, there is one transaction per database, so the block is only
+    atomic within each database.
+
+    """
+
+    if getattr(_unit_of_work, 'users', None) is not None:
+        yield
+        return
+
+    _unit_of_work.users = []
+    _unit_of_work.transactions = transactions = _Transactions(db)
+    _unit_of_work.after_commit = after_commit = []
+    _unit_of_work.on_rollback = on_rollback = []
+    _unit_of_work.events = events = []
+    try:
+        yield
+        _flush_batch(_unit_of_work.users)
+        for target, target_events in events:
+            outbox.write(target, target_events)
+        transactions.commit()
+    except:
+        transactions.rollback()
+        for func, args in reversed(on_rollback):
+            func(*args)
+        raise
+    finally:
+        _unit_of_work.users = None
+        _unit_of_work.transactions = None
+        _unit_of_work.after_commit = None
+        _unit_of_work.on_rollback = None
+        _unit_of_work.events = None
+    for func, args in after_commit:
+        func(*args)
+
+def _join_batch(*databases):
+    """ Adds ``databases`` to the transactions of the current ``batch`` """
+    if getattr(_unit_of_work, 'transactions', None) is not None:
+        _unit_of_work.transactions.add(*databases)
+
+def _after_commit(func, *args):
+    """ Calls ``func`` once the changes that were made are committed
+
+    Within a ``batch`` block, the call is deferred until the block is
+    committed, and dropped if the block fails.
+
+    """
+
+    after_commit = getattr(_unit_of_work, 'after_commit', None)
+    if after_commit is not None:
+        after_commit.append((func, args))
+    else:
+        func(*args)
+
+def _on_rollback(func, *args):
+    """ Calls ``func`` if the current ``batch`` block is rolled back
+
+    Outside of a ``batch`` block, the changes are already committed, and
+    ``func`` is never called.
+
+    """
+
+    on_rollback = getattr(_unit_of_work, 'on_rollback', None)
+    if on_rollback is not None:
+        on_rollback.append((func, args))
+
+def _write_events(target, events):
+    """ Writes outbox ``events`` to ``target``
+
+    Within a ``batch`` block, the events are queued and written when the
+    block is committed, since ``outbox.write`` locks the outbox until the end
+    of the transaction.
+
+    """
+
+    queued = getattr(_unit_of_work, 'events', None)
+    if queued is None:
+        outbox.write(target, events)
+        return
+    for database, database_events in queued:
+        if database is target:
+            database_events.extend(events)
+            return
+    queued.append((target, list(events)))
+
+# Types of the columns that can be updated in a batch, since values in a
+# ``VALUES`` list that are all ``NULL`` would otherwise be typed as text
+_BATCH_COLUMN_TYPES = {
+    'username': 'VARCHAR',
+    'email': 'VARCHAR',
+    'password': 'CHAR(81)',
+    'pending_pwd': 'CHAR(81)',
+    'active': 'BOOLEAN',
+    'act_code': 'CHAR(64)',
+    'act_time': 'TIMESTAMP',
+    'act_type': 'CHAR(1)',
+}
+
+def _batch_update(target, columns, users):
+    """ Updates ``columns`` of ``users`` in ``target`` using one statement
+
+    Each row is only updated if its version still matches the version of the
+    account, and the number of updated rows is returned.
+
+    """
+
+    rows = []
+    for user in users:
+        data = user._data_to_store
+        values = [user._account_id, user._version] + [data[c] for c in columns]
+        rows.append(web.db.SQLQuery.join([web.db.sqlquote(v) for v in values],
+                                         ', ', prefix='(', suffix=')'))
+    assignments = ', '.join(['%s = CAST(v.%s AS %s)' %
+                             (c, c, _BATCH_COLUMN_TYPES[c]) for c in columns])
+    query = ('UPDATE %s AS u SET %s, version = u.version + 1 FROM (VALUES ' %
+             (TABLE, assignments))
+    query = query + web.db.SQLQuery.join(rows, ', ')
+    query = query + (') AS v (id, version, %s) WHERE u.id = v.id AND '
+                     'u.version = v.version' % ', '.join(columns))
+    return target.query(query)
+
+def _flush_batch(users):
+    """ Writes queued accounts grouping updates of the same columns together """
+    groups = {}
+    order = []
+    for user in users:
+        data = user._data_to_store
+        if not data:
+            continue
+        target = _user_db(user._shard_key)
+        key = (target, tuple(sorted(data.keys())))
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(user)
+
+    for key in order:
+        target, columns = key
+        group = groups[key]
+        _join_batch(target)
+        if 'username' in columns or 'email' in columns:
+            for user in group:
+                data = user._data_to_store
+                _purge_deleted(target, data.get('username'),
+                               data.get('email'))
+        if _batch_update(target, columns, group) != len(group):
+            raise StaleUserError('Accounts were modified concurrently')
+
+    if outbox_enabled:
+        events = {}
+        for key in order:
+            for user in groups[key]:
+                events.setdefault(key[0], []).extend(
+                    _outbox_events(user, user._events or ['store']))
+        for target, target_events in events.items():
+            _write_events(target, target_events)
+
+    for key in order:
+        for user in groups[key]:
+            _on_rollback(user._restore, user._snapshot())
+            object.__setattr__(user, '_version', user._version + 1)
+            object.__setattr__(user, '_dirty_fields', [])
+            object.__setattr__(user, '_events', [])
+            _shared_cache_forget(user._shard_key, user.email)
+            _forget_credentials(user)
+            _identity_map().add(user)
+            object.__setattr__(user, '_shard_key', user.username)
+            _after_commit(_stats_apply, user._stats_state, user._stats_key())
+            object.__setattr__(user, '_stats_state', user._stats_key())
+
+
+if soft_delete:
+    purger = purge.Purger(router and router.shards or [db], TABLE,
+                          **authsoftdelete_conf)
+    purger.start()
+else:
+    purger = None
+
+# Queries can be traced per request for debugging (see the ``trace`` module)
+try:
+    trace_queries = web.config.authtrace
+except AttributeError:
+    trace_queries = False
+
+if trace_queries:
+    for database in [db] + (router and router.shards or []):
+        trace.install(database)
+
+LIVE_CLAUSE = 'deleted_at IS NULL'
+
+def _live(where=None):
+    """ Restricts ``where`` clause to accounts that are not soft-deleted """
+    if not soft_delete:
+        return where
+    if not where:
+        return web.db.SQLQuery(LIVE_CLAUSE)
+    return '(' + where + ') AND ' + LIVE_CLAUSE
+
+# Columns read by ``User._map_user_properties``. Prepared queries list them
+# explicitly, since the plan of a ``SELECT *`` statement breaks when columns
+# are added to the table. The ``last_login`` column is only required (and
+# read) if the audit trail is enabled.
+USER_COLUMNS = ('id, username, email, password, pending_pwd, act_code, '
+                'act_time, act_type, registered_at, active, version')
+if audit_log is not None:
+    USER_COLUMNS += ', last_login'
+
+# Fixed queries that are prepared once per connection. Keys are the sorted
+# names of the parameters, which are passed in that order. The ``{live}``
+# marker is replaced by the soft delete condition if needed.
+PREPARED_QUERIES = {
+    ('username',): (
+        'authpy_by_username',
+        'SELECT %s FROM %s WHERE username = $1{live} LIMIT 1' %
+        (USER_COLUMNS, TABLE)),
+    ('email',): (
+        'authpy_by_email',
+        'SELECT %s FROM %s WHERE email = $1{live} LIMIT 1' %
+        (USER_COLUMNS, TABLE)),
+    ('email', 'username'): (
+        'authpy_by_email_username',
+        'SELECT %s FROM %s WHERE email = $1 AND username = $2{live} '
+        'LIMIT 1' % (USER_COLUMNS, TABLE)),
+    ('act_code',): (
+        'authpy_by_act_code',
+        'SELECT %s FROM %s WHERE act_code = $1{live} LIMIT 1' %
+        (USER_COLUMNS, TABLE)),
+    ('exists',): (
+        'authpy_exists',
+        'SELECT 1 AS id FROM %s WHERE (email = $1 OR username = $2){live} '
+        'LIMIT 1' % TABLE),
+    ('taken',): (
+        'authpy_taken',
+        'SELECT username, email FROM %s WHERE (email = $1 OR username = $2)'
+        '{live} LIMIT 2' % TABLE),
+    ('insert',): (
+        'authpy_insert',
+        'INSERT INTO %s (username, email, password, active, act_code, '
+        'act_time, act_type) VALUES ($1, $2, $3, $4, $5, $6, $7) '
+        'RETURNING id' % TABLE),
+}
+
+# Errors after which the prepared statements of a connection are looked up
+# again: duplicate_prepared_statement, invalid_sql_statement_name, and
+# feature_not_supported ("cached plan must not change result type")
+_PREPARED_RETRY_CODES = ('42P05', '26000', '0A000')
+
+# Names of the statements prepared on each DB-API connection. Connections
+# outlive ``database.ctx`` when they are pooled, so they are tracked here.
+_prepared = weakref.WeakKeyDictionary()
+
+def _can_prepare(database):
+    return prepare_queries and getattr(database, 'dbname', None) == 'postgres'
+
+def _raw_connection(connection):
+    """ Returns the DB-API connection wrapped by a pooled ``connection`` """
+    while hasattr(connection, '_con'):
+        connection = connection._con
+    return connection
+
+def _prepared_names(connection):
+    """ Returns the names of the statements prepared on ``connection``
+
+    The names are read from the server the first time a connection is seen,
+    so statements prepared before the connection was returned to the pool
+    are not prepared again.
+
+    """
+
+    raw = _raw_connection(connection)
+    names = _prepared.get(raw)
+    if names is None:
+        cursor = connection.cursor()
+        cursor.execute('SELECT name FROM pg_prepared_statements')
+        names = _prepared[raw] = set([row[0] for row in cursor.fetchall()])
+    return names
+
+def _execute_prepared(key, args, database):
+    """ Executes a prepared query, and returns a list of records
+
+    Statements are prepared the first time they are used on a connection.
+    Unlike ``db.where``, the SQL is not rebuilt on every call.
+
+    Outside of a transaction, a failed statement is rolled back, so the
+    connection can be reused. If the statement failed because it was missing,
+    already prepared, or has to be planned again, it's prepared again and
+    retried once. Within a transaction, errors are left to the transaction.
+
+    """
+
+    name, sql = PREPARED_QUERIES[key]
+    if soft_delete:
+        name += '_live'
+        sql = sql.replace('{live}', ' AND ' + LIVE_CLAUSE)
+    else:
+        sql = sql.replace('{live}', '')
+    connection = database.ctx.db
+
+    retried = False
+    while True:
+        try:
+            prepared = _prepared_names(connection)
+            cursor = connection.cursor()
+            if name not in prepared:
+                cursor.execute('PREPARE %s AS %s' % (name, sql))
+                prepared.add(name)
+            start = time.time()
+            cursor.execute('EXECUTE %s (%s)' %
+                           (name, ', '.join(['%s'] * len(args))), args)
+            break
+        except Exception as error:
+            _prepared.pop(_raw_connection(connection), None)
+            if database.ctx.transactions:
+                raise
+            database.ctx.rollback()
+            if retried or \
+               getattr(error, 'pgcode', None) not in _PREPARED_RETRY_CODES:
+                raise
+            retried = True
+            if name in _prepared_names(connection):
+                connection.cursor().execute('DEALLOCATE %s' % name)
+                _prepared_names(connection).discard(name)
+
+    query_trace = trace.current()
+    if query_trace is not None:
+        query_trace.record(sql, args, time.time() - start)
+    names = [column[0] for column in cursor.description]
+    records = [web.storage(zip(names, row)) for row in cursor.fetchall()]
+    if not database.ctx.transactions:
+        database.ctx.commit()
+    return records
+
+def _purge_deleted(target, username=None, email=None):
+    """ Removes soft-deleted accounts holding ``username`` or ``email``
+
+    Soft-deleted accounts keep their username and e-mail address until they
+    are purged, so they are purged right away when another account takes
+    either of them.
+
+    """
+
+    where = {}
+    if username:
+        where['username'] = username
+    if email:
+        where['email'] = email
+    if not soft_delete or not where:
+        return
+    target.delete(TABLE, where='(' + web.db.sqlwhere(where, ' OR ') +
+                               ') AND deleted_at IS NOT NULL')
+
+def _change_accounts(target, event, where, **values):
+    """ Updates accounts matching ``where`` in ``target`` with ``values``
+
+    If no ``values`` are given, the accounts are deleted. Otherwise, their
+    ``version`` is incremented, so instances loaded before the change can't
+    undo it with ``store`` (which raises ``StaleUserError``). Accounts changed by
+    a ``'delete'`` ``event`` are no longer counted by ``User.stats``, even if
+    they are only marked as deleted. The changed rows are returned by the
+    statement itself (with the values they had before), and used for the
+    outbox events, the cached statistics, and the credential cache.
+
+    """
+
+    returning = 'id, username, email, active, act_type, registered_at'
+    if values:
+        query = ('UPDATE %s AS u SET ' % TABLE +
+                 web.db.sqlwhere(values, ', ') +
+                 ', version = u.version + 1 FROM (SELECT %s FROM %s WHERE ' % (returning, TABLE) +
+                 where + ' FOR UPDATE) AS old WHERE u.id = old.id '
+                 'RETURNING old.*')
+    else:
+        query = ('DELETE FROM %s WHERE ' % TABLE + where +
+                 ' RETURNING ' + returning)
+
+    _join_batch(target)
+    transaction = target.transaction()
+    try:
+        records = list(target.query(query))
+        if outbox_enabled:
+            _write_events(target, [outbox.event(event, r.id, r.username,
+                                                r.email, r.active)
+                                   for r in records])
+    except:
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+
+    for record in records:
+        before = _stats_key(record.active, record.act_type,
+                            record.registered_at)
+        if event == 'delete':
+            after = None
+        else:
+            after = _stats_key(values.get('active', record.active),
+                               record.act_type, record.registered_at)
+        _after_commit(_stats_apply, before, after)
+        if credential_cache:
+            credential_cache.forget(record.id)
+
+def _user_db(username):
+    """ Returns the database that holds the account for ``username`` """
+    if router:
+        return router.db_for(username)
+    return db
+
+def _locate_user(where):
+    """ Returns the database and the shard index entry for an account
+
+    If the account cannot be found in the shard index, ``(None, None)`` is
+    returned. Without sharding, the index entry is always ``None``.
+
+    """
+
+    if not router:
+        return db, None
+    entry = router.lookup(**where)
+    if entry is None:
+        return None, None
+    return router.shards[entry.shard], entry
+
+def _select_users(**where):
+    """ Returns user records matching all of the ``where`` values """
+    target = db
+    if router:
+        if 'username' in where:
+            target = router.db_for(where['username'])
+        else:
+            entry = router.lookup(**where)
+            if entry is None:
+                return []
+            target = router.shards[entry.shard]
+
+    key = tuple(sorted(where.keys()))
+    if _can_prepare(target) and key in PREPARED_QUERIES:
+        return _execute_prepared(key, [where[k] for k in key], target)
+    return target.select(TABLE, where=_live(web.db.sqlwhere(where)))
+
+
+# Binary record format used by ``User.to_bytes``. The header holds the format
+# version, id, row version, and the active flag. It is followed by the
+# length-prefixed strings in ``_SERIAL_STRINGS`` order, and timestamps in
+# ``_SERIAL_TIMES`` order (microseconds since the epoch).
+SERIAL_VERSION = 1
+_SERIAL_HEADER = struct.Struct('!BqiB')
+_SERIAL_LENGTH = struct.Struct('!H')
+_SERIAL_TIME = struct.Struct('!q')
+_SERIAL_STRINGS = ['username', 'email', 'password', 'pending_pwd', 'act_code',
+                   'act_type']
+_SERIAL_TIMES = ['act_time', 'registered_at', 'last_login']
+_NO_STRING = 0xffff
+_NO_TIME = -2 ** 63
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _record_to_bytes(record):
+    """ Serializes a user record into the binary record format """
+    parts = [_SERIAL_HEADER.pack(SERIAL_VERSION, record.id or 0,
+                                 record.version or 0, record.active and 1 or 0)]
+    for name in _SERIAL_STRINGS:
+        value = record.get(name)
+        if value is None:
+            parts.append(_SERIAL_LENGTH.pack(_NO_STRING))
+        else:
+            value = web.utf8(value)
+            parts.append(_SERIAL_LENGTH.pack(len(value)))
+            parts.append(value)
+    for name in _SERIAL_TIMES:
+        value = record.get(name)
+        if value is None:
+            parts.append(_SERIAL_TIME.pack(_NO_TIME))
+        else:
+            delta = value - _EPOCH
+            parts.append(_SERIAL_TIME.pack(
+                (delta.days * 86400 + delta.seconds) * 1000000 +
+                delta.microseconds))
+    return ''.join(parts)
+
+def _record_from_bytes(data):
+    """ Deserializes a user record from the binary record format """
+    version, id, row_version, active = _SERIAL_HEADER.unpack_from(data)
+    if version != SERIAL_VERSION:
+        raise ValueError('Unsupported user record format %s' % version)
+    record = web.storage(id=id or None, version=row_version,
+                         active=bool(active))
+    offset = _SERIAL_HEADER.size
+    for name in _SERIAL_STRINGS:
+        length, = _SERIAL_LENGTH.unpack_from(data, offset)
+        offset += _SERIAL_LENGTH.size
+        if length == _NO_STRING:
+            record[name] = None
+        else:
+            record[name] = data[offset:offset + length].decode('utf-8')
+            offset += length
+    for name in _SERIAL_TIMES:
+        value, = _SERIAL_TIME.unpack_from(data, offset)
+        offset += _SERIAL_TIME.size
+        if value == _NO_TIME:
+            record[name] = None
+        else:
+            record[name] = _EPOCH + datetime.timedelta(microseconds=value)
+    return record
+
+def _shared_cache_forget(username=None, email=None):
+    """ Removes an account from the shared cache
+
+    Both keys of the account are removed even if only one of ``username`` or
+    ``email`` is known. The entries are replaced by tombstones, which keep
+    ``User.get_user`` calls that are still in progress from caching the old
+    record again.
+
+    """
+
+    if not shared_cache:
+        return
+    keys = []
+    if username:
+        keys.append('u:' + web.utf8(username))
+    if email:
+        keys.append('e:' + web.utf8(email))
+    for key in list(keys):
+        data = shared_cache.get(key)
+        if data is not None and data != _TOMBSTONE:
+            record = _record_from_bytes(data)
+            keys.extend(['u:' + web.utf8(record.username),
+                         'e:' + web.utf8(record.email)])
+    for key in set(keys):
+        shared_cache.set(key, _TOMBSTONE, ttl=shared_cache_hold)
+
+
+# Password hashing runs in a pool of worker processes if
+# ``web.config.authhashing`` is set to a dictionary of ``HashingExecutor``
+# options (can be empty)
+try:
+    authhashing_conf = web.config.authhashing
+except AttributeError:
+    authhashing_conf = None
+
+if authhashing_conf is not None:
+    hashing_executor = hashing.HashingExecutor(**authhashing_conf)
+else:
+    hashing_executor = None
+
+HashingBusyError = hashing.HashingBusyError
+
+# Successful password verifications are cached for a short time if
+# ``web.config.authcredcache`` is set to a dictionary of ``VerifiedCache``
+# options (can be empty)
+try:
+    authcredcache_conf = web.config.authcredcache
+except AttributeError:
+    authcredcache_conf = None
+
+if authcredcache_conf is not None:
+    credential_cache = credentials.VerifiedCache(**authcredcache_conf)
+else:
+    credential_cache = None
+
+def _forget_credentials(user):
+    if credential_cache and user is not None:
+        credential_cache.forget(user._account_id)
+
+# Passwords are checked against a blocklist of breached passwords if
+# ``web.config.authbreached`` is set to the path of a file built with the
+# ``breach`` module. The file is memory-mapped, so open it before forking.
+try:
+    authbreached_path = web.config.authbreached
+except AttributeError:
+    authbreached_path = None
+
+if authbreached_path:
+    breached_passwords = breach.Blocklist(authbreached_path)
+else:
+    breached_passwords = None
+
+# E-mail addresses on blocked domains (e.g., disposable e-mail services) are
+# rejected if ``web.config.authblocked_domains`` is set to the path of a
+# blocklist file, or a list of domains (see the ``domains`` module)
+try:
+    authblocked_domains = web.config.authblocked_domains
+except AttributeError:
+    authblocked_domains = None
+
+if isinstance(authblocked_domains, basestring):
+    blocked_domains = domains.DomainBlocklist(path=authblocked_domains)
+elif authblocked_domains:
+    blocked_domains = domains.DomainBlocklist(domains=authblocked_domains)
+else:
+    blocked_domains = None
+
+def is_blocked_email(email):
+    """ Tests whether ``email`` address is on a blocked domain """
+    return blocked_domains is not None and blocked_domains.is_blocked(email)
+
+def is_breached(password):
+    """ Tests whether ``password`` is in the breached password blocklist """
+    return breached_passwords is not None and password in breached_passwords
+
+def _hash(func, *args):
+    """ Runs a hashing function using the hashing executor if any """
+    if hashing_executor:
+        return hashing_executor.run(func, *args)
+    return func(*args)
+
+# Cached result of ``User.stats``
+_stats_cache = {'value': None, 'expires': 0}
+_stats_lock = threading.Lock()
+
+def _stats_key(active, act_type, registered_at):
+    """ Returns the state of an account as counted by ``User.stats`` """
+    if registered_at:
+        day = registered_at.date()
+    else:
+        day = datetime.date.today()
+    return (bool(active), act_type, day)
+
+def _stats_apply(before, after):
+    """ Updates cached statistics for an account changing state
+
+    ``before`` and ``after`` are the results of ``_stats_key`` before and
+    after the change, or ``None`` if the account didn't (or no longer does)
+    exist.
+
+    """
+
+    if not incremental_stats or before == after:
+        return
+    _stats_lock.acquire()
+    try:
+        stats = _stats_cache['value']
+        if stats is None:
+            return
+        for state, sign in [(before, -1), (after, 1)]:
+            if state is None:
+                continue
+            active, act_type, day = state
+            stats[active and 'active' or 'inactive'] += sign
+            if act_type:
+                stats.pending[act_type] = stats.pending.get(act_type, 0) + sign
+            stats.registrations[day] = stats.registrations.get(day, 0) + sign
+    finally:
+        _stats_lock.release()
+
+
+def _identity_map():
+    """ Returns the identity map of the current request
+
+    The map is only kept if ``user_cache_hook`` has set up the cache for the
+    request (a cache that was reset to a dict is replaced by a new map).
+    Otherwise, e.g., in scripts and worker threads, an empty map is returned
+    that is not kept, so every lookup queries the database, and loaded
+    accounts are not held in memory.
+
+    """
+
+    identity_map = web.ctx.get('auth_user_cache')
+    if isinstance(identity_map, IdentityMap):
+        return identity_map
+    if isinstance(identity_map, dict):
+        identity_map = web.ctx.auth_user_cache = IdentityMap()
+        return identity_map
+    return IdentityMap()
+
 
 class UserError(Exception):
     pass
@@ -103,6 +939,10 @@ class UserInteractionError(UserError):
     pass
 
 
+class StaleUserError(UserError):
+    pass
+
+
 class User(object):
     """ User and user management class
 
@@ -125,6 +965,7 @@ class User(object):
         # These properties are set directly during __init__
         object.__setattr__(self, 'password', None)
         object.__setattr__(self, 'registered_at', None)
+        object.__setattr__(self, 'last_login', None)
         object.__setattr__(self, 'active', False)
         object.__setattr__(self, '_act_code', None)
         object.__setattr__(self, '_act_time', None)
@@ -133,6 +974,11 @@ class User(object):
         object.__setattr__(self, '_account_id', None)
         object.__setattr__(self, '_dirty_fields', [])
         object.__setattr__(self, '_pending_pwd', None)
+        object.__setattr__(self, '_version', 0)
+        object.__setattr__(self, '_shard_key', None)
+        object.__setattr__(self, '_stats_state', None)
+        object.__setattr__(self, '_unhashed', {})
+        object.__setattr__(self, '_events', [])
         
         self.username = username
         self.email = email
@@ -158,8 +1004,9 @@ class User(object):
                 raise ValueError('Passwords cannot be blank')
             if len(value) < min_pwd_length:
                 raise ValueError('Passwords cannot be shorter than %s characters.' % min_pwd_length)
+            if is_breached(value):
+                raise ValueError('This password is known to have been leaked')
             self._cleartext = value
-            value = _encrypt_password(self.username, value)    
 
         # store tuples of property name and column name for dirty fields
         if name in ['username', 'email', 'password', 'active']:
@@ -168,9 +1015,31 @@ class User(object):
         if name in ['_act_code', '_act_time', '_act_type', '_pending_pwd']:
             self._dirty_fields.append((name, name[1:]))
 
+        if name in ['password', '_pending_pwd']:
+            # Hashing is deferred until the password is needed (usually in
+            # ``store``), so reassigning it doesn't cost a hash each time
+            self._unhashed[name] = value
+            self.__dict__.pop(name, None)
+            return
+
         # no errors so far, so go ahead and assign
         object.__setattr__(self, name, value)
 
+    def __getattr__(self, name):
+        # Only called for missing attributes, i.e., passwords awaiting hashing
+        if name in self.__dict__.get('_unhashed', {}):
+            self._hash_passwords()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _hash_passwords(self):
+        """ Hashes the passwords that were assigned since the last call """
+        for name, cleartext in self._unhashed.items():
+            object.__setattr__(self, name,
+                               _hash(_encrypt_password, self.username,
+                                     cleartext))
+        self._unhashed.clear()
+
     def set_interaction(self, type):
         """ Sets interaction data
 
@@ -272,16 +1141,18 @@ class User(object):
         
         """
 
-        if db.where(TABLE, what='username', limit=1, username=self.username):
+        if _select_users(username=self.username):
             raise DuplicateUserError("Username '%s' already exists" % self.username)
 
-        if db.where(TABLE, what='email', limit=1, email=self.email):
+        if _select_users(email=self.email):
             raise DuplicateEmailError("Email '%s' already exists" % self.email)
 
         if not self._new_account:
             raise UserAccountError('Account for %s (%s) is not new' % (self.username,
                                                                        self.email))
-        if not self.password:
+        self._check_email_domain()
+
+        if 'password' not in self._unhashed and not self.password:
             self._cleartext = _generate_password()
             self.password = self._cleartext
 
@@ -300,50 +1171,183 @@ class User(object):
         self.store()
 
     def store(self):
-        """ Stores a user account """
+        """ Stores a user account
+
+        Existing accounts are only updated if their ``version`` column still
+        matches the version that was loaded. If another process has stored the
+        account in the meantime, ``StaleUserError`` is raised, and the account
+        must be loaded again before retrying.
+
+        Within a ``batch`` block, existing accounts are queued and stored when
+        the block exits.
+
+        """
         if self._dirty_fields:
-            # Destroy the cache in an unlikely event that the username or
-            # email matches the cached username or email respectively (this
-            # happens in tests).
-            if web.ctx.auth_user_cache.get('username') == self.username or \
-               web.ctx.auth_user_cache.get('email') == self.email:
-                web.ctx.auth_user_cache = {}
-
-            transaction = db.transaction()
+            self._check_email_domain()
+            self._hash_passwords()
+
+            # Changes to indexed columns of sharded accounts must update the
+            # global index, so they are never queued
+            index_changes = router and self._index_changes
+            queued = getattr(_unit_of_work, 'users', None)
+            if queued is not None and not self._new_account and \
+               not index_changes:
+                if not [u for u in queued if u is self]:
+                    queued.append(self)
+                return
+
+            old_username = self._shard_key
+            old_stats_state = self._stats_state
+            new_target = _user_db(self.username)
+            if self._new_account:
+                target = new_target
+            else:
+                target = _user_db(self._shard_key)
+            # When the account moves to another shard, the copy is committed
+            # before the index entry, and the original is removed last, so a
+            # failed move leaves the account where it was, and can be
+            # repeated
+            databases = [new_target] + (router and [db] or []) + [target]
+            _join_batch(*databases)
+            transaction = _Transactions(*databases)
+            new_account = self._new_account
+            snapshot = self._snapshot()
             try:
-                if self._new_account:
+                if new_account:
                     if not self.password:
                         raise UserAccountError('Password cannot be blank.')
-                    db.insert(TABLE, **self._data_to_insert)
-                    record = db.where(TABLE, what='id',
-                                      limit=1,
-                                      username=self.username)[0]
+                    data = self._data_to_insert
+                    _purge_deleted(target, self.username, self.email)
+                    if router:
+                        data['id'] = self._register()
+                        target.insert(TABLE, seqname=False, **data)
+                        record = web.storage(id=data['id'])
+                    elif _can_prepare(target):
+                        record = _execute_prepared(('insert',), [
+                            data['username'], data['email'], data['password'],
+                            data['active'], data.get('act_code'),
+                            data.get('act_time'), data.get('act_type')],
+                            target)[0]
+                    else:
+                        target.insert(TABLE, **data)
+                        record = target.where(TABLE, what='id',
+                                              limit=1,
+                                              username=self.username)[0]
                     self._account_id = record.id
+                    if outbox_enabled:
+                        _write_events(target, _outbox_events(self, ['create']))
                 else:
-                    db.update(TABLE, where='id = $id',
-                              vars={'id': self._account_id},
-                              **self._data_to_store)
+                    changes = self._data_to_store
+                    for database in set([target, new_target]):
+                        _purge_deleted(database, changes.get('username'),
+                                       changes.get('email'))
+                    updated = target.update(TABLE,
+                                            where='id = $id AND version = $version',
+                                            vars={'id': self._account_id,
+                                                  'version': self._version},
+                                            version=web.db.SQLLiteral('version + 1'),
+                                            **self._data_to_store)
+                    if not updated:
+                        raise StaleUserError('Account for %s was modified '
+                                             'concurrently' % self.username)
+                    if index_changes:
+                        if 'username' in index_changes:
+                            index_changes['shard'] = router.shard_for(self.username)
+                        if new_target is not target:
+                            router.move(self._account_id, target, new_target,
+                                        **index_changes)
+                        else:
+                            router.update(self._account_id, **index_changes)
+                    if outbox_enabled:
+                        _write_events(new_target,
+                                      _outbox_events(self,
+                                                     self._events or ['store']))
+                transaction.commit()
             except:
                 transaction.rollback()
+                self._restore(snapshot)
                 raise
             else:
-                transaction.commit()
+                _on_rollback(self._restore, snapshot)
+                if not new_account:
+                    object.__setattr__(self, '_version', self._version + 1)
+                object.__setattr__(self, '_shard_key', self.username)
+                object.__setattr__(self, '_dirty_fields', [])
+                object.__setattr__(self, '_events', [])
+                _shared_cache_forget(old_username, self.email)
+                _forget_credentials(self)
+                _identity_map().add(self)
+                object.__setattr__(self, '_stats_state', self._stats_key())
+                _after_commit(_stats_apply, old_stats_state, self._stats_state)
 
         # nothing to store
         pass
 
+    def _stats_key(self):
+        """ Returns the state of the account as counted by ``stats`` """
+        return _stats_key(self.active, self._act_type, self.registered_at)
+
+    # Properties that ``store`` changes once the account is written
+    _STORED_STATE = ['_account_id', '_version', '_shard_key', '_dirty_fields',
+                     '_events', '_stats_state']
+
+    def _snapshot(self):
+        """ Returns the state that ``_restore`` puts back """
+        return dict([(name, copy.copy(getattr(self, name)))
+                     for name in self._STORED_STATE])
+
+    def _restore(self, snapshot):
+        """ Puts back the state of an account whose changes were rolled back """
+        if snapshot['_account_id'] is None and self._account_id:
+            # A new account that was never committed
+            _identity_map().discard(self)
+        for name in self._STORED_STATE:
+            object.__setattr__(self, name, snapshot[name])
+
+    def _register(self):
+        """ Adds the account to the shard index and returns the new id """
+        try:
+            return router.register(self.username, self.email, self._act_code)
+        except Exception:
+            # Another process may have taken the username or the e-mail
+            # address since ``create`` has checked them
+            if router.lookup(username=self.username):
+                raise DuplicateUserError("Username '%s' already exists" %
+                                         self.username)
+            if router.lookup(email=self.email):
+                raise DuplicateEmailError("Email '%s' already exists" %
+                                          self.email)
+            raise
+
     def activate(self):
         self.clear_interaction()
         self.active = True
+        self._events.append('activate')
 
     def authenticate(self, password):
-        """ Test ``password`` and return boolean success status """
+        """ Test ``password`` and return boolean success status
+
+        If the audit trail is enabled, the attempt is recorded.
+
+        """
         if not self.active:
+            if audit_log:
+                audit_log.record(self._account_id, self.username, False)
             raise UserAccountError('Cannot authenticate inactive account')
-        salt, crypt = self.password.split('$')
-        return _password_hexdigest(self.username,
-                                   salt,
-                                   password) == crypt
+        if credential_cache and credential_cache.check(self._account_id,
+                                                       password,
+                                                       self.password):
+            success = True
+        else:
+            salt, crypt = self.password.split('$')
+            success = _hash(_password_hexdigest, self.username,
+                            salt, password) == crypt
+            if success and credential_cache:
+                credential_cache.add(self._account_id, password,
+                                     self.password)
+        if audit_log:
+            audit_log.record(self._account_id, self.username, success)
+        return success
 
     def reset_password(self, password=None, message=None, confirmation=None):
         """ Resets the user password 
@@ -396,10 +1400,12 @@ class User(object):
     def confirm_reset(self):
         """ Assign pending password as new """
         self.clear_interaction()
+        self._unhashed.pop('password', None)
         object.__setattr__(self, 'password', self._pending_pwd)
         object.__setattr__(self, '_pending_pwd', None)
         self._dirty_fields.extend([('password', 'password'), 
                                    ('_pending_pwd', 'pending_pwd')])
+        self._events.append('confirm_reset')
 
     def send_email(self, message, subject, sender=sender, **kwargs):
         """ Send an arbitrary e-mail message to the user 
@@ -446,14 +1452,168 @@ class User(object):
                       'email': self.email }
         template = string.Template(message)
         body = template.substitute(**kwargs)
+        _sendmail(sender, self.email, subject, body)
+
+    @classmethod
+    def broadcast_email(cls, message, subject, filters=None, sender=sender,
+                        batch_size=500, workers=4, rate=None, start_after=0,
+                        progress=None, on_failure=None, **kwargs):
+        """ Send a templated e-mail message to all matching users
+
+        Required arguments are the same as for ``send_email``:
+
+        * ``message``: the body template of the e-mail
+        * ``subject``: e-mail's subject
+
+        ``filters`` is an optional dictionary of column values that matching
+        accounts must have (e.g., ``{'active': False}`` targets all
+        unactivated accounts). If it's omitted, all users receive the message.
+
+        Users are read from the database in batches of ``batch_size`` records
+        ordered by id, and the messages are delivered by ``workers`` sender
+        threads. If ``rate`` is specified, no more than ``rate`` messages per
+        second are sent.
+
+        Broadcasts can be resumed. After each batch is delivered, the
+        ``progress`` callable (if any) is called with the id of the last user
+        in the batch, and the number of messages sent so far. Passing that id
+        as ``start_after`` argument continues the broadcast from the next user.
+
+        The template variables available in the ``message`` are:
+
+        * ``$sender``: the sender's e-mail address
+        * ``$username``: username of the receiving user
+        * ``$email``: e-mail address of the receiving user
+
+        Any additional ``kwargs`` are made available to the template as well.
+
+        Messages that can't be delivered are skipped, and the ``on_failure``
+        callable (if any) is called with the e-mail address of each of them
+        (from the sender threads).
+
+        Returns the number of messages sent successfully.
+
+        """
+
+        template = string.Template(message)
+        queue = Queue.Queue(maxsize=workers * 2)
+        throttle_lock = threading.Lock()
+        next_slot = [time.time()]
+        counts = {'sent': 0, 'failed': 0}
+        count_lock = threading.Lock()
+
+        def count(outcome, email=None):
+            count_lock.acquire()
+            try:
+                counts[outcome] += 1
+            finally:
+                count_lock.release()
+            if email is not None and on_failure:
+                on_failure(email)
+
+        def throttle():
+            if not rate:
+                return
+            throttle_lock.acquire()
+            try:
+                now = time.time()
+                wait = next_slot[0] - now
+                next_slot[0] = max(now, next_slot[0]) + 1.0 / rate
+            finally:
+                throttle_lock.release()
+            if wait > 0:
+                time.sleep(wait)
+
+        def deliver():
+            while True:
+                item = queue.get()
+                try:
+                    if item is None:
+                        return
+                    throttle()
+                    try:
+                        web.utils.sendmail(from_address=sender,
+                                           to_address=item[0],
+                                           subject=subject,
+                                           message=item[1])
+                    except (smtplib.SMTPException, socket.error, OSError):
+                        # A failed delivery must not stop the worker, or the
+                        # remaining messages would never be taken off the
+                        # queue
+                        count('failed', item[0])
+                    else:
+                        count('sent')
+                finally:
+                    queue.task_done()
+
+        threads = [threading.Thread(target=deliver) for i in range(workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+
+        last_id = start_after
         try:
-            
-            web.utils.sendmail(from_address=sender,
-                               to_address=self.email,
-                               subject=subject,
-                               message=body)
-        except OSError:
-            pass
+            while True:
+                where = web.db.reparam('id > $last_id', {'last_id': last_id})
+                if filters:
+                    where = where + ' AND ' + web.db.sqlwhere(filters)
+                where = _live(where)
+                # With sharding, the next batch is merged from all shards,
+                # which works because ids are unique across shards
+                records = []
+                for database in (router and router.shards or [db]):
+                    records.extend(database.select(TABLE,
+                                                   what='id, username, email',
+                                                   where=where, order='id',
+                                                   limit=batch_size))
+                records.sort(key=lambda r: r.id)
+                records = records[:batch_size]
+                if not records:
+                    break
+                for record in records:
+                    template_vars = dict(kwargs)
+                    template_vars.update(sender=sender,
+                                         username=record.username,
+                                         email=record.email)
+                    queue.put((record.email,
+                               template.safe_substitute(**template_vars)))
+                queue.join()
+                last_id = records[-1].id
+                if progress:
+                    progress(last_id, counts['sent'])
+        finally:
+            for thread in threads:
+                queue.put(None)
+
+        return counts['sent']
+
+    def to_bytes(self):
+        """ Returns the account serialized in a compact binary format
+
+        The format is versioned, and does not use pickle, so it's safe to
+        store in caches shared with other processes. Use ``from_bytes`` to
+        restore the account.
+
+        """
+
+        return _record_to_bytes(web.storage(
+            id=self._account_id,
+            version=self._version,
+            active=self.active,
+            username=self.username,
+            email=self.email,
+            password=self.password,
+            pending_pwd=self._pending_pwd,
+            act_code=self._act_code,
+            act_type=self._act_type,
+            act_time=self._act_time,
+            registered_at=self.registered_at,
+            last_login=self.last_login))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Restores an account serialized using ``to_bytes`` """
+        return cls._map_user_properties(_record_from_bytes(data))
 
     @property
     def _data_to_insert(self):
@@ -473,9 +1633,15 @@ class User(object):
         """ Returns a dictionary of dirty field names and values """
         store_dict = {}
         for field in self._dirty_fields:
-            store_dict[field[1]] = self.__dict__[field[0]]
+            store_dict[field[1]] = getattr(self, field[0])
         return store_dict
 
+    @property
+    def _index_changes(self):
+        """ Returns a dictionary of modified columns kept in the shard index """
+        return dict([(k, v) for k, v in self._data_to_store.items()
+                     if k in ['username', 'email', 'act_code']])
+
     @property
     def _new_account(self):
         if self._account_id:
@@ -485,6 +1651,31 @@ class User(object):
     @property
     def id(self):
         return self._account_id or None
+
+    def can(self, *permissions):
+        """ Tests whether the user has all of the ``permissions``
+
+        Roles and permissions are managed using the ``perm`` module.
+
+        """
+
+        from authenticationpy import perm
+        return perm.has_permission(self, *permissions)
+
+    def has_role(self, role):
+        """ Tests whether the user has ``role``, directly or inherited """
+        from authenticationpy import perm
+        return perm.has_role(self, role)
+
+    def create_api_key(self, scopes=(), expires_at=None):
+        """ Creates an API key for the account and returns it
+
+        See the ``apikeys`` module for details.
+
+        """
+
+        from authenticationpy import apikeys
+        return apikeys.create_key(self, scopes, expires_at)
        
     @classmethod
     def _validate_username(cls, username):
@@ -494,6 +1685,20 @@ class User(object):
     def _validate_email(cls, email):
         return email_re.match(email)
 
+    def _check_email_domain(self):
+        """ Rejects new or changed e-mail addresses on blocked domains
+
+        Existing accounts keep their addresses even if the domain was blocked
+        later, so the check is not done when accounts are loaded.
+
+        """
+
+        if not self._new_account and \
+           ('email', 'email') not in self._dirty_fields:
+            return
+        if is_blocked_email(self.email):
+            raise ValueError('E-mail domain is not allowed')
+
     @classmethod
     def delete(cls, username=None, email=None, message=None, confirmation=None):
         """ Deletes user account optionally sending an e-mail
@@ -527,15 +1732,9 @@ class User(object):
         delete_dict = {}
 
         if username:
-            if web.ctx.auth_user_cache.get('username') == username:
-                # Reset the chace before we delete the user
-                web.ctx.auth_user_cache = {}
             delete_dict['username'] = username
 
         if email:
-            if web.ctx.auth_user_cache.get('email') == email:
-                # Reset the chace before we delete the user
-                web.ctx.auth_user_cache = {}
             delete_dict['email'] = email
 
         if confirmation is None and message:
@@ -556,7 +1755,22 @@ class User(object):
             user.store()
         
         if not confirmation:
-            db.delete(TABLE, where=web.db.sqlwhere(delete_dict))
+            target, entry = _locate_user(delete_dict)
+            if target is not None:
+                if soft_delete:
+                    _change_accounts(target, 'delete',
+                                     _live(web.db.sqlwhere(delete_dict)),
+                                     deleted_at=datetime.datetime.now())
+                else:
+                    _change_accounts(target, 'delete',
+                                     web.db.sqlwhere(delete_dict))
+            if entry is not None:
+                router.remove(entry.id)
+            _shared_cache_forget(username, email)
+            if username:
+                _identity_map().forget('username', username)
+            if email:
+                _identity_map().forget('email', email)
 
     @classmethod
     def confirm_delete(cls, username=None, email=None):
@@ -602,10 +1816,18 @@ class User(object):
                             username=user.username,
                             email=user.email)
 
-        # Destroy the cache
-        web.ctx.auth_user_cache = {}
+        # Loaded instances would still be active
+        if username:
+            _identity_map().forget('username', username)
+        if email:
+            _identity_map().forget('email', email)
 
-        db.update(TABLE, where=web.db.sqlwhere(suspend_dict), active=False)
+        target, entry = _locate_user(suspend_dict)
+        if target is not None:
+            _change_accounts(target, 'suspend',
+                             _live(web.db.sqlwhere(suspend_dict)),
+                             active=False)
+        _shared_cache_forget(username, email)
 
     @classmethod
     def get_user(cls, username=None, email=None):
@@ -636,24 +1858,46 @@ class User(object):
         if username:
             if not cls._validate_username(username):
                 raise ValueError("'%s' does not look like a valid username" % username)
-            if web.ctx.auth_user_cache.get('username') == username:
-                return web.ctx.auth_user_cache['object']
             select_dict['username'] = username
         if email:
             if not cls._validate_email(email):
                 raise ValueError("'%s' does not look like a valid e-mail" % email)
-            if web.ctx.auth_user_cache.get('email') == email:
-                return web.ctx.auth_user_cache['object']
             select_dict['email'] = email
 
-        records = db.where(TABLE, **select_dict)
+        identity_map = _identity_map()
+        if username:
+            user = identity_map.get('username', username)
+        else:
+            user = identity_map.get('email', email)
+        if user is not None and (not email or user.email == email):
+            return user
+
+        if shared_cache:
+            if username:
+                data = shared_cache.get('u:' + web.utf8(username))
+            else:
+                data = shared_cache.get('e:' + web.utf8(email))
+            if data is not None and data != _TOMBSTONE:
+                record = _record_from_bytes(data)
+                # The cached record may be left over from before a rename
+                if (not username or record.username == username) and \
+                   (not email or record.email == email):
+                    return identity_map.add(cls._map_user_properties(record))
+
+        records = _select_users(**select_dict)
 
         if not records:
             # There is nothing to return
-            web.ctx.auth_user_cache = {}
             return None
 
-        return cls._cache_and_return(records[0])
+        if shared_cache:
+            # Entries of recently changed accounts are held by tombstones, and
+            # are not replaced, since this record may predate the change
+            data = _record_to_bytes(records[0])
+            shared_cache.add('u:' + web.utf8(records[0].username), data)
+            shared_cache.add('e:' + web.utf8(records[0].email), data)
+
+        return identity_map.add(cls._map_user_properties(records[0]))
         
     @classmethod
     def get_user_by_act_code(cls, act_code):
@@ -661,25 +1905,67 @@ class User(object):
         if not re.match(r'^[a-f0-9]{64}$', act_code):
             raise UserAccountError('Action code is not the right format.')
 
-        if web.ctx.auth_user_cache.get('act_code') == act_code:
-            return web.ctx.auth_user_cache['object']
+        identity_map = _identity_map()
+        user = identity_map.get('act_code', act_code)
+        if user is not None:
+            return user
 
-        records = db.where(TABLE, act_code=act_code)
+        records = _select_users(act_code=act_code)
         
         if not records:
             # There is nothing to return
-            web.ctx.auth_user_cache = {}
             return None
 
-        return cls._cache_and_return(records[0])
+        return identity_map.add(cls._map_user_properties(records[0]))
 
     @classmethod
-    def _cache_and_return(cls, record):
-        web.ctx.auth_user_cache['username'] = record.username
-        web.ctx.auth_user_cache['email'] = record.email
-        web.ctx.auth_user_cache['act_code'] = record.act_code
-        web.ctx.auth_user_cache['object'] = cls._map_user_properties(record)
-        return web.ctx.auth_user_cache['object']
+    def get_user_by_api_key(cls, key, scope=None):
+        """ Gets the user account owning a valid API ``key``
+
+        Returns None if the key is invalid, has expired, or doesn't have the
+        ``scope`` (if given), and if the account is not active.
+
+        """
+
+        from authenticationpy import apikeys
+        record = apikeys.verify(key, scope)
+        if record is None:
+            return None
+        users = cls.get_users([record.user_id])
+        if not users or not users[0].active:
+            return None
+        return users[0]
+
+    @classmethod
+    def get_users(cls, ids, batch_size=1000):
+        """ Gets user accounts by a list of ids
+
+        Accounts are returned in the order of ``ids``, and ids that don't
+        belong to an account are skipped. Accounts are selected in batches of
+        ``batch_size`` ids, using a single query per batch and database.
+
+        """
+
+        ids = list(ids)
+        records = {}
+        for start in range(0, len(ids), batch_size):
+            for target in router and router.shards or [db]:
+                for record in target.select(TABLE, where=_live('id IN $ids'),
+                                            vars={'ids': ids[start:start +
+                                                             batch_size]}):
+                    records[record.id] = record
+
+        identity_map = _identity_map()
+        users = []
+        for id in ids:
+            record = records.get(id)
+            if record is None:
+                continue
+            user = identity_map.get('username', record.username)
+            if user is None:
+                user = identity_map.add(cls._map_user_properties(record))
+            users.append(user)
+        return users
 
     @classmethod
     def _map_user_properties(cls, user_account):
@@ -696,7 +1982,10 @@ class User(object):
                 '_act_time': user_account.act_time,
                 '_act_type': user_account.act_type,
                 'registered_at': user_account.registered_at,
+                'last_login': user_account.get('last_login'),
                 'active': user_account.active,
+                '_version': user_account.version,
+                '_shard_key': user_username,
             }
         except AttributeError:
             raise UserAccountError('Missing data for user with id %s)' % user_account.id)
@@ -706,6 +1995,7 @@ class User(object):
 
         for key in user_dict.keys():
             object.__setattr__(user, key, user_dict[key])
+        object.__setattr__(user, '_stats_state', user._stats_key())
 
         return user
 
@@ -713,6 +2003,14 @@ class User(object):
     def exists(cls, username=None, email=None):
         if not username and not email:
             raise TypeError('You must supply username or email argument.')
+        if router:
+            return router.exists(username=username, email=email)
+
+        if _can_prepare(db):
+            return bool(_execute_prepared(('exists',),
+                                          [email or None, username or None],
+                                          db))
+
         where_kws = {}
         if username:
             where_kws['username'] = username
@@ -720,7 +2018,188 @@ class User(object):
             where_kws['email'] = email
 
         where_clause = web.db.sqlwhere(where_kws, grouping=' OR ')
-        if len(db.select(TABLE, what='id', where=where_clause)) > 0:
+        if len(db.select(TABLE, what='id', where=_live(where_clause))) > 0:
             return True
         return False
 
+    @classmethod
+    def search(cls, username=None, email=None, active=None,
+               registered_after=None, registered_before=None, act_type=None,
+               after=None, limit=50):
+        """ Search user accounts for administration purposes
+
+        All arguments are optional, and all of the given criteria must match:
+
+        * ``username``: username prefix
+        * ``email``: e-mail address prefix
+        * ``active``: ``True`` or ``False`` to match (in)active accounts
+        * ``registered_after``, ``registered_before``: registration time range
+        * ``act_type``: type of the pending interaction (``'a'``, ``'d'``, or
+          ``'r'``)
+
+        Results are ordered by id, and at most ``limit`` records are returned.
+        To get the next page, pass the id of the last record as ``after``
+        argument. Unlike ``OFFSET``, this is equally fast on every page.
+
+        Returned records are lightweight (no ``User`` instances are created),
+        and have ``id``, ``username``, ``email``, ``active``,
+        ``registered_at``, and ``act_type`` properties. Use
+        ``create_search_indexes`` to create the indexes that make prefix
+        searches fast.
+
+        """
+
+        def prefix(value):
+            return value.replace('\\', '\\\\').replace('%', '\\%') \
+                        .replace('_', '\\_') + '%'
+
+        clauses = []
+        if after is not None:
+            clauses.append(web.db.reparam('id > $after', {'after': after}))
+        if username:
+            clauses.append(web.db.reparam('username LIKE $username',
+                                          {'username': prefix(username)}))
+        if email:
+            clauses.append(web.db.reparam('email LIKE $email',
+                                          {'email': prefix(email)}))
+        if active is not None:
+            clauses.append(web.db.reparam('active = $active',
+                                          {'active': active}))
+        if registered_after is not None:
+            clauses.append(web.db.reparam('registered_at >= $time',
+                                          {'time': registered_after}))
+        if registered_before is not None:
+            clauses.append(web.db.reparam('registered_at < $time',
+                                          {'time': registered_before}))
+        if act_type is not None:
+            clauses.append(web.db.reparam('act_type = $act_type',
+                                          {'act_type': act_type[:1]}))
+        where = clauses and web.db.SQLQuery.join(clauses, ' AND ') or None
+        where = _live(where)
+
+        records = []
+        for database in (router and router.shards or [db]):
+            records.extend(database.select(TABLE,
+                                           what='id, username, email, active, '
+                                                'registered_at, act_type',
+                                           where=where, order='id',
+                                           limit=limit))
+        records.sort(key=lambda r: r.id)
+        return records[:limit]
+
+    @classmethod
+    def create_search_indexes(cls):
+        """ Creates the indexes used by ``search`` (PostgreSQL only)
+
+        Prefix searches on username and e-mail need indexes with pattern
+        operator classes, unless the database uses the C locale.
+
+        """
+
+        statements = [
+            'CREATE INDEX IF NOT EXISTS authpy_username_prefix ON %s '
+            '(username varchar_pattern_ops)',
+            'CREATE INDEX IF NOT EXISTS authpy_email_prefix ON %s '
+            '(email varchar_pattern_ops)',
+            'CREATE INDEX IF NOT EXISTS authpy_registered_at ON %s '
+            '(registered_at, id)',
+            'CREATE INDEX IF NOT EXISTS authpy_act_type ON %s '
+            '(act_type, id) WHERE act_type IS NOT NULL',
+        ]
+        for database in (router and router.shards or [db]):
+            for statement in statements:
+                database.query(statement % TABLE)
+
+    @classmethod
+    def stats(cls, max_age=60):
+        """ Returns account statistics
+
+        The statistics are computed using a single aggregate query, and the
+        result is cached for ``max_age`` seconds. If
+        ``web.config.authstats_incremental`` is set to ``True``, the cached
+        result is also updated when accounts are created, stored, deleted, or
+        suspended by this process.
+
+        The returned object has the following properties:
+
+        * ``active``: number of active accounts
+        * ``inactive``: number of inactive accounts
+        * ``registrations``: dictionary of registration dates and numbers of
+          accounts registered on that date
+        * ``pending``: dictionary of interaction types (``'a'``, ``'d'``, and
+          ``'r'``) and numbers of accounts with that interaction outstanding
+
+        """
+
+        def snapshot(stats):
+            # Callers must not be able to modify the cached result
+            return web.storage(active=stats.active, inactive=stats.inactive,
+                               registrations=dict(stats.registrations),
+                               pending=dict(stats.pending))
+
+        _stats_lock.acquire()
+        try:
+            stats = _stats_cache['value']
+            if stats is not None and _stats_cache['expires'] > time.time():
+                return snapshot(stats)
+        finally:
+            _stats_lock.release()
+
+        stats = web.storage(active=0, inactive=0, registrations={},
+                            pending={})
+        for database in (router and router.shards or [db]):
+            records = database.query('SELECT CAST(registered_at AS DATE) AS day, '
+                                     'active, act_type, COUNT(*) AS count '
+                                     'FROM %s %s GROUP BY 1, 2, 3' %
+                                     (TABLE, soft_delete and
+                                             'WHERE ' + LIVE_CLAUSE or ''))
+            for record in records:
+                if record.active:
+                    stats.active += record.count
+                else:
+                    stats.inactive += record.count
+                if record.act_type:
+                    stats.pending[record.act_type] = \
+                        stats.pending.get(record.act_type, 0) + record.count
+                stats.registrations[record.day] = \
+                    stats.registrations.get(record.day, 0) + record.count
+
+        _stats_lock.acquire()
+        try:
+            _stats_cache['value'] = stats
+            _stats_cache['expires'] = time.time() + max_age
+        finally:
+            _stats_lock.release()
+        return snapshot(stats)
+
+    @classmethod
+    def taken(cls, username, email):
+        """ Tests whether ``username`` and ``email`` are already in use
+
+        Returns a tuple of two booleans, one for the username and one for the
+        e-mail address. Both are answered by a single query.
+
+        """
+
+        if router:
+            database, table = router.index_db, router.index_table
+        else:
+            database, table = db, TABLE
+
+        if not router and _can_prepare(db):
+            records = _execute_prepared(('taken',), [email, username], db)
+        else:
+            where_clause = web.db.sqlwhere({'username': username,
+                                            'email': email},
+                                           grouping=' OR ')
+            if not router:
+                where_clause = _live(where_clause)
+            records = database.select(table, what='username, email',
+                                      where=where_clause, limit=2)
+
+        username_taken = email_taken = False
+        for record in records:
+            username_taken = username_taken or record.username == username
+            email_taken = email_taken or record.email == email
+        return username_taken, email_taken
+
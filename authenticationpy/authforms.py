@@ -28,15 +28,25 @@ account_reg_msg = web.config.authform.get('account registration error',
                                           'Username or e-mail already belongs to a registered user')
 authentication_msg = web.config.authform.get('authentication error',
                                              'Please check your username or password.')
+blocked_domain_msg = web.config.authform.get('blocked domain error',
+                                             'E-mail addresses on this domain are not accepted')
+breached_msg = web.config.authform.get('breached password error',
+                                       'This password is known to have been leaked')
 
 username_va = form.regexp('[A-Za-z]{1}[A-Za-z0-9.-_]{3,39}', username_msg)
 password_va = form.regexp('^.{%s}.*' % auth.min_pwd_length, password_msg)
+# Only used for new passwords, so that users with breached passwords can still
+# log in and change them
+unbreached_va = form.Validator(breached_msg,
+                               lambda v: not auth.is_breached(v))
 email_va = form.regexp(
     r"(^[-!#$%&'*+/=?^_`{}|~0-9A-Za-z]+(\.[-!#$%&'*+/=?^_`{}|~0-9A-Za-z]+)*"  # dot-atom
     r'|^"([\001-\010\013\014\016-\037!#-\[\]-\177]|\\[\001-011\013\014\016-\177])*"' # quoted-string
     r')@(?:[A-Za-z0-9]+(?:-*[A-Za-z0-9]+)*\.)+[A-Za-z]{2,6}$', # domain
     email_msg
 )
+email_domain_va = form.Validator(blocked_domain_msg,
+                                 lambda v: not auth.is_blocked_email(v))
 confirmation_va = form.Validator(pw_confirm_msg,
                                  lambda i: i.password == i.confirm)
 new_confirmation_va = form.Validator(pw_confirm_msg,
@@ -44,19 +54,30 @@ new_confirmation_va = form.Validator(pw_confirm_msg,
 email_belongs_va = form.Validator(email_request_msg,
                                   lambda i: auth.User.exists(email=i.email))
 account_reg_va = form.Validator(account_reg_msg,
-                                lambda i: not auth.User.exists(username=i.username,
-                                                               email=i.email))
+                                lambda i: not any(auth.User.taken(i.username,
+                                                                  i.email)))
 
-authentication_va = form.Validator(authentication_msg,
-                                   lambda i: auth.User.get_user(i.username).authenticate(i.password))
+def _authenticate(i):
+    user = auth.User.get_user(i.username)
+    if user is None:
+        # Record attempts on nonexistent accounts as well
+        if auth.audit_log:
+            auth.audit_log.record(None, i.username, False)
+        return False
+    return user.authenticate(i.password)
+
+authentication_va = form.Validator(authentication_msg, _authenticate)
 
 username_field = form.Textbox('username', username_va)
 password_field = form.Password('password', password_va)
-new_pw_field = form.Password('new', password_va,
+new_pw_field = form.Password('new', password_va, unbreached_va,
                              descrption='new password')
 pw_confirmation_field = form.Password('confirm', password_va,
                                       description='confirm password')
+reg_password_field = form.Password('password', password_va, unbreached_va)
 email_field = form.Textbox('email', email_va, description='e-mail')
+reg_email_field = form.Textbox('email', email_va, email_domain_va,
+                               description='e-mail')
 
 login_form = form.Form(
     username_field,
@@ -66,10 +87,12 @@ login_form = form.Form(
     ]
 )
 
+# Form validators run in order, and only if all fields are valid, so the
+# ones that query the database come last
 register_form = form.Form(
     username_field,
-    email_field,
-    password_field,
+    reg_email_field,
+    reg_password_field,
     pw_confirmation_field,
     validators = [
         confirmation_va, 
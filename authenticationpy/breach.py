@@ -0,0 +1,166 @@
+""" Blocklist of known breached passwords
+
+The blocklist is a file of sorted, fixed-length SHA-1 prefixes of breached
+passwords. It is memory-mapped and searched using binary search, so checking
+a password reads a few pages of the file, and the pages are shared by all
+processes using the same file. Build the file from a list of SHA-1 hashes
+(e.g., the "ordered by hash" file from haveibeenpwned.com) or plain-text
+passwords::
+
+    python -m authenticationpy.breach pwned-passwords-sha1.txt breached.bin
+
+With the default 8-byte prefixes, a password that is not in the list is
+rejected with a probability of about n / 2 ** 64 for a list of n passwords.
+
+"""
+
+import os
+import mmap
+import heapq
+import binascii
+import struct
+import hashlib
+import optparse
+import tempfile
+
+import web
+
+MAGIC = 'authpybl'
+HEADER = struct.Struct('!8sB7x')
+DEFAULT_PREFIX_LENGTH = 8
+
+
+class Blocklist(object):
+    """ Memory-mapped blocklist read from ``path`` """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+        magic, self.prefix_length = HEADER.unpack(self._map[:HEADER.size])
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not a password blocklist' % path)
+        self._count = (len(self._map) - HEADER.size) // self.prefix_length
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, password):
+        prefix = hashlib.sha1(web.utf8(password)).digest()[:self.prefix_length]
+        size = self.prefix_length
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            start = HEADER.size + middle * size
+            entry = self._map[start:start + size]
+            if entry < prefix:
+                low = middle + 1
+            elif entry > prefix:
+                high = middle
+            else:
+                return True
+        return False
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+def _prefixes(lines, hashed, prefix_length):
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        if hashed:
+            yield binascii.unhexlify(line[:40])[:prefix_length]
+        else:
+            yield hashlib.sha1(line).digest()[:prefix_length]
+
+def _read_chunk(path, size):
+    chunk = open(path, 'rb')
+    try:
+        while True:
+            entry = chunk.read(size)
+            if not entry:
+                break
+            yield entry
+    finally:
+        chunk.close()
+
+def build(source, target, hashed=True, prefix_length=DEFAULT_PREFIX_LENGTH,
+          chunk_size=10000000):
+    """ Builds a blocklist file ``target`` from ``source`` file
+
+    ``source`` has one entry per line, either an SHA-1 hash in hex (optionally
+    followed by anything, such as ``:count``), or a plain-text password if
+    ``hashed`` is False. The entries don't need to be sorted. They are sorted
+    in chunks of ``chunk_size`` entries, so memory use is bounded. Returns the
+    number of entries in the blocklist.
+
+    """
+
+    chunks = []
+    try:
+        lines = open(source, 'rb')
+        try:
+            prefixes = _prefixes(lines, hashed, prefix_length)
+            while True:
+                chunk = []
+                for prefix in prefixes:
+                    chunk.append(prefix)
+                    if len(chunk) >= chunk_size:
+                        break
+                if not chunk:
+                    break
+                chunk.sort()
+                fd, path = tempfile.mkstemp(dir=os.path.dirname(
+                    os.path.abspath(target)))
+                chunks.append(path)
+                os.write(fd, ''.join(chunk))
+                os.close(fd)
+                if len(chunk) < chunk_size:
+                    break
+        finally:
+            lines.close()
+
+        count = 0
+        output = open(target + '.tmp', 'wb')
+        try:
+            output.write(HEADER.pack(MAGIC, prefix_length))
+            previous = None
+            for prefix in heapq.merge(*[_read_chunk(p, prefix_length)
+                                        for p in chunks]):
+                if prefix != previous:
+                    output.write(prefix)
+                    previous = prefix
+                    count += 1
+        finally:
+            output.close()
+        # Replace the file atomically, processes using the old file keep it
+        os.rename(target + '.tmp', target)
+    finally:
+        for path in chunks:
+            os.remove(path)
+    return count
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog SOURCE TARGET [options]')
+    parser.add_option('--plain', action='store_true', default=False,
+                      help='source contains plain-text passwords')
+    parser.add_option('--prefix-length', type='int',
+                      default=DEFAULT_PREFIX_LENGTH,
+                      help='bytes of SHA-1 hash to keep per password')
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('SOURCE and TARGET are required')
+    count = build(args[0], args[1], hashed=not options.plain,
+                  prefix_length=options.prefix_length)
+    print('%s passwords written to %s' % (count, args[1]))
+
+if __name__ == '__main__':
+    main()
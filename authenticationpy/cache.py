@@ -0,0 +1,98 @@
+import time
+import threading
+import sqlite3
+
+
+class SharedCache(object):
+    """ Interface for caches that are shared between worker processes
+
+    Keys are strings and values are byte strings. Implementations are free to
+    forget values at any time.
+
+    """
+
+    def get(self, key):
+        """ Returns the value for ``key``, or None """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """ Stores ``value`` under ``key``
+
+        If ``ttl`` is given, the value expires after ``ttl`` seconds instead
+        of the default expiry time of the cache.
+
+        """
+        raise NotImplementedError
+
+    def add(self, key, value):
+        """ Stores ``value`` under ``key`` unless the key has a value
+
+        Returns True if the value was stored. Implementations should do this
+        atomically (like ``add`` in memcached, or ``SET NX`` in Redis). This
+        default implementation is not atomic.
+
+        """
+
+        if self.get(key) is not None:
+            return False
+        self.set(key, value)
+        return True
+
+    def delete(self, key):
+        """ Removes ``key`` if present """
+        raise NotImplementedError
+
+
+class SqliteCache(SharedCache):
+    """ Shared cache stored in a SQLite file
+
+    All worker processes on the same host that use the same ``path`` share the
+    cached values. Values expire after ``ttl`` seconds.
+
+    """
+
+    def __init__(self, path, ttl=300):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                               '(key TEXT PRIMARY KEY, value BLOB, '
+                               'expires REAL)')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return bytes(row[0])
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self._connection().execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) '
+            'VALUES (?, ?, ?)',
+            (key, sqlite3.Binary(value), time.time() + ttl))
+
+    def add(self, key, value):
+        now = time.time()
+        connection = self._connection()
+        # Expired values don't count, and are replaced in the same statement
+        cursor = connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) '
+            'SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM cache '
+            'WHERE key = ? AND expires >= ?)',
+            (key, sqlite3.Binary(value), now + self.ttl, key, now))
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
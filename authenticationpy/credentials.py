@@ -0,0 +1,101 @@
+""" Cache of recently verified credentials
+
+Clients that use HTTP Basic authentication send the same password with every
+request. Verifying it costs a password hash each time, so successful
+verifications can be remembered for a short time. Entries are keyed by an
+HMAC of the user id, the password, and the stored password hash. The HMAC key
+is random and never leaves the process, so the cache holds no cleartext, and
+its contents are useless outside of the process. Because the stored hash is
+part of the key, entries stop matching as soon as the password is changed.
+
+"""
+
+import os
+import hmac
+import time
+import hashlib
+import threading
+import collections
+
+import web
+
+
+class VerifiedCache(object):
+    """ Bounded cache of successful password verifications
+
+    Entries expire after ``ttl`` seconds. At most ``max_size`` entries are
+    kept, and the least recently used ones are dropped first.
+
+    """
+
+    def __init__(self, ttl=30, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._key = os.urandom(32)
+        self._entries = collections.OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def _digest(self, user_id, password, stored_hash):
+        message = '\0'.join([str(user_id), web.utf8(password),
+                             web.utf8(stored_hash)])
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def check(self, user_id, password, stored_hash):
+        """ Tests whether the credentials were verified recently """
+        digest = self._digest(user_id, password, stored_hash)
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(digest, None)
+            if entry is None:
+                return False
+            if entry[0] <= time.time():
+                self._discard(digest, entry[1])
+                return False
+            # Move to the end, as the most recently used entry
+            self._entries[digest] = entry
+            return True
+        finally:
+            self._lock.release()
+
+    def add(self, user_id, password, stored_hash):
+        """ Remembers successfully verified credentials """
+        digest = self._digest(user_id, password, stored_hash)
+        self._lock.acquire()
+        try:
+            self._entries.pop(digest, None)
+            self._entries[digest] = (time.time() + self.ttl, user_id)
+            self._by_user.setdefault(user_id, set()).add(digest)
+            while len(self._entries) > self.max_size:
+                oldest, entry = self._entries.popitem(last=False)
+                self._discard(oldest, entry[1])
+        finally:
+            self._lock.release()
+
+    def forget(self, user_id):
+        """ Removes all entries for ``user_id`` """
+        self._lock.acquire()
+        try:
+            for digest in self._by_user.pop(user_id, ()):
+                self._entries.pop(digest, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._by_user.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, digest, user_id):
+        self._entries.pop(digest, None)
+        digests = self._by_user.get(user_id)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._by_user[user_id]
@@ -0,0 +1,129 @@
+""" Blocklist of e-mail domains (e.g., disposable e-mail services)
+
+Entries are domain names, one per line in a blocklist file. Empty lines and
+lines starting with ``#`` are ignored. An entry can be:
+
+* ``example.com``: blocks example.com only
+* ``.example.com``: blocks example.com and all of its subdomains
+* a name with ``*`` labels, such as ``*.example.com``: each ``*`` matches
+  exactly one label, so this blocks mail.example.com, but neither example.com
+  nor a.mail.example.com
+
+Entries are compiled into a trie of reversed labels (com, example, ...), so a
+lookup takes time proportional to the number of labels in the domain, however
+many entries there are.
+
+"""
+
+import os
+import time
+import threading
+
+# Trie node keys marking the end of an entry, which can't be labels
+_END = ''
+_SUFFIX = '.'
+
+
+def compile_domains(entries):
+    """ Compiles domain ``entries`` into a trie """
+    root = {}
+    for entry in entries:
+        entry = entry.strip().lower()
+        if not entry or entry.startswith('#'):
+            continue
+        suffix = entry.startswith('.')
+        node = root
+        for label in reversed(entry.strip('.').split('.')):
+            node = node.setdefault(label, {})
+        node[suffix and _SUFFIX or _END] = True
+    return root
+
+def _matches(trie, domain):
+    nodes = [trie]
+    for label in reversed(domain.lower().split('.')):
+        children = []
+        for node in nodes:
+            if _SUFFIX in node:
+                return True
+            for key in (label, '*'):
+                if key in node:
+                    children.append(node[key])
+        if not children:
+            return False
+        nodes = children
+    for node in nodes:
+        if _END in node or _SUFFIX in node:
+            return True
+    return False
+
+
+class DomainBlocklist(object):
+    """ Blocklist of e-mail domains
+
+    The entries are read from the file at ``path``, and/or given as a list of
+    ``domains``. If the file changes, it is reloaded at most
+    ``check_interval`` seconds later, so the list can be updated without
+    restarting the application.
+
+    """
+
+    def __init__(self, path=None, domains=(), check_interval=5):
+        self.path = path
+        self.domains = list(domains)
+        self.check_interval = check_interval
+        self._mtime = None
+        self._next_check = 0
+        self._trie = compile_domains(self.domains)
+        self._lock = threading.Lock()
+        if path:
+            self.reload()
+
+    def reload(self):
+        """ Reloads the blocklist file """
+        self._lock.acquire()
+        try:
+            self._load()
+        finally:
+            self._lock.release()
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        entries = open(self.path, 'rb')
+        try:
+            # Build the new trie before swapping, so lookups are never
+            # done on a partial trie
+            self._trie = compile_domains(self.domains + list(entries))
+        finally:
+            entries.close()
+        self._mtime = mtime
+        self._next_check = time.time() + self.check_interval
+
+    def _check(self):
+        now = time.time()
+        if now < self._next_check:
+            return
+        # Lookups keep using the current entries while another thread is
+        # reloading the file
+        if not self._lock.acquire(False):
+            return
+        try:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            try:
+                if os.stat(self.path).st_mtime != self._mtime:
+                    self._load()
+            except (IOError, OSError):
+                # Keep the old entries while the file is being replaced
+                pass
+        finally:
+            self._lock.release()
+
+    def __contains__(self, domain):
+        if self.path:
+            self._check()
+        return _matches(self._trie, domain)
+
+    def is_blocked(self, email):
+        """ Tests whether the domain of ``email`` address is blocked """
+        return email.rsplit('@', 1)[-1] in self
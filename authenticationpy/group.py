@@ -0,0 +1,268 @@
+""" Groups of users
+
+Each group is kept as a bitmap of user ids, where bit number n is set if the
+user with id n is a member. Bitmaps are Python integers, so union,
+intersection, and difference of groups are single bitwise operations, no
+matter how large the groups are. Bitmaps are stored compressed, and cached in
+memory. Changes made by other processes are picked up within ``cache_ttl``
+seconds.
+
+The following table is used (PostgreSQL syntax)::
+
+    CREATE TABLE authenticationpy_groups (
+      id               SERIAL PRIMARY KEY,
+      name             VARCHAR(40) NOT NULL UNIQUE,
+      members          TEXT NOT NULL
+    );
+
+"""
+
+import time
+import zlib
+import base64
+import binascii
+
+import web
+
+from authenticationpy import auth
+
+GROUPS_TABLE = 'authenticationpy_groups'
+
+db = auth.db
+
+# Number of seconds group bitmaps are cached
+try:
+    cache_ttl = web.config.authgroup_ttl
+except AttributeError:
+    cache_ttl = 60
+
+
+class GroupError(auth.UserError):
+    pass
+
+
+# Number of set bits, and positions of the set bits, of each byte value
+_POPCOUNT = ''.join([chr(bin(n).count('1')) for n in range(256)])
+_BIT_POSITIONS = [tuple([bit for bit in range(8) if n >> bit & 1])
+                  for n in range(256)]
+
+def _bitmap(bits):
+    """ Returns the bitmap of integer ``bits``, least significant byte first """
+    digits = '%x' % bits
+    if len(digits) % 2:
+        digits = '0' + digits
+    data = bytearray(binascii.unhexlify(digits))
+    data.reverse()
+    return data.rstrip('\0')
+
+
+class UserSet(object):
+    """ Set of user ids backed by a bitmap
+
+    Supports ``|``, ``&``, ``-``, and ``^`` with other sets, membership tests
+    with ``in``, ``len``, and iteration over the ids in ascending order.
+
+    The bitmap is a ``bytearray`` where bit n is bit ``n % 8`` of byte
+    ``n // 8``, so a membership test reads a single byte. Set operations
+    convert the bitmaps to integers, which takes linear time, and combine
+    them with a single bitwise operation. Sets are immutable, so the number
+    of members is only counted once.
+
+    """
+
+    def __init__(self, ids=(), bits=0):
+        ids = list(ids)
+        if ids and min(ids) < 0:
+            raise ValueError('User ids cannot be negative')
+        data = bytearray(ids and max(ids) // 8 + 1 or 0)
+        for id in ids:
+            data[id >> 3] |= 1 << (id & 7)
+        if bits:
+            data = _bitmap(self._int(data) | bits)
+        self._data = data
+        self._len = None
+
+    @classmethod
+    def _from_bitmap(cls, data):
+        user_set = cls.__new__(cls)
+        user_set._data = data
+        user_set._len = None
+        return user_set
+
+    @staticmethod
+    def _int(data):
+        return int(binascii.hexlify(data[::-1]) or '0', 16)
+
+    @property
+    def bits(self):
+        """ The bitmap as an integer, where bit n is set for user id n """
+        return self._int(self._data)
+
+    def __contains__(self, id):
+        byte = id >> 3
+        return id >= 0 and byte < len(self._data) and \
+               bool(self._data[byte] >> (id & 7) & 1)
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(self._data.translate(_POPCOUNT))
+        return self._len
+
+    def __nonzero__(self):
+        return bool(self._data)
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        for index, byte in enumerate(self._data):
+            if byte:
+                base = index << 3
+                for bit in _BIT_POSITIONS[byte]:
+                    yield base + bit
+
+    def __or__(self, other):
+        return UserSet._from_bitmap(_bitmap(self.bits | other.bits))
+
+    def __and__(self, other):
+        return UserSet._from_bitmap(_bitmap(self.bits & other.bits))
+
+    def __sub__(self, other):
+        return UserSet._from_bitmap(_bitmap(self.bits & ~other.bits))
+
+    def __xor__(self, other):
+        return UserSet._from_bitmap(_bitmap(self.bits ^ other.bits))
+
+    def __eq__(self, other):
+        return isinstance(other, UserSet) and self._data == other._data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<UserSet of %s users>' % len(self)
+
+    def users(self):
+        """ Returns the ``User`` instances of the members """
+        return auth.User.get_users(self)
+
+    def to_bytes(self):
+        """ Returns the compressed bitmap """
+        # Most significant byte first, as a big-endian integer
+        return zlib.compress(bytes(self._data[::-1] or bytearray(1)))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Creates a set from the bitmap returned by ``to_bytes`` """
+        data = bytearray(zlib.decompress(data))
+        data.reverse()
+        return cls._from_bitmap(data.rstrip('\0'))
+
+
+# Cached sets by group name, as (expiry, set)
+_groups = {}
+
+def _encode(members):
+    return base64.b64encode(members.to_bytes())
+
+def _decode(data):
+    return UserSet.from_bytes(base64.b64decode(data))
+
+def _ids(users):
+    if isinstance(users, UserSet):
+        return users
+    ids = []
+    for user in users:
+        if isinstance(user, auth.User):
+            if user.id is None:
+                raise auth.UserAccountError('Account for %s is not stored' %
+                                            user.username)
+            user = user.id
+        ids.append(user)
+    return UserSet(ids)
+
+def create_group(name, members=()):
+    """ Creates a group with optional ``members`` (users or ids) """
+    members = _ids(members)
+    id = db.insert(GROUPS_TABLE, name=name, members=_encode(members))
+    _groups[name] = (time.time() + cache_ttl, members)
+    return id
+
+def delete_group(name):
+    """ Deletes a group """
+    db.delete(GROUPS_TABLE, where='name = $name', vars={'name': name})
+    _groups.pop(name, None)
+
+def get(name):
+    """ Returns the (cached) members of group ``name`` as ``UserSet`` """
+    cached = _groups.get(name)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    records = db.where(GROUPS_TABLE, what='members', name=name, limit=1)
+    if not records:
+        raise GroupError("Group '%s' does not exist" % name)
+    members = _decode(records[0].members)
+    _groups[name] = (time.time() + cache_ttl, members)
+    return members
+
+def _update(name, change):
+    transaction = db.transaction()
+    try:
+        # The row lock serializes concurrent updates of the same group
+        records = db.query('SELECT members FROM %s WHERE name = $name '
+                           'FOR UPDATE' % GROUPS_TABLE, vars={'name': name})
+        if not records:
+            raise GroupError("Group '%s' does not exist" % name)
+        members = change(_decode(records[0].members))
+        db.update(GROUPS_TABLE, where='name = $name', vars={'name': name},
+                  members=_encode(members))
+    except:
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    _groups[name] = (time.time() + cache_ttl, members)
+    return members
+
+def add_members(name, users):
+    """ Adds ``users`` (users or ids) to group ``name`` """
+    added = _ids(users)
+    return _update(name, lambda members: members | added)
+
+def remove_members(name, users):
+    """ Removes ``users`` (users or ids) from group ``name`` """
+    removed = _ids(users)
+    return _update(name, lambda members: members - removed)
+
+def _select_ids(where, vars):
+    ids = []
+    for target in auth.router and auth.router.shards or [db]:
+        ids.extend([r.id for r in target.select(auth.TABLE, what='id',
+                                                where=auth._live(where),
+                                                vars=vars)])
+    return ids
+
+def matching(where=None, vars=None, within=None, batch_size=1000):
+    """ Returns the set of ids of users matching a ``where`` clause
+
+    If ``within`` (a set, or a list of users or ids) is given, only those
+    users are tested, in batches of ``batch_size`` ids, so the query uses the
+    primary key instead of scanning the whole table. For example,
+    ``group.matching('active', within=group.get('a'))`` are the active members
+    of group ``a``. Only ids are selected, so this is cheap compared to loading
+    the users.
+
+    """
+
+    if within is None:
+        return UserSet(_select_ids(where, vars or {}))
+
+    within = list(_ids(within))
+    if where:
+        where = '(%s) AND id IN $matching_ids' % where
+    else:
+        where = 'id IN $matching_ids'
+    ids = []
+    for start in range(0, len(within), batch_size):
+        batch_vars = dict(vars or {})
+        batch_vars['matching_ids'] = within[start:start + batch_size]
+        ids.extend(_select_ids(where, batch_vars))
+    return UserSet(ids)
@@ -0,0 +1,121 @@
+import time
+import random
+import threading
+import multiprocessing
+
+
+class HashingBusyError(Exception):
+    """ Raised when the hashing executor is saturated
+
+    The operation can be retried later (e.g., by responding with HTTP 503 and
+    a ``Retry-After`` header).
+
+    """
+    pass
+
+
+def _init_worker():
+    # Forked workers inherit the state of the parent's ``random`` module, so
+    # they would all produce the same numbers
+    random.seed()
+
+
+class HashingExecutor(object):
+    """ Runs password hashing in a pool of worker processes
+
+    Hashing is CPU-bound, so running it in separate processes keeps it from
+    holding the GIL in request threads. At most ``max_pending`` hashing jobs
+    may be queued or running at any time. When the limit is reached, new jobs
+    fail immediately with ``HashingBusyError`` instead of piling up. Jobs
+    that don't finish within ``timeout`` seconds fail with
+    ``HashingBusyError`` as well.
+
+    The worker processes are started when the first job is submitted, so
+    creating an executor at import time doesn't fork the importing process.
+
+    Functions passed to the executor must be importable module-level
+    functions.
+
+    """
+
+    def __init__(self, workers=None, max_pending=64, timeout=30):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._metrics = {'submitted': 0, 'completed': 0, 'failed': 0,
+                         'rejected': 0, 'pending': 0, 'total_time': 0.0}
+
+    def run(self, func, *args):
+        """ Runs ``func(*args)`` in a worker process and returns the result """
+        if not self._slots.acquire(False):
+            self._count(rejected=1)
+            raise HashingBusyError('Too many pending hashing jobs')
+
+        start = time.time()
+        self._count(submitted=1, pending=1)
+        try:
+            result = self._get_pool().apply_async(func, args).get(
+                self.timeout)
+        except multiprocessing.TimeoutError:
+            self._count(failed=1)
+            raise HashingBusyError('Hashing job timed out')
+        except Exception:
+            self._count(failed=1)
+            raise
+        finally:
+            self._slots.release()
+            self._count(pending=-1, total_time=time.time() - start)
+        self._count(completed=1)
+        return result
+
+    def metrics(self):
+        """ Returns a dictionary of executor metrics
+
+        The metrics are the numbers of ``submitted``, ``completed``,
+        ``failed``, ``rejected``, and currently ``pending`` jobs, and the
+        ``average_time`` (including queueing) of a job in seconds.
+
+        """
+
+        self._lock.acquire()
+        try:
+            metrics = dict(self._metrics)
+        finally:
+            self._lock.release()
+        done = metrics['completed'] + metrics['failed']
+        metrics['average_time'] = done and metrics.pop('total_time') / done or 0.0
+        metrics.pop('total_time', None)
+        return metrics
+
+    def close(self):
+        """ Stops the worker processes """
+        self._pool_lock.acquire()
+        try:
+            pool, self._pool = self._pool, None
+        finally:
+            self._pool_lock.release()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _get_pool(self):
+        self._pool_lock.acquire()
+        try:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.workers,
+                                                  initializer=_init_worker)
+            return self._pool
+        finally:
+            self._pool_lock.release()
+
+    def _count(self, **deltas):
+        self._lock.acquire()
+        try:
+            for key, delta in deltas.items():
+                self._metrics[key] += delta
+        finally:
+            self._lock.release()
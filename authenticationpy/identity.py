@@ -0,0 +1,62 @@
+class IdentityMap(object):
+    """ Request-scoped map of loaded user accounts
+
+    Accounts are keyed by id, and can also be found by username, e-mail
+    address, and action code. As long as an account is in the map, every
+    lookup returns the same ``User`` instance.
+
+    """
+
+    KEYS = [('username', 'username'), ('email', 'email'),
+            ('act_code', '_act_code')]
+
+    def __init__(self):
+        self._by_id = {}
+        self._keys = {}
+
+    def get(self, key, value):
+        """ Returns the account whose ``key`` property is ``value``, or None
+
+        ``key`` is one of ``'username'``, ``'email'``, or ``'act_code'``.
+
+        """
+
+        user = self._by_id.get(self._keys.get((key, value)))
+        if user is None or getattr(user, dict(self.KEYS)[key]) != value:
+            # The account was modified after it was added
+            return None
+        return user
+
+    def add(self, user):
+        """ Adds ``user`` to the map and returns the mapped instance
+
+        If an account with the same id is already in the map, the instance
+        that is already mapped is returned (and re-indexed), and ``user`` is
+        discarded.
+
+        """
+
+        user = self._by_id.setdefault(user.id, user)
+        for key, attribute in self.KEYS:
+            value = getattr(user, attribute)
+            if value is not None:
+                self._keys[(key, value)] = user.id
+        return user
+
+    def forget(self, key, value):
+        """ Removes the account whose ``key`` property is ``value`` """
+        user = self.get(key, value)
+        if user is not None:
+            self.discard(user)
+
+    def discard(self, user):
+        """ Removes ``user`` from the map """
+        self._by_id.pop(user.id, None)
+        for k, id in list(self._keys.items()):
+            if id == user.id:
+                del self._keys[k]
+
+    def clear(self):
+        """ Removes all accounts from the map """
+        self._by_id.clear()
+        self._keys.clear()
@@ -0,0 +1,332 @@
+""" Concurrent load generator for authentication.py
+
+This module runs a small web.py application wired to the forms in
+``authforms`` against a real database, and drives a mix of registration,
+activation, login, password change, and e-mail password reset flows from a
+pool of threads. At the end, it reports the throughput and the 50th, 95th,
+and 99th percentile latencies for each flow.
+
+The database must contain the tables used by authentication.py. Because the
+load test creates accounts, do *not* run it against a production database.
+Example::
+
+    python -m authenticationpy.loadtest --db authenticationpy_load \\
+        --user postgres --threads 16 --requests 5000 \\
+        --mix register=1,activate=1,login=6,reset=1,forgot=1
+
+"""
+
+import time
+import random
+import threading
+import optparse
+
+import web
+
+DEFAULT_MIX = {'register': 1, 'activate': 1, 'login': 6, 'reset': 1,
+               'forgot': 1}
+
+def make_app():
+    """ Returns a web.py application that exposes the forms
+
+    ``web.config.authdb`` must be configured before calling this function.
+
+    Instead of sending them by e-mail, the application returns the activation
+    and password reset codes in the response, so that the load test can
+    follow them.
+
+    """
+
+    from authenticationpy import user_cache_hook, auth, authforms
+
+    class register:
+        def POST(self):
+            f = authforms.register_form()
+            if not f.validates():
+                raise web.badrequest()
+            user = auth.User(username=f.d.username, email=f.d.email)
+            user.password = f.d.password
+            code = user.set_activation()
+            user.create()
+            return code
+
+    class activate:
+        def GET(self, code):
+            user = auth.User.get_user_by_act_code(code)
+            if user is None:
+                raise web.notfound()
+            user.activate()
+            user.store()
+            return 'activated'
+
+    class login:
+        def POST(self):
+            f = authforms.login_form()
+            if not f.validates():
+                raise web.unauthorized()
+            return 'logged in'
+
+    class reset:
+        def POST(self):
+            f = authforms.pw_reset_form()
+            if not f.validates():
+                raise web.badrequest()
+            user = auth.User.get_user(username=web.input().username)
+            if user is None or not user.authenticate(f.d.password):
+                raise web.unauthorized()
+            user.reset_password(f.d.new)
+            return 'reset'
+
+    class forgot:
+        def POST(self):
+            f = authforms.email_request_form()
+            if not f.validates():
+                raise web.notfound()
+            user = auth.User.get_user(email=f.d.email)
+            code = user.set_reset()
+            user.reset_password(web.input().new, confirmation=True)
+            return code
+
+    class confirm:
+        def GET(self, code):
+            user = auth.User.get_user_by_act_code(code)
+            if user is None or not user.is_interaction_timely('reset', 3600):
+                raise web.notfound()
+            user.confirm_reset()
+            user.store()
+            return 'confirmed'
+
+    urls = ('/register', register,
+            '/activate/([a-f0-9]{64})', activate,
+            '/login', login,
+            '/reset', reset,
+            '/forgot', forgot,
+            '/confirm/([a-f0-9]{64})', confirm)
+    app = web.application(urls, locals())
+    app.add_processor(web.loadhook(user_cache_hook))
+    return app
+
+def percentile(values, percent):
+    """ Returns the ``percent`` percentile of a list of numbers """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+class LoadTest(object):
+    """ Drives a mix of flows against ``app`` from a pool of threads
+
+    ``mix`` is a dictionary of flow names and their relative weights. Flows
+    that need an existing account (activation, login, reset, forgot) fall
+    back to registration until enough accounts exist.
+
+    """
+
+    def __init__(self, app, mix=DEFAULT_MIX, threads=8, requests=1000):
+        self.app = app
+        self.mix = mix
+        self.threads = threads
+        self.requests = requests
+        self.latencies = dict([(flow, []) for flow in mix])
+        self.errors = dict([(flow, 0) for flow in mix])
+        self.duration = None
+        self._lock = threading.Lock()
+        self._counter = 0
+        self._registered = 0
+        self._run_id = '%x' % random.getrandbits(24)
+        self._pending = []
+        self._active = []
+
+    def run(self):
+        """ Runs the load test and returns ``self`` """
+        flows = []
+        for flow, weight in self.mix.items():
+            flows.extend([flow] * weight)
+
+        def worker():
+            while self._next_request():
+                self._run_flow(random.choice(flows))
+
+        threads = [threading.Thread(target=worker) for i in range(self.threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.duration = time.time() - start
+        return self
+
+    def report(self):
+        """ Returns a list of per-flow result dictionaries """
+        results = []
+        for flow in sorted(self.latencies):
+            latencies = self.latencies[flow]
+            results.append({
+                'flow': flow,
+                'requests': len(latencies),
+                'errors': self.errors.get(flow, 0),
+                'throughput': len(latencies) / self.duration,
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+            })
+        return results
+
+    def _next_request(self):
+        self._lock.acquire()
+        try:
+            if self._counter >= self.requests:
+                return False
+            self._counter += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def _take(self, accounts):
+        self._lock.acquire()
+        try:
+            if not accounts:
+                return None
+            return accounts.pop(random.randrange(len(accounts)))
+        finally:
+            self._lock.release()
+
+    def _put(self, accounts, account):
+        self._lock.acquire()
+        try:
+            accounts.append(account)
+        finally:
+            self._lock.release()
+
+    def _run_flow(self, flow):
+        if flow == 'activate':
+            account = self._take(self._pending)
+        elif flow in ['login', 'reset', 'forgot']:
+            account = self._take(self._active)
+        else:
+            account = None
+        if account is None:
+            flow = 'register'
+
+        start = time.time()
+        ok, account = getattr(self, '_' + flow)(account)
+        latency = time.time() - start
+
+        self._lock.acquire()
+        try:
+            self.latencies.setdefault(flow, []).append(latency)
+            if not ok:
+                self.errors[flow] = self.errors.get(flow, 0) + 1
+        finally:
+            self._lock.release()
+
+    def _request(self, path, method='GET', data=None):
+        response = self.app.request(path, method=method, data=data or {})
+        return response.status.startswith('200'), response.data
+
+    def _register(self, account):
+        self._lock.acquire()
+        try:
+            self._registered += 1
+            username = 'load%s%s' % (self._run_id, self._registered)
+        finally:
+            self._lock.release()
+        password = 'pw%s' % random.getrandbits(32)
+        ok, code = self._request('/register', 'POST', {
+            'username': username,
+            'email': '%s@loadtest.example.com' % username,
+            'password': password,
+            'confirm': password,
+        })
+        if ok:
+            self._put(self._pending, (username, password, code))
+        return ok, None
+
+    def _activate(self, account):
+        username, password, code = account
+        ok, data = self._request('/activate/%s' % code)
+        self._put(ok and self._active or self._pending, account)
+        return ok, account
+
+    def _login(self, account):
+        username, password, code = account
+        ok, data = self._request('/login', 'POST', {
+            'username': username,
+            'password': password,
+        })
+        self._put(self._active, account)
+        return ok, account
+
+    def _reset(self, account):
+        username, password, code = account
+        new = 'pw%s' % random.getrandbits(32)
+        ok, data = self._request('/reset', 'POST', {
+            'username': username,
+            'password': password,
+            'new': new,
+            'confirm': new,
+        })
+        if ok:
+            account = (username, new, code)
+        self._put(self._active, account)
+        return ok, account
+
+    def _forgot(self, account):
+        username, password, code = account
+        new = 'pw%s' % random.getrandbits(32)
+        ok, reset_code = self._request('/forgot', 'POST', {
+            'email': '%s@loadtest.example.com' % username,
+            'new': new,
+        })
+        if ok:
+            ok, data = self._request('/confirm/%s' % reset_code)
+            if ok:
+                account = (username, new, code)
+        self._put(self._active, account)
+        return ok, account
+
+def parse_mix(value):
+    """ Parses a ``flow=weight,...`` string into a dictionary """
+    mix = {}
+    for item in value.split(','):
+        flow, weight = item.split('=')
+        mix[flow.strip()] = int(weight)
+    return mix
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog --db NAME [options]')
+    parser.add_option('--dbn', default='postgres', help='database driver')
+    parser.add_option('--db', help='database name')
+    parser.add_option('--user', help='database user')
+    parser.add_option('--pw', help='database password')
+    parser.add_option('--host', help='database host')
+    parser.add_option('--threads', type='int', default=8)
+    parser.add_option('--requests', type='int', default=1000)
+    parser.add_option('--mix',
+                      default='register=1,activate=1,login=6,reset=1,forgot=1',
+                      help='flow weights as flow=weight,...')
+    options, args = parser.parse_args(argv)
+    if not options.db:
+        parser.error('--db is required')
+
+    params = dict([(k, getattr(options, k))
+                   for k in ['dbn', 'db', 'user', 'pw', 'host']
+                   if getattr(options, k)])
+    web.config.authdb = web.database(**params)
+
+    test = LoadTest(make_app(), mix=parse_mix(options.mix),
+                    threads=options.threads, requests=options.requests).run()
+
+    print('%-10s %8s %7s %10s %9s %9s %9s' % ('flow', 'requests', 'errors',
+                                             'req/s', 'p50 ms', 'p95 ms',
+                                             'p99 ms'))
+    for r in test.report():
+        if not r['requests']:
+            continue
+        print('%-10s %8d %7d %10.1f %9.2f %9.2f %9.2f' % (
+            r['flow'], r['requests'], r['errors'], r['throughput'],
+            r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+""" Outbox of account events for downstream systems
+
+When the outbox is enabled, every change to an account (``create``,
+``store``, ``activate``, ``confirm_reset``, ``delete``, and ``suspend``)
+writes an event row in the same transaction as the change itself. Consumers
+read the events in order of their ids, and acknowledge them, so keeping
+another system in sync is a matter of reading the new events instead of
+scanning the users table. Events that all consumers have acknowledged can be
+removed using ``compact``.
+
+Events are written while holding a transaction-level advisory lock, so their
+ids are committed in increasing order, and a consumer never skips an event
+that commits after events with larger ids. To keep the lock short, the
+events of a ``batch`` block are written when the block is committed.
+
+If accounts are sharded, the events are written to the outbox of the shard
+that holds the account, in the transaction opened on that shard. An account
+that moves to another shard gets its event in the new shard, committed with
+the copy of the account. Each shard has its own outbox, so consumers read the
+outbox of every shard.
+
+The following tables are used (PostgreSQL syntax)::
+
+    CREATE TABLE authenticationpy_outbox (
+      id               BIGSERIAL PRIMARY KEY,
+      event            VARCHAR(20) NOT NULL,
+      user_id          INTEGER,
+      username         VARCHAR(40),
+      data             TEXT NOT NULL,
+      at               TIMESTAMP NOT NULL
+    );
+    CREATE TABLE authenticationpy_outbox_offsets (
+      consumer         VARCHAR(40) PRIMARY KEY,
+      last_id          BIGINT NOT NULL
+    );
+
+"""
+
+import json
+import datetime
+
+OUTBOX_TABLE = 'authenticationpy_outbox'
+OFFSETS_TABLE = 'authenticationpy_outbox_offsets'
+
+# Key of the advisory lock that orders event ids
+LOCK_KEY = 0x61757468
+
+def event(name, user_id, username, email, active, fields=()):
+    """ Returns an event row for ``write``
+
+    ``fields`` are the names of the columns that were changed. Column values,
+    and password hashes in particular, are never included.
+
+    """
+
+    return {'event': name,
+            'user_id': user_id,
+            'username': username,
+            'data': json.dumps({'email': email,
+                                'active': bool(active),
+                                'fields': list(fields)}),
+            'at': datetime.datetime.now()}
+
+def write(database, events):
+    """ Writes ``events`` to the outbox
+
+    Must be called in the transaction that makes the changes, right before it
+    is committed, since the lock is held until the end of the transaction.
+
+    """
+
+    if not events:
+        return
+    database.query('SELECT pg_advisory_xact_lock($key)',
+                   vars={'key': LOCK_KEY})
+    database.multiple_insert(OUTBOX_TABLE, events, seqname=False)
+
+def compact(database):
+    """ Removes the events acknowledged by all consumers
+
+    Returns the number of removed events. Nothing is removed while there are
+    no consumers.
+
+    """
+
+    return database.query('DELETE FROM %s WHERE id <= (SELECT MIN(last_id) '
+                          'FROM %s)' % (OUTBOX_TABLE, OFFSETS_TABLE))
+
+
+class Consumer(object):
+    """ Reader of outbox events in ``database`` identified by ``name``
+
+    Each consumer keeps its own position, so several downstream systems can
+    read the same events.
+
+    """
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    def position(self):
+        """ Returns the id of the last acknowledged event """
+        records = self.database.where(OFFSETS_TABLE, what='last_id',
+                                      consumer=self.name, limit=1)
+        if not records:
+            return 0
+        return records[0].last_id
+
+    def read(self, batch_size=100):
+        """ Returns up to ``batch_size`` events after the last acknowledged
+
+        Events are ``web.storage`` objects with ``id``, ``event``,
+        ``user_id``, ``username``, ``at``, and decoded ``data``. Reading
+        doesn't acknowledge the events, so the same events are returned until
+        ``ack`` is called.
+
+        """
+
+        events = []
+        for record in self.database.select(OUTBOX_TABLE,
+                                           where='id > $last_id',
+                                           vars={'last_id': self.position()},
+                                           order='id', limit=batch_size):
+            record.data = json.loads(record.data)
+            events.append(record)
+        return events
+
+    def ack(self, event_id):
+        """ Acknowledges all events up to and including ``event_id`` """
+        # A single upsert, so concurrent first acknowledgements don't both
+        # insert the consumer's row
+        self.database.query('INSERT INTO %s (consumer, last_id) '
+                            'VALUES ($consumer, $last_id) '
+                            'ON CONFLICT (consumer) '
+                            'DO UPDATE SET last_id = EXCLUDED.last_id' %
+                            OFFSETS_TABLE,
+                            vars={'consumer': self.name, 'last_id': event_id})
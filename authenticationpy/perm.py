@@ -0,0 +1,537 @@
+""" Roles and permissions
+
+Users are assigned roles, and roles are granted permissions. Roles can
+include other roles (e.g., admin includes moderator, which includes editor),
+in which case they also have all of the permissions of the included roles.
+The hierarchy is kept in a closure table, which holds a row for each pair of a
+role and a role it includes directly or indirectly (and for each role and
+itself), together with the number of distinct paths between them. Adding or
+removing an inclusion only updates the affected pairs. Each permission
+has a bit number, so the effective permissions of a user compile into a
+single integer bitset, and checking a permission is a single bitwise AND. The
+bitsets of at most ``cache_size`` recently active users are cached by user
+id, and the cache is invalidated whenever roles, permissions, or assignments
+are changed by this process. Changes made by other processes are picked up
+within ``cache_ttl`` seconds.
+
+The following tables are used (PostgreSQL syntax)::
+
+    CREATE TABLE authenticationpy_roles (
+      id               SERIAL PRIMARY KEY,
+      name             VARCHAR(40) NOT NULL UNIQUE
+    );
+    CREATE TABLE authenticationpy_permissions (
+      id               SERIAL PRIMARY KEY,
+      name             VARCHAR(80) NOT NULL UNIQUE,
+      bit              INTEGER NOT NULL UNIQUE
+    );
+    CREATE TABLE authenticationpy_role_permissions (
+      role_id          INTEGER NOT NULL REFERENCES authenticationpy_roles
+                       ON DELETE CASCADE,
+      permission_id    INTEGER NOT NULL REFERENCES authenticationpy_permissions
+                       ON DELETE CASCADE,
+      PRIMARY KEY (role_id, permission_id)
+    );
+    CREATE TABLE authenticationpy_role_edges (
+      parent_id        INTEGER NOT NULL REFERENCES authenticationpy_roles
+                       ON DELETE CASCADE,
+      child_id         INTEGER NOT NULL REFERENCES authenticationpy_roles
+                       ON DELETE CASCADE,
+      PRIMARY KEY (parent_id, child_id)
+    );
+    CREATE TABLE authenticationpy_role_closure (
+      ancestor_id      INTEGER NOT NULL REFERENCES authenticationpy_roles
+                       ON DELETE CASCADE,
+      descendant_id    INTEGER NOT NULL REFERENCES authenticationpy_roles
+                       ON DELETE CASCADE,
+      paths            INTEGER NOT NULL,
+      PRIMARY KEY (ancestor_id, descendant_id)
+    );
+    CREATE INDEX role_closure_descendant_index
+    ON authenticationpy_role_closure (descendant_id);
+    CREATE TABLE authenticationpy_user_roles (
+      user_id          INTEGER NOT NULL,
+      role_id          INTEGER NOT NULL REFERENCES authenticationpy_roles
+                       ON DELETE CASCADE,
+      PRIMARY KEY (user_id, role_id)
+    );
+
+"""
+
+import time
+import threading
+import collections
+
+import web
+
+from authenticationpy import auth
+
+ROLES_TABLE = 'authenticationpy_roles'
+PERMISSIONS_TABLE = 'authenticationpy_permissions'
+ROLE_PERMISSIONS_TABLE = 'authenticationpy_role_permissions'
+EDGES_TABLE = 'authenticationpy_role_edges'
+CLOSURE_TABLE = 'authenticationpy_role_closure'
+USER_ROLES_TABLE = 'authenticationpy_user_roles'
+
+db = auth.db
+
+# Number of seconds compiled permissions are cached, and the maximum number
+# of users whose permissions are cached
+try:
+    cache_ttl = web.config.authperm_ttl
+except AttributeError:
+    cache_ttl = 60
+try:
+    cache_size = web.config.authperm_cache_size
+except AttributeError:
+    cache_size = 10000
+
+
+class RoleError(auth.UserError):
+    pass
+
+
+# Name of the permission that grants an action on owned resources only
+OWN_PERMISSION = '%s.own'
+
+# Name of the permission that grants an action on the resources of the roles
+# that have it
+ROLE_PERMISSION = '%s.role'
+
+# Bit numbers of permissions by name, as (expiry, bit)
+_bits = {}
+
+# Compiled permissions and roles by user id, least recently used first
+_user_cache = collections.OrderedDict()
+
+# Incremented on every change, invalidates all cached permissions
+_generation = [0]
+
+# Incremented on every change to a user, invalidates their cached permissions
+_user_generations = {}
+_lock = threading.Lock()
+
+def _changed(user_id=None):
+    """ Invalidates cached permissions for ``user_id``, or for all users """
+    _lock.acquire()
+    try:
+        if user_id is None:
+            _generation[0] += 1
+            _user_generations.clear()
+            _user_cache.clear()
+            _bits.clear()
+        else:
+            # Bumped rather than just dropping the entry, so that a compile
+            # already in progress doesn't cache the old permissions again
+            _user_generations[user_id] = _user_generations.get(user_id, 0) + 1
+            _user_cache.pop(user_id, None)
+    finally:
+        _lock.release()
+
+def _user_id(user):
+    if isinstance(user, auth.User):
+        if user.id is None:
+            raise RoleError('Account for %s is not stored' % user.username)
+        return user.id
+    return user
+
+def _role_id(role):
+    if isinstance(role, basestring):
+        records = db.where(ROLES_TABLE, what='id', name=role, limit=1)
+        if not records:
+            raise RoleError("Role '%s' does not exist" % role)
+        return records[0].id
+    return role
+
+def _permission_id(permission):
+    records = db.where(PERMISSIONS_TABLE, what='id', name=permission, limit=1)
+    if not records:
+        raise RoleError("Permission '%s' does not exist" % permission)
+    return records[0].id
+
+# Pairs of every ancestor of the parent and every descendant of the child,
+# with the number of paths between them that go through the parent-child edge
+_closure_pairs = ('SELECT a.ancestor_id, d.descendant_id, '
+                  'a.paths * d.paths AS paths FROM %s a, %s d '
+                  'WHERE a.descendant_id = $parent_id '
+                  'AND d.ancestor_id = $child_id' %
+                  (CLOSURE_TABLE, CLOSURE_TABLE))
+
+def create_role(name):
+    """ Creates a role and returns its id """
+    transaction = db.transaction()
+    try:
+        id = db.insert(ROLES_TABLE, name=name)
+        db.insert(CLOSURE_TABLE, seqname=False, ancestor_id=id,
+                  descendant_id=id, paths=1)
+    except:
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    return id
+
+def delete_role(role):
+    """ Deletes a role (by name or id) with all its grants and assignments
+
+    Roles that included the deleted role no longer include the roles that were
+    included through it.
+
+    """
+
+    role_id = _role_id(role)
+    transaction = db.transaction()
+    try:
+        for edge in list(db.select(EDGES_TABLE,
+                                   where='parent_id = $id OR child_id = $id',
+                                   vars={'id': role_id})):
+            _unlink(edge.parent_id, edge.child_id)
+        db.delete(ROLES_TABLE, where='id = $id', vars={'id': role_id})
+    except:
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    _changed()
+
+def includes(parent, child):
+    """ Tests whether ``parent`` role includes ``child``, directly or not """
+    return bool(db.where(CLOSURE_TABLE, what='paths',
+                         ancestor_id=_role_id(parent),
+                         descendant_id=_role_id(child), limit=1))
+
+def add_subrole(parent, child):
+    """ Makes ``parent`` role include ``child`` role (names or ids)
+
+    ``RoleError`` is raised if ``child`` already includes ``parent``, since
+    that would create a cycle.
+
+    """
+
+    parent_id, child_id = _role_id(parent), _role_id(child)
+    if db.where(EDGES_TABLE, parent_id=parent_id, child_id=child_id):
+        return
+    if includes(child_id, parent_id):
+        raise RoleError('Role %s already includes role %s' % (child, parent))
+
+    edge = {'parent_id': parent_id, 'child_id': child_id}
+    transaction = db.transaction()
+    try:
+        db.insert(EDGES_TABLE, seqname=False, **edge)
+        db.query('UPDATE %s SET paths = %s.paths + x.paths FROM (%s) x '
+                 'WHERE %s.ancestor_id = x.ancestor_id '
+                 'AND %s.descendant_id = x.descendant_id' %
+                 (CLOSURE_TABLE, CLOSURE_TABLE, _closure_pairs,
+                  CLOSURE_TABLE, CLOSURE_TABLE), vars=edge)
+        db.query('INSERT INTO %s (ancestor_id, descendant_id, paths) '
+                 'SELECT * FROM (%s) x WHERE NOT EXISTS ('
+                 'SELECT 1 FROM %s c WHERE c.ancestor_id = x.ancestor_id '
+                 'AND c.descendant_id = x.descendant_id)' %
+                 (CLOSURE_TABLE, _closure_pairs, CLOSURE_TABLE), vars=edge)
+    except:
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    _changed()
+
+def _unlink(parent_id, child_id):
+    edge = {'parent_id': parent_id, 'child_id': child_id}
+    db.query('UPDATE %s SET paths = %s.paths - x.paths FROM (%s) x '
+             'WHERE %s.ancestor_id = x.ancestor_id '
+             'AND %s.descendant_id = x.descendant_id' %
+             (CLOSURE_TABLE, CLOSURE_TABLE, _closure_pairs,
+              CLOSURE_TABLE, CLOSURE_TABLE), vars=edge)
+    db.delete(CLOSURE_TABLE, where='paths <= 0')
+    db.delete(EDGES_TABLE, where='parent_id = $parent_id AND '
+              'child_id = $child_id', vars=edge)
+
+def remove_subrole(parent, child):
+    """ Makes ``parent`` role no longer include ``child`` role directly
+
+    ``parent`` still includes ``child`` if it includes another role that
+    includes ``child``.
+
+    """
+
+    parent_id, child_id = _role_id(parent), _role_id(child)
+    if not db.where(EDGES_TABLE, parent_id=parent_id, child_id=child_id):
+        return
+    transaction = db.transaction()
+    try:
+        _unlink(parent_id, child_id)
+    except:
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    _changed()
+
+def create_permission(name):
+    """ Creates a permission, allocating the next free bit, and returns its id """
+    transaction = db.transaction()
+    try:
+        # Concurrent calls would otherwise allocate the same bit
+        db.query('LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE' %
+                 PERMISSIONS_TABLE)
+        record = db.query('SELECT COALESCE(MAX(bit) + 1, 0) AS bit FROM %s' %
+                          PERMISSIONS_TABLE)[0]
+        id = db.insert(PERMISSIONS_TABLE, name=name, bit=record.bit)
+    except:
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    return id
+
+def grant(role, permission):
+    """ Grants ``permission`` (name) to ``role`` (name or id) """
+    db.insert(ROLE_PERMISSIONS_TABLE, seqname=False,
+              role_id=_role_id(role),
+              permission_id=_permission_id(permission))
+    _changed()
+
+def revoke(role, permission):
+    """ Revokes ``permission`` (name) from ``role`` (name or id) """
+    db.delete(ROLE_PERMISSIONS_TABLE,
+              where='role_id = $role_id AND permission_id = $permission_id',
+              vars={'role_id': _role_id(role),
+                    'permission_id': _permission_id(permission)})
+    _changed()
+
+def assign(user, role):
+    """ Assigns ``role`` (name or id) to ``user`` (``User`` or id) """
+    user_id = _user_id(user)
+    db.insert(USER_ROLES_TABLE, seqname=False, user_id=user_id,
+              role_id=_role_id(role))
+    _changed(user_id)
+
+def unassign(user, role):
+    """ Removes ``role`` (name or id) from ``user`` (``User`` or id) """
+    user_id = _user_id(user)
+    db.delete(USER_ROLES_TABLE, where='user_id = $user_id AND role_id = $role_id',
+              vars={'user_id': user_id, 'role_id': _role_id(role)})
+    _changed(user_id)
+
+def roles(user):
+    """ Returns the names of the roles assigned to ``user`` """
+    return [r.name for r in db.query(
+        'SELECT r.name FROM %s r JOIN %s ur ON ur.role_id = r.id '
+        'WHERE ur.user_id = $user_id ORDER BY r.name' %
+        (ROLES_TABLE, USER_ROLES_TABLE), vars={'user_id': _user_id(user)})]
+
+def permission_bit(name):
+    """ Returns the bit number of permission ``name``, or None """
+    cached = _bits.get(name)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    records = db.where(PERMISSIONS_TABLE, what='bit', name=name, limit=1)
+    if not records:
+        _bits.pop(name, None)
+        return None
+    _bits[name] = (time.time() + cache_ttl, records[0].bit)
+    return records[0].bit
+
+def permission_mask(*names):
+    """ Returns a bitset with the bits of all permission ``names`` set
+
+    Unknown permissions are ignored.
+
+    """
+
+    mask = 0
+    for name in names:
+        bit = permission_bit(name)
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+def compile_role_permissions(user_id):
+    """ Returns the roles of ``user_id`` that have each permission
+
+    The result is a dictionary of permission bit numbers and sets of the ids
+    of the roles (assigned to the user, or included by assigned roles) that
+    have the permission, directly or through the roles they include.
+
+    """
+
+    role_ids = {}
+    for record in db.query('SELECT DISTINCT c.descendant_id AS role_id, p.bit '
+                           'FROM %s ur '
+                           'JOIN %s c ON c.ancestor_id = ur.role_id '
+                           'JOIN %s i ON i.ancestor_id = c.descendant_id '
+                           'JOIN %s rp ON rp.role_id = i.descendant_id '
+                           'JOIN %s p ON p.id = rp.permission_id '
+                           'WHERE ur.user_id = $user_id' %
+                           (USER_ROLES_TABLE, CLOSURE_TABLE, CLOSURE_TABLE,
+                            ROLE_PERMISSIONS_TABLE, PERMISSIONS_TABLE),
+                           vars={'user_id': user_id}):
+        role_ids.setdefault(record.bit, set()).add(record.role_id)
+    return dict([(bit, frozenset(ids)) for bit, ids in role_ids.items()])
+
+def compile_roles(user_id):
+    """ Returns the roles ``user_id`` has, directly or not, as a dictionary
+
+    The keys are role ids, and the values are role names.
+
+    """
+
+    return dict([(r.id, r.name) for r in db.query(
+        'SELECT DISTINCT r.id, r.name FROM %s ur '
+        'JOIN %s c ON c.ancestor_id = ur.role_id '
+        'JOIN %s r ON r.id = c.descendant_id '
+        'WHERE ur.user_id = $user_id' %
+        (USER_ROLES_TABLE, CLOSURE_TABLE, ROLES_TABLE),
+        vars={'user_id': user_id})])
+
+def _compiled(user):
+    user_id = _user_id(user)
+    _lock.acquire()
+    try:
+        cached = _user_cache.pop(user_id, None)
+        generation = (_generation[0], _user_generations.get(user_id, 0))
+        if cached is not None:
+            # Move to the end, as the most recently used entry
+            _user_cache[user_id] = cached
+    finally:
+        _lock.release()
+    if (cached is None or cached.generation != generation or
+        cached.expires <= time.time()):
+        roles = compile_roles(user_id)
+        role_bits = compile_role_permissions(user_id)
+        # The user has every permission that any of their roles has
+        bits = 0
+        for bit in role_bits:
+            bits |= 1 << bit
+        cached = web.storage(generation=generation,
+                             expires=time.time() + cache_ttl,
+                             bits=bits,
+                             role_bits=role_bits,
+                             roles=frozenset(roles.values()))
+        _lock.acquire()
+        try:
+            _user_cache.pop(user_id, None)
+            _user_cache[user_id] = cached
+            while len(_user_cache) > cache_size:
+                _user_cache.popitem(last=False)
+        finally:
+            _lock.release()
+    return cached
+
+def user_permissions(user):
+    """ Returns the (cached) permission bitset of ``user`` (``User`` or id) """
+    return _compiled(user).bits
+
+def user_roles(user):
+    """ Returns the (cached) set of names of all roles ``user`` has
+
+    Unlike ``roles``, this includes the roles included by assigned roles.
+
+    """
+
+    return _compiled(user).roles
+
+def role_ids_for(user, permission):
+    """ Returns the ids of the roles of ``user`` that have ``permission``
+
+    The roles include those included by the assigned roles, and each has the
+    permission either directly or through the roles it includes.
+
+    """
+
+    bit = permission_bit(permission)
+    if bit is None:
+        return frozenset()
+    return _compiled(user).role_bits.get(bit, frozenset())
+
+def has_role(user, role):
+    """ Tests whether ``user`` has ``role`` (name), directly or not """
+    return role in _compiled(user).roles
+
+def has_permission(user, *names):
+    """ Tests whether ``user`` has all of the permissions ``names``
+
+    Unknown permissions are never granted.
+
+    """
+
+    mask = 0
+    for name in names:
+        bit = permission_bit(name)
+        if bit is None:
+            return False
+        mask |= 1 << bit
+    return user_permissions(user) & mask == mask
+
+def _value(resource, field):
+    if isinstance(resource, dict):
+        return resource.get(field)
+    return getattr(resource, field, None)
+
+def filter_allowed(user, action, resources, owner='owner_id', role='role_id'):
+    """ Returns the subset of ``resources`` ``user`` may perform ``action`` on
+
+    ``resources`` can be dictionaries (e.g., database records) or objects. A
+    resource is allowed if any of the following is true:
+
+    * the user has the ``action`` permission (e.g., ``'edit'``)
+    * the user has the ``action + '.own'`` permission (e.g., ``'edit.own'``),
+      and the resource's ``owner`` field is the user's id
+    * the resource's ``role`` field is the id of a role the user has, and
+      that role has the ``action + '.role'`` permission (e.g.,
+      ``'edit.role'``)
+
+    Pass ``None`` as ``owner`` or ``role`` to skip the corresponding test.
+    The user's grants are resolved once (usually from the cache), so the
+    resources are filtered without touching the database.
+
+    """
+
+    if has_permission(user, action):
+        return list(resources)
+    user_id = None
+    if owner and has_permission(user, OWN_PERMISSION % action):
+        user_id = _user_id(user)
+    role_ids = role and role_ids_for(user, ROLE_PERMISSION % action)
+    if user_id is None and not role_ids:
+        return []
+    return [r for r in resources
+            if (user_id is not None and _value(r, owner) == user_id) or
+               (role_ids and _value(r, role) in role_ids)]
+
+def allowed(user, action, resource, owner='owner_id', role='role_id'):
+    """ Tests whether ``user`` may perform ``action`` on ``resource``
+
+    See ``filter_allowed`` for the rules. When checking many resources, use
+    ``filter_allowed`` instead.
+
+    """
+
+    return bool(filter_allowed(user, action, [resource], owner, role))
+
+def access_where(user, action, owner='owner_id', role='role_id'):
+    """ Returns a ``WHERE`` clause matching the rows ``user`` may access
+
+    The rules are the same as in ``filter_allowed``, with ``owner`` and
+    ``role`` being column names (which may be qualified, e.g.,
+    ``'p.owner_id'``). The clause is a ``web.db.SQLQuery`` with bound
+    parameters, and can be passed as the ``where`` argument to ``select``, or
+    combined with other conditions using ``web.db.SQLQuery.join``. Adding
+    indexes on the ``owner`` and ``role`` columns lets the database return
+    just the permitted rows.
+
+    """
+
+    if has_permission(user, action):
+        return web.db.SQLQuery('1 = 1')
+    clauses = []
+    if owner and has_permission(user, OWN_PERMISSION % action):
+        clauses.append(web.db.reparam('%s = $user_id' % owner,
+                                      {'user_id': _user_id(user)}))
+    role_ids = role and role_ids_for(user, ROLE_PERMISSION % action)
+    if role_ids:
+        clauses.append(web.db.reparam('%s IN $role_ids' % role,
+                                      {'role_ids': sorted(role_ids)}))
+    if not clauses:
+        return web.db.SQLQuery('1 = 0')
+    return web.db.SQLQuery.join(clauses, ' OR ', prefix='(', suffix=')')
@@ -0,0 +1,71 @@
+import datetime
+import threading
+
+
+class Purger(object):
+    """ Removes soft-deleted records in the background
+
+    Records in ``table`` whose ``deleted_at`` column is older than ``grace``
+    seconds are deleted from each of the ``databases``, at most
+    ``batch_size`` records per statement, with a pause of ``interval`` seconds
+    between the statements. Small batches keep the deletes and the related
+    index maintenance from competing with regular traffic.
+
+    """
+
+    def __init__(self, databases, table, batch_size=100, interval=1.0,
+                 grace=0):
+        self.databases = databases
+        self.table = table
+        self.batch_size = batch_size
+        self.interval = interval
+        self.grace = grace
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def purge_batch(self, database):
+        """ Deletes one batch of records and returns the number deleted """
+        return database.query(
+            'DELETE FROM %s WHERE id IN (SELECT id FROM %s '
+            'WHERE deleted_at IS NOT NULL AND deleted_at < $before '
+            'ORDER BY deleted_at LIMIT $limit)' % (self.table, self.table),
+            vars={'before': datetime.datetime.now() -
+                            datetime.timedelta(seconds=self.grace),
+                  'limit': self.batch_size})
+
+    def purge(self):
+        """ Deletes all purgeable records and returns the number deleted """
+        purged = 0
+        for database in self.databases:
+            while not self._stopped.is_set():
+                deleted = self.purge_batch(database)
+                purged += deleted
+                if deleted < self.batch_size:
+                    break
+                self._stopped.wait(self.interval)
+        return purged
+
+    def start(self):
+        """ Starts purging in a background thread """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the background thread """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.purge()
+            except Exception:
+                # Try again later, purging is not urgent
+                pass
+            self._stopped.wait(self.interval)
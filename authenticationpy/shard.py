@@ -0,0 +1,162 @@
+import hashlib
+
+import web
+
+INDEX_TABLE = 'authenticationpy_user_index'
+
+def jump_hash(key, buckets):
+    """ Maps ``key`` string to a bucket number in ``range(buckets)``
+
+    This is the jump consistent hash by Lamping and Veach. When the number of
+    buckets grows from n to n + 1, only 1/(n + 1) of the keys change their
+    bucket, which keeps rebalancing cheap.
+
+    """
+
+    key = int(hashlib.md5(key).hexdigest()[:16], 16)
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+class ShardRouter(object):
+    """ Routes user records to one of the ``shards`` databases
+
+    Records are placed on shards by a stable hash of the username, so lookups
+    by username go directly to the right shard. A small global index table
+    (``index_table`` in ``index_db``) maps e-mail addresses and action codes
+    to the username and shard, and guarantees that usernames and e-mail
+    addresses are unique across shards. The index also allocates user ids, so
+    ids are unique across shards as well.
+
+    """
+
+    def __init__(self, index_db, shards, table, index_table=INDEX_TABLE):
+        self.index_db = index_db
+        self.shards = list(shards)
+        self.table = table
+        self.index_table = index_table
+
+    def shard_for(self, username):
+        """ Returns the shard number for ``username`` """
+        return jump_hash(username, len(self.shards))
+
+    def db_for(self, username):
+        """ Returns the shard database for ``username`` """
+        return self.shards[self.shard_for(username)]
+
+    def db_for_id(self, id):
+        """ Returns the shard database for user ``id``, or None """
+        entry = self.lookup(id=id)
+        if entry is None:
+            return None
+        return self.shards[entry.shard]
+
+    def lookup(self, **where):
+        """ Returns the index entry matching all of the ``where`` values """
+        records = self.index_db.where(self.index_table, limit=1, **where)
+        if not records:
+            return None
+        return records[0]
+
+    def exists(self, username=None, email=None):
+        """ Tests whether either ``username`` or ``email`` is taken """
+        where = {}
+        if username:
+            where['username'] = username
+        if email:
+            where['email'] = email
+        where_clause = web.db.sqlwhere(where, grouping=' OR ')
+        return bool(self.index_db.select(self.index_table, what='id',
+                                         where=where_clause, limit=1))
+
+    def register(self, username, email, act_code=None):
+        """ Adds an index entry for a new account and returns its id
+
+        The database's integrity error is raised if either the username or
+        the e-mail address is already taken.
+
+        """
+
+        return self.index_db.insert(self.index_table,
+                                    username=username,
+                                    email=email,
+                                    act_code=act_code,
+                                    shard=self.shard_for(username))
+
+    def update(self, id, **values):
+        """ Updates the index entry for user ``id`` """
+        self.index_db.update(self.index_table, where='id = $id',
+                             vars={'id': id}, **values)
+
+    def remove(self, id):
+        """ Removes the index entry for user ``id`` """
+        self.index_db.delete(self.index_table, where='id = $id',
+                             vars={'id': id})
+
+    def move(self, id, source, target, **index_values):
+        """ Moves the record of user ``id`` from ``source`` to ``target``
+
+        The record is copied to ``target`` first, replacing a copy left there
+        by an interrupted move, then the index entry is updated with
+        ``index_values`` (if any), and the record is removed from ``source``
+        last. A move that failed halfway can therefore simply be repeated.
+
+        """
+
+        records = source.where(self.table, id=id)
+        if not records:
+            return
+        transaction = target.transaction()
+        try:
+            target.delete(self.table, where='id = $id', vars={'id': id})
+            target.insert(self.table, seqname=False, **dict(records[0]))
+        except:
+            transaction.rollback()
+            raise
+        else:
+            transaction.commit()
+        if index_values:
+            self.update(id, **index_values)
+        source.delete(self.table, where='id = $id', vars={'id': id})
+
+    def rebalance(self, shards, batch_size=1000):
+        """ Redistributes records after the list of shards has changed
+
+        ``shards`` is the new list of shard databases. Existing shards must
+        keep their positions in the list, and new shards should be appended to
+        the end, so that only the records that hash to the new shards are
+        moved. Returns the number of records that were moved.
+
+        Lookups by username use the new list of shards only after rebalancing
+        is finished, so this is best done during a maintenance window. If
+        rebalancing is interrupted, it can be run again with the same list.
+
+        """
+
+        shards = list(shards)
+        moved = 0
+        for number, source in enumerate(self.shards):
+            last_id = 0
+            while True:
+                records = list(source.select(self.table,
+                                             what='id, username',
+                                             where='id > $last_id',
+                                             vars={'last_id': last_id},
+                                             order='id',
+                                             limit=batch_size))
+                if not records:
+                    break
+                last_id = records[-1].id
+                for record in records:
+                    target = jump_hash(record.username, len(shards))
+                    if target == number:
+                        continue
+                    self.move(record.id, source, shards[target],
+                              shard=target)
+                    moved += 1
+        self.shards = shards
+        return moved
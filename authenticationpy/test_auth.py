@@ -1,5 +1,9 @@
 import datetime
 import time
+import os
+import smtplib
+import tempfile
+import threading
 
 import web
 from nose.tools import *
@@ -9,8 +13,21 @@ web.config.authdb = database
 web.config.authmail = {'sender': 'admin@mysite.com',
                        'activation_subject': 'MySite.com Activation E-Mail',}
 
-from authenticationpy import user_cache_hook, auth
+from authenticationpy import user_cache_hook, auth, IdentityMap
 from authenticationpy import authforms
+from authenticationpy import audit
+from authenticationpy import loadtest
+from authenticationpy import cache
+from authenticationpy import hashing
+from authenticationpy import purge
+from authenticationpy import trace
+from authenticationpy import perm
+from authenticationpy import group
+from authenticationpy import breach
+from authenticationpy import domains
+from authenticationpy import credentials
+from authenticationpy import apikeys
+from authenticationpy import outbox
 
 invalid_usernames = (
     '12hours', # starts with a number
@@ -41,7 +58,94 @@ def setup_table():
                      act_time         TIMESTAMP,
                      act_type         CHAR(1),
                      registered_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                     active           BOOLEAN DEFAULT 'false' 
+                     active           BOOLEAN DEFAULT 'false',
+                     last_login       TIMESTAMP,
+                     deleted_at       TIMESTAMP,
+                     version          INTEGER NOT NULL DEFAULT 0
+                   );
+                   DROP TABLE IF EXISTS authenticationpy_logins CASCADE;
+                   CREATE TABLE authenticationpy_logins (
+                     id               SERIAL PRIMARY KEY,
+                     user_id          INTEGER,
+                     username         VARCHAR(40),
+                     success          BOOLEAN NOT NULL,
+                     ip               VARCHAR(45),
+                     at               TIMESTAMP NOT NULL
+                   );
+                   DROP TABLE IF EXISTS authenticationpy_user_roles CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_role_permissions CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_role_edges CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_role_closure CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_roles CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_permissions CASCADE;
+                   CREATE TABLE authenticationpy_roles (
+                     id               SERIAL PRIMARY KEY,
+                     name             VARCHAR(40) NOT NULL UNIQUE
+                   );
+                   CREATE TABLE authenticationpy_permissions (
+                     id               SERIAL PRIMARY KEY,
+                     name             VARCHAR(80) NOT NULL UNIQUE,
+                     bit              INTEGER NOT NULL UNIQUE
+                   );
+                   CREATE TABLE authenticationpy_role_permissions (
+                     role_id          INTEGER NOT NULL REFERENCES
+                                      authenticationpy_roles ON DELETE CASCADE,
+                     permission_id    INTEGER NOT NULL REFERENCES
+                                      authenticationpy_permissions
+                                      ON DELETE CASCADE,
+                     PRIMARY KEY (role_id, permission_id)
+                   );
+                   CREATE TABLE authenticationpy_role_edges (
+                     parent_id        INTEGER NOT NULL REFERENCES
+                                      authenticationpy_roles ON DELETE CASCADE,
+                     child_id         INTEGER NOT NULL REFERENCES
+                                      authenticationpy_roles ON DELETE CASCADE,
+                     PRIMARY KEY (parent_id, child_id)
+                   );
+                   CREATE TABLE authenticationpy_role_closure (
+                     ancestor_id      INTEGER NOT NULL REFERENCES
+                                      authenticationpy_roles ON DELETE CASCADE,
+                     descendant_id    INTEGER NOT NULL REFERENCES
+                                      authenticationpy_roles ON DELETE CASCADE,
+                     paths            INTEGER NOT NULL,
+                     PRIMARY KEY (ancestor_id, descendant_id)
+                   );
+                   CREATE TABLE authenticationpy_user_roles (
+                     user_id          INTEGER NOT NULL,
+                     role_id          INTEGER NOT NULL REFERENCES
+                                      authenticationpy_roles ON DELETE CASCADE,
+                     PRIMARY KEY (user_id, role_id)
+                   );
+                   DROP TABLE IF EXISTS authenticationpy_groups CASCADE;
+                   CREATE TABLE authenticationpy_groups (
+                     id               SERIAL PRIMARY KEY,
+                     name             VARCHAR(40) NOT NULL UNIQUE,
+                     members          TEXT NOT NULL
+                   );
+                   DROP TABLE IF EXISTS authenticationpy_api_keys CASCADE;
+                   CREATE TABLE authenticationpy_api_keys (
+                     id               SERIAL PRIMARY KEY,
+                     user_id          INTEGER NOT NULL,
+                     prefix           CHAR(12) NOT NULL UNIQUE,
+                     secret_hash      CHAR(64) NOT NULL,
+                     scopes           VARCHAR(255) NOT NULL DEFAULT '',
+                     created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     expires_at       TIMESTAMP,
+                     last_used        TIMESTAMP
+                   );
+                   DROP TABLE IF EXISTS authenticationpy_outbox CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_outbox_offsets CASCADE;
+                   CREATE TABLE authenticationpy_outbox (
+                     id               BIGSERIAL PRIMARY KEY,
+                     event            VARCHAR(20) NOT NULL,
+                     user_id          INTEGER,
+                     username         VARCHAR(40),
+                     data             TEXT NOT NULL,
+                     at               TIMESTAMP NOT NULL
+                   );
+                   CREATE TABLE authenticationpy_outbox_offsets (
+                     consumer         VARCHAR(40) PRIMARY KEY,
+                     last_id          BIGINT NOT NULL
                    );
                    CREATE UNIQUE INDEX username_index ON authenticationpy_users
                    USING btree (username);
@@ -52,6 +156,17 @@ def setup_table():
 def teardown_table():
     database.query("""
                    DROP TABLE IF EXISTS authenticationpy_users CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_logins CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_user_roles CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_role_permissions CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_role_edges CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_role_closure CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_roles CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_permissions CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_groups CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_api_keys CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_outbox CASCADE;
+                   DROP TABLE IF EXISTS authenticationpy_outbox_offsets CASCADE;
                    """)
 
 def test_username_regexp():
@@ -229,14 +344,50 @@ def test_get_user_with_combined_nonexistent_email():
 def test_get_user_sets_cache():
     user = auth.User(username='myuser', email='valid@email.com')
     user.create()
+    web.ctx.auth_user_cache = {}
     user = auth.User.get_user(username='myuser')
-    assert web.ctx.auth_user_cache
-    assert web.ctx.auth_user_cache.get('username')
-    assert web.ctx.auth_user_cache.get('email')
-    assert web.ctx.auth_user_cache.get('object')
-    assert web.ctx.auth_user_cache.get('object') is user
-    user = auth.User.get_user(username='myuser')
-    assert web.ctx.auth_user_cache.get('object') is user
+    assert isinstance(web.ctx.auth_user_cache, IdentityMap)
+    assert web.ctx.auth_user_cache.get('username', 'myuser') is user
+    assert web.ctx.auth_user_cache.get('email', 'valid@email.com') is user
+    assert auth.User.get_user(username='myuser') is user
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_identity_map_needs_hook():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    results = []
+    def lookup():
+        # A new thread has no request context, so the hook hasn't run
+        results.append(auth.User.get_user(username='myuser'))
+        results.append(auth.User.get_user(username='myuser'))
+        results.append('auth_user_cache' in web.ctx)
+    thread = threading.Thread(target=lookup)
+    thread.start()
+    thread.join()
+    first, second, cached = results
+    assert first.username == second.username == 'myuser'
+    assert first is not second
+    assert not cached
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_identity_map_keeps_several_users():
+    for name in ['userone', 'usertwo']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.set_activation()
+        user.create()
+    web.ctx.auth_user_cache = {}
+    first = auth.User.get_user(username='userone')
+    second = auth.User.get_user(username='usertwo')
+    assert auth.User.get_user(username='userone') is first
+    assert auth.User.get_user(email='userone@email.com') is first
+    assert auth.User.get_user_by_act_code(second._act_code) is second
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_created_user_is_mapped():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    assert auth.User.get_user(email='valid@email.com') is user
+    assert user._dirty_fields == []
 
 @with_setup(setup=setup_table, teardown=teardown_table)
 def test_existing_user_has_no_new_account_flag():
@@ -783,3 +934,1305 @@ def test_email_belongs_to_account_validation():
     assert not email_form.validates(web.storify({
         'email': 'some@other.com',
     }))
+
+def record_sendmail(outbox):
+    def sendmail(from_address, to_address, subject, message, **kwargs):
+        outbox.append((to_address, subject, message))
+    return sendmail
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_broadcast_email_to_filtered_users():
+    for name in ['userone', 'usertwo', 'userthree']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create(activated=(name == 'usertwo'))
+    outbox = []
+    sendmail = web.utils.sendmail
+    web.utils.sendmail = record_sendmail(outbox)
+    try:
+        sent = auth.User.broadcast_email(message='Hi, $username',
+                                         subject='Reminder',
+                                         filters={'active': False},
+                                         batch_size=1)
+    finally:
+        web.utils.sendmail = sendmail
+    assert sent == 2
+    assert sorted(outbox) == [('userone@email.com', 'Reminder', 'Hi, userone'),
+                              ('userthree@email.com', 'Reminder', 'Hi, userthree')]
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_broadcast_email_resumes_after_progress():
+    for name in ['userone', 'usertwo', 'userthree']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create()
+    checkpoints = []
+    outbox = []
+    sendmail = web.utils.sendmail
+    web.utils.sendmail = record_sendmail(outbox)
+    try:
+        auth.User.broadcast_email(message='Hi', subject='Reminder',
+                                  batch_size=2,
+                                  progress=lambda i, n: checkpoints.append(i))
+        assert checkpoints == [2, 3]
+        outbox[:] = []
+        sent = auth.User.broadcast_email(message='Hi', subject='Reminder',
+                                         start_after=checkpoints[0])
+    finally:
+        web.utils.sendmail = sendmail
+    assert sent == 1
+    assert outbox[0][0] == 'userthree@email.com'
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_broadcast_email_skips_failed_deliveries():
+    for name in ['userone', 'usertwo', 'userthree']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create()
+    outbox = []
+    failed = []
+    def sendmail(from_address, to_address, subject, message):
+        if to_address == 'usertwo@email.com':
+            raise smtplib.SMTPRecipientsRefused({to_address: (550, 'No')})
+        outbox.append(to_address)
+    original = web.utils.sendmail
+    web.utils.sendmail = sendmail
+    try:
+        sent = auth.User.broadcast_email(message='Hi', subject='Reminder',
+                                         workers=1, on_failure=failed.append)
+    finally:
+        web.utils.sendmail = original
+    assert sent == 2
+    assert failed == ['usertwo@email.com']
+    assert sorted(outbox) == ['userone@email.com', 'userthree@email.com']
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_batch_defers_store():
+    for name in ['userone', 'usertwo']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create()
+    with auth.batch():
+        for name in ['userone', 'usertwo']:
+            user = auth.User.get_user(username=name)
+            user.activate()
+            user.store()
+        assert not database.select('authenticationpy_users',
+                                   where='active = true')
+    assert len(database.select('authenticationpy_users',
+                               where='active = true')) == 2
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_batch_updates_different_values_of_same_columns():
+    for name in ['userone', 'usertwo']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create()
+    with auth.batch():
+        for name in ['userone', 'usertwo']:
+            user = auth.User.get_user(username=name)
+            user.email = '%s@example.com' % name
+            user.set_reset()
+            user.store()
+    records = database.select('authenticationpy_users', order='username')
+    assert [r.email for r in records] == ['userone@example.com',
+                                          'usertwo@example.com']
+    assert [r.act_type for r in records] == ['r', 'r']
+    assert [r.version for r in records] == [1, 1]
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+@raises(auth.StaleUserError)
+def test_batch_checks_version_of_each_account():
+    for name in ['userone', 'usertwo']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create()
+    users = [auth.User.get_user(username=n) for n in ['userone', 'usertwo']]
+    database.update('authenticationpy_users', where="username = 'usertwo'",
+                    version=5)
+    with auth.batch():
+        for user in users:
+            user.activate()
+            user.store()
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_batch_rolls_back_on_error():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    try:
+        with auth.batch():
+            user = auth.User.get_user(username='myuser')
+            user.activate()
+            user.store()
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert not database.select('authenticationpy_users',
+                               where='active = true')
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_batch_failed_commit_restores_accounts():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    user = auth.User.get_user(username='myuser')
+    def failing_commit():
+        auth._unit_of_work.transactions.rollback()
+        raise RuntimeError()
+    try:
+        with auth.batch():
+            auth._unit_of_work.transactions.commit = failing_commit
+            user.activate()
+            user.store()
+            new_user = auth.User(username='newuser', email='new@email.com')
+            new_user.create()
+    except RuntimeError:
+        pass
+    assert user._version == 0
+    assert user._dirty_fields
+    assert new_user.id is None
+    assert new_user._dirty_fields
+    assert auth._identity_map().get('username', 'newuser') is None
+    assert not database.select('authenticationpy_users',
+                               where="active = true OR username = 'newuser'")
+    # Both accounts can be stored again
+    user.store()
+    new_user.create()
+    assert auth.User.get_user(username='myuser').active
+    assert auth.User.exists(username='newuser')
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_store_increments_version():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    user = auth.User.get_user(username='myuser')
+    assert user._version == 0
+    user.activate()
+    user.store()
+    assert user._version == 1
+    record = database.select('authenticationpy_users', what='version')[0]
+    assert record.version == 1
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+@raises(auth.StaleUserError)
+def test_store_stale_user():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    first = auth.User.get_user(username='myuser')
+    web.ctx.auth_user_cache = {}
+    second = auth.User.get_user(username='myuser')
+    first.activate()
+    first.store()
+    second.email = 'other@email.com'
+    second.store()
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+@raises(auth.StaleUserError)
+def test_store_stale_user_after_suspend():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create(activated=True)
+    stale = auth.User.get_user(username='myuser')
+    auth.User.suspend(username='myuser')
+    record = database.select('authenticationpy_users', what='version')[0]
+    assert record.version == 1
+    stale.activate()
+    stale.store()
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_lookup_uses_prepared_statement():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    web.ctx.auth_user_cache = {}
+    user = auth.User.get_user(username='myuser')
+    assert user.email == 'valid@email.com'
+    assert 'authpy_by_username' in auth._prepared_names(database.ctx.db)
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_prepared_statements_found_on_reused_connection():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    web.ctx.auth_user_cache = {}
+    auth.User.get_user(username='myuser')
+    # Like a pooled connection handed to a new context
+    auth._prepared.clear()
+    web.ctx.auth_user_cache = {}
+    assert auth.User.get_user(username='myuser').email == 'valid@email.com'
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_prepared_statement_prepared_again_when_missing():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    web.ctx.auth_user_cache = {}
+    auth.User.get_user(username='myuser')
+    database.query('DEALLOCATE authpy_by_username')
+    web.ctx.auth_user_cache = {}
+    assert auth.User.get_user(username='myuser').email == 'valid@email.com'
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_prepared_statement_survives_added_column():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    web.ctx.auth_user_cache = {}
+    auth.User.get_user(username='myuser')
+    database.query('ALTER TABLE authenticationpy_users ADD COLUMN extra TEXT')
+    web.ctx.auth_user_cache = {}
+    assert auth.User.get_user(username='myuser').email == 'valid@email.com'
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_lookup_without_prepared_statements():
+    auth.prepare_queries = False
+    try:
+        user = auth.User(username='myuser', email='valid@email.com')
+        user.create()
+        web.ctx.auth_user_cache = {}
+        assert auth.User.get_user(email='valid@email.com').username == 'myuser'
+        assert auth.User.exists(username='myuser')
+    finally:
+        auth.prepare_queries = True
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_lookup_without_last_login_column():
+    database.query('ALTER TABLE authenticationpy_users DROP COLUMN last_login')
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    try:
+        for prepare in [True, False]:
+            auth.prepare_queries = prepare
+            web.ctx.auth_user_cache = {}
+            user = auth.User.get_user(username='myuser')
+            assert user.username == 'myuser'
+            assert user.last_login is None
+    finally:
+        auth.prepare_queries = True
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_audit_log_buffers_events():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create(activated=True)
+    log = audit.AuditLog(database, 'authenticationpy_users', flush_size=10)
+    log.record(user.id, user.username, True, ip='127.0.0.1')
+    log.record(user.id, user.username, False, ip='127.0.0.1')
+    log.record(None, 'nouser', False, ip='127.0.0.1')
+    assert not database.select('authenticationpy_logins')
+    log.flush()
+    assert len(database.select('authenticationpy_logins')) == 3
+    record = database.select('authenticationpy_users', what='last_login')[0]
+    assert record.last_login
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_audit_log_skips_unrouted_accounts():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create(activated=True)
+    routes = {user.id: database}
+    log = audit.AuditLog(database, 'authenticationpy_users', flush_size=10,
+                         route=routes.get)
+    log.record(user.id, user.username, True, ip='127.0.0.1')
+    log.record(user.id + 1, 'deleteduser', True, ip='127.0.0.1')
+    log.flush()
+    assert len(database.select('authenticationpy_logins')) == 2
+    record = database.select('authenticationpy_users', what='last_login')[0]
+    assert record.last_login
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_audit_log_flushes_when_full():
+    log = audit.AuditLog(database, 'authenticationpy_users', flush_size=2)
+    log.record(None, 'nouser', False, ip='127.0.0.1')
+    log.record(None, 'nouser', False, ip='127.0.0.1')
+    assert len(database.select('authenticationpy_logins')) == 2
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_audit_log_keeps_events_of_failed_flush():
+    log = audit.AuditLog(database, 'authenticationpy_users',
+                         table='authenticationpy_missing', flush_size=2)
+    log.record(None, 'nouser', False, ip='127.0.0.1')
+    log.record(None, 'nouser', False, ip='127.0.0.1')
+    log.table = 'authenticationpy_logins'
+    log.flush()
+    assert len(database.select('authenticationpy_logins')) == 2
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_audit_log_timer_flushes_full_buffer():
+    log = audit.AuditLog(database, 'authenticationpy_users', flush_size=2,
+                         flush_interval=60)
+    log.start()
+    try:
+        log.record(None, 'nouser', False, ip='127.0.0.1')
+        log.record(None, 'nouser', False, ip='127.0.0.1')
+    finally:
+        log.stop()
+    assert len(database.select('authenticationpy_logins')) == 2
+
+def test_loadtest_percentile():
+    values = range(1, 101)
+    assert loadtest.percentile(values, 50) == 51
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([], 50) is None
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_loadtest_runs_flows():
+    test = loadtest.LoadTest(loadtest.make_app(), threads=2, requests=20).run()
+    report = dict([(r['flow'], r) for r in test.report()])
+    assert sum([r['requests'] for r in report.values()]) == 20
+    assert report['register']['requests'] > 0
+    assert report['register']['errors'] == 0
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_loadtest_forgot_flow():
+    test = loadtest.LoadTest(loadtest.make_app())
+    assert test._register(None)[0]
+    assert test._activate(test._take(test._pending))[0]
+    account = test._take(test._active)
+    ok, new_account = test._forgot(account)
+    assert ok
+    assert new_account[1] != account[1]
+    assert test._login(test._take(test._active))[0]
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_user_taken():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    assert auth.User.taken('myuser', 'valid@email.com') == (True, True)
+    assert auth.User.taken('myuser', 'other@email.com') == (True, False)
+    assert auth.User.taken('otheruser', 'valid@email.com') == (False, True)
+    assert auth.User.taken('otheruser', 'other@email.com') == (False, False)
+
+def test_register_form_checks_database_last():
+    calls = []
+    taken = auth.User.__dict__['taken']
+    auth.User.taken = classmethod(lambda cls, username, email:
+                                  calls.append(username) or (False, False))
+    try:
+        reg_form = authforms.register_form()
+        assert not reg_form.validates(web.storify({
+            'username': '12hours',
+            'email': 'valid@email.com',
+            'password': 'abc123',
+            'confirm': 'abc123',
+        }))
+        assert not reg_form.validates(web.storify({
+            'username': 'myuser',
+            'email': 'valid@email.com',
+            'password': 'abc123',
+            'confirm': 'abc124',
+        }))
+        assert calls == []
+        assert reg_form.validates(web.storify({
+            'username': 'myuser',
+            'email': 'valid@email.com',
+            'password': 'abc123',
+            'confirm': 'abc123',
+        }))
+        assert calls == ['myuser']
+    finally:
+        auth.User.taken = taken
+
+def test_user_bytes_roundtrip():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.password = 'abc123'
+    user.set_activation()
+    same_user = auth.User.from_bytes(user.to_bytes())
+    assert same_user.username == 'myuser'
+    assert same_user.email == 'valid@email.com'
+    assert same_user.password == user.password
+    assert same_user._act_code == user._act_code
+    assert same_user._act_time == user._act_time
+    assert same_user.registered_at is None
+    assert same_user._new_account
+
+@raises(ValueError)
+def test_user_from_bytes_wrong_version():
+    data = auth.User(username='myuser', email='valid@email.com').to_bytes()
+    auth.User.from_bytes(chr(99) + data[1:])
+
+def test_sqlite_cache():
+    path = tempfile.mktemp()
+    try:
+        shared = cache.SqliteCache(path, ttl=10)
+        assert shared.get('key') is None
+        shared.set('key', 'value')
+        assert shared.get('key') == 'value'
+        assert not shared.add('key', 'other')
+        shared.delete('key')
+        assert shared.get('key') is None
+        assert shared.add('key', 'other')
+        assert shared.get('key') == 'other'
+    finally:
+        os.remove(path)
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_shared_cache_keeps_stale_record_out():
+    path = tempfile.mktemp()
+    auth.shared_cache = cache.SqliteCache(path)
+    try:
+        user = auth.User(username='myuser', email='valid@email.com')
+        user.create()
+        stale = auth._select_users(username='myuser')
+        user.activate()
+        user.store()
+        # A lookup that read the record before the change finishes now
+        data = auth._record_to_bytes(stale[0])
+        assert not auth.shared_cache.add('u:myuser', data)
+        web.ctx.auth_user_cache = {}
+        assert auth.User.get_user(username='myuser').active
+    finally:
+        auth.shared_cache = None
+        os.remove(path)
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_get_user_uses_shared_cache():
+    path = tempfile.mktemp()
+    auth.shared_cache = cache.SqliteCache(path)
+    try:
+        user = auth.User(username='myuser', email='valid@email.com')
+        user.create()
+        web.ctx.auth_user_cache = {}
+        auth.User.get_user(username='myuser')
+        database.update('authenticationpy_users', where='1 = 1',
+                        password='x')
+        web.ctx.auth_user_cache = {}
+        user = auth.User.get_user(email='valid@email.com')
+        assert user.password != 'x'
+        user.activate()
+        user.store()
+        web.ctx.auth_user_cache = {}
+        user = auth.User.get_user(username='myuser')
+        assert user.password.strip() == 'x'
+    finally:
+        auth.shared_cache = None
+        os.remove(path)
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_search_by_prefix():
+    for name in ['alpha', 'alphonse', 'bravo']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create(activated=(name == 'alphonse'))
+    records = auth.User.search(username='alph')
+    assert [r.username for r in records] == ['alpha', 'alphonse']
+    records = auth.User.search(username='alph', active=True)
+    assert [r.username for r in records] == ['alphonse']
+    records = auth.User.search(email='bra')
+    assert [r.username for r in records] == ['bravo']
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_search_keyset_pages():
+    for name in ['alpha', 'alphonse', 'bravo']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create()
+    auth.User.create_search_indexes()
+    page = auth.User.search(limit=2)
+    assert [r.username for r in page] == ['alpha', 'alphonse']
+    page = auth.User.search(limit=2, after=page[-1].id)
+    assert [r.username for r in page] == ['bravo']
+
+def reset_stats():
+    auth._stats_cache['value'] = None
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_stats():
+    reset_stats()
+    for name in ['userone', 'usertwo', 'userthree']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        if name == 'userthree':
+            user.set_activation()
+        user.create(activated=(name == 'userone'))
+    stats = auth.User.stats()
+    assert stats.active == 1
+    assert stats.inactive == 2
+    assert stats.pending == {'a': 1}
+    assert stats.registrations == {datetime.date.today(): 3}
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_stats_incremental():
+    reset_stats()
+    auth.incremental_stats = True
+    try:
+        user = auth.User(username='myuser', email='valid@email.com')
+        user.create()
+        assert auth.User.stats(max_age=3600).inactive == 1
+        user = auth.User(username='otheruser', email='other@email.com')
+        user.create(activated=True)
+        auth.User.suspend(username='otheruser')
+        stats = auth.User.stats(max_age=3600)
+        assert stats.inactive == 2
+        assert stats.active == 0
+        auth.User.delete(username='myuser')
+        assert auth.User.stats(max_age=3600).inactive == 1
+    finally:
+        auth.incremental_stats = False
+        reset_stats()
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_stats_incremental_waits_for_commit():
+    reset_stats()
+    auth.incremental_stats = True
+    try:
+        user = auth.User(username='myuser', email='valid@email.com')
+        user.create()
+        assert auth.User.stats(max_age=3600).inactive == 1
+        try:
+            with auth.batch():
+                user.activate()
+                user.store()
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        stats = auth.User.stats(max_age=3600)
+        assert stats.inactive == 1
+        assert stats.active == 0
+        web.ctx.auth_user_cache = {}
+        user = auth.User.get_user(username='myuser')
+        with auth.batch():
+            user.activate()
+            user.store()
+            assert auth.User.stats(max_age=3600).active == 0
+        assert auth.User.stats(max_age=3600).active == 1
+    finally:
+        auth.incremental_stats = False
+        reset_stats()
+
+def test_password_hashing_is_deferred():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.password = 'abc123'
+    user.password = '123abc'
+    assert 'password' not in user.__dict__
+    assert user._unhashed == {'password': '123abc'}
+    assert len(user.password) == 81
+    assert user._unhashed == {}
+
+def test_hashing_executor():
+    executor = hashing.HashingExecutor(workers=1, max_pending=2)
+    try:
+        assert executor.run(auth._password_hexdigest, 'myuser', 'salt',
+                            'abc123') == \
+            auth._password_hexdigest('myuser', 'salt', 'abc123')
+        metrics = executor.metrics()
+        assert metrics['completed'] == 1
+        assert metrics['pending'] == 0
+    finally:
+        executor.close()
+
+def test_hashing_executor_salts_differ_between_workers():
+    executor = hashing.HashingExecutor(workers=2)
+    try:
+        assert executor._pool is None
+        hashes = set([executor.run(auth._encrypt_password, 'myuser', 'abc123')
+                      for i in range(8)])
+        assert len(set([h.split('$')[0] for h in hashes])) == 8
+    finally:
+        executor.close()
+
+@raises(hashing.HashingBusyError)
+def test_hashing_executor_times_out():
+    executor = hashing.HashingExecutor(workers=1, timeout=0.1)
+    try:
+        executor.run(time.sleep, 1)
+    finally:
+        assert executor.metrics()['failed'] == 1
+        executor.close()
+
+@raises(hashing.HashingBusyError)
+def test_hashing_executor_rejects_when_saturated():
+    executor = hashing.HashingExecutor(workers=1, max_pending=0)
+    try:
+        executor.run(auth._password_hexdigest, 'myuser', 'salt', 'abc123')
+    finally:
+        assert executor.metrics()['rejected'] == 1
+        executor.close()
+
+def enable_soft_delete():
+    setup_table()
+    auth.soft_delete = True
+
+def disable_soft_delete():
+    auth.soft_delete = False
+    teardown_table()
+
+@with_setup(setup=enable_soft_delete, teardown=disable_soft_delete)
+def test_soft_delete_hides_account():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    auth.User.delete(username='myuser')
+    assert not auth.User.get_user(username='myuser')
+    assert not auth.User.exists(email='valid@email.com')
+    assert len(database.select('authenticationpy_users')) == 1
+
+@with_setup(setup=enable_soft_delete, teardown=disable_soft_delete)
+@raises(auth.StaleUserError)
+def test_store_stale_user_after_soft_delete():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create(activated=True)
+    stale = auth.User.get_user(username='myuser')
+    auth.User.delete(username='myuser')
+    stale.email = 'other@email.com'
+    stale.store()
+
+@with_setup(setup=enable_soft_delete, teardown=disable_soft_delete)
+def test_soft_deleted_username_can_be_reused():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    auth.User.delete(username='myuser')
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    web.ctx.auth_user_cache = {}
+    assert auth.User.get_user(username='myuser').id == user.id
+    assert len(database.select('authenticationpy_users')) == 1
+
+@with_setup(setup=enable_soft_delete, teardown=disable_soft_delete)
+def test_rename_to_soft_deleted_username():
+    user = auth.User(username='olduser', email='old@email.com')
+    user.create()
+    auth.User.delete(username='olduser')
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    user.username = 'olduser'
+    user.email = 'old@email.com'
+    user.store()
+    records = database.select('authenticationpy_users')
+    assert [(r.username, r.email) for r in records] == [('olduser',
+                                                         'old@email.com')]
+
+@with_setup(setup=enable_soft_delete, teardown=disable_soft_delete)
+def test_batch_rename_to_soft_deleted_username():
+    user = auth.User(username='olduser', email='old@email.com')
+    user.create()
+    auth.User.delete(username='olduser')
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    with auth.batch():
+        user.username = 'olduser'
+        user.store()
+    records = database.select('authenticationpy_users')
+    assert [r.username for r in records] == ['olduser']
+
+@with_setup(setup=enable_soft_delete, teardown=disable_soft_delete)
+def test_purger_removes_soft_deleted_accounts():
+    for name in ['userone', 'usertwo', 'userthree']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create()
+        auth.User.delete(username=name)
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    purger = purge.Purger([database], 'authenticationpy_users',
+                          batch_size=2, interval=0)
+    assert purger.purge() == 3
+    records = database.select('authenticationpy_users')
+    assert [r.username for r in records] == ['myuser']
+
+def test_query_trace_flags_repeated_queries():
+    query_trace = trace.QueryTrace()
+    query_trace.record('SELECT * FROM t WHERE username = %s', ['a'], 0.001)
+    query_trace.record('SELECT * FROM t WHERE username = %s', ['b'], 0.001)
+    query_trace.record('SELECT * FROM t WHERE id IN (%s, %s)', [1, 2], 0.001)
+    query_trace.record('SELECT * FROM t WHERE id IN (%s)', [1], 0.001)
+    query_trace.record('SELECT * FROM t WHERE id IN (%s)', [1], 0.001)
+    repeated = query_trace.repeated()
+    assert [(r.count, r.identical) for r in repeated] == [(2, False),
+                                                          (3, True)]
+    assert query_trace.summary().startswith('5 queries')
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_query_trace_records_auth_queries():
+    for name in ['userone', 'usertwo']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create()
+    web.ctx.auth_user_cache = {}
+    trace.install(database)
+    trace.install(database)
+    web.ctx.auth_query_trace = trace.QueryTrace()
+    try:
+        for name in ['userone', 'usertwo']:
+            auth.User.get_user(username=name)
+        database.select('authenticationpy_users')
+        query_trace = web.ctx.auth_query_trace
+    finally:
+        web.ctx.auth_query_trace = None
+        trace.uninstall(database)
+    assert len(query_trace.queries) == 2
+    assert query_trace.repeated()[0].count == 2
+    assert 'test_auth.py' in query_trace.queries[0].site
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_user_can():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    perm.create_role('editor')
+    perm.create_permission('edit')
+    perm.create_permission('publish')
+    perm.grant('editor', 'edit')
+    assert not user.can('edit')
+    perm.assign(user, 'editor')
+    assert user.can('edit')
+    assert not user.can('publish')
+    assert not user.can('edit', 'publish')
+    assert not user.can('nonexistent')
+    assert perm.roles(user) == ['editor']
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_permission_bits_are_cached():
+    perm.create_role('editor')
+    perm.create_permission('edit')
+    perm.grant('editor', 'edit')
+    perm.assign(1, 'editor')
+    assert perm.user_permissions(1) == 1 << perm.permission_bit('edit')
+    # Changes made behind perm's back are not seen until the cache expires
+    database.delete(perm.USER_ROLES_TABLE, where='user_id = 1')
+    assert perm.user_permissions(1) == 1 << perm.permission_bit('edit')
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_permission_cache_is_bounded():
+    perm.create_role('editor')
+    for user_id in [1, 2, 3]:
+        perm.assign(user_id, 'editor')
+    cache_size = perm.cache_size
+    perm.cache_size = 2
+    try:
+        for user_id in [1, 2, 1, 3]:
+            perm.user_roles(user_id)
+        assert list(perm._user_cache.keys()) == [1, 3]
+    finally:
+        perm.cache_size = cache_size
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_permission_bit_expires():
+    perm.create_permission('edit')
+    assert perm.permission_bit('edit') == 0
+    database.update(perm.PERMISSIONS_TABLE, where="name = 'edit'", bit=5)
+    assert perm.permission_bit('edit') == 0
+    perm._bits['edit'] = (0, 0)
+    assert perm.permission_bit('edit') == 5
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_permission_cache_invalidated_on_change():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    perm.create_role('editor')
+    perm.create_permission('edit')
+    perm.assign(user, 'editor')
+    assert not user.can('edit')
+    perm.grant('editor', 'edit')
+    assert user.can('edit')
+    perm.unassign(user, 'editor')
+    assert not user.can('edit')
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_permission_change_during_compile():
+    perm.create_role('editor')
+    perm.create_permission('edit')
+    perm.grant('editor', 'edit')
+    perm.assign(1, 'editor')
+    compile_role_permissions = perm.compile_role_permissions
+    def racing_compile(user_id):
+        # The role is taken away after the grants were read
+        role_bits = compile_role_permissions(user_id)
+        perm.unassign(user_id, 'editor')
+        return role_bits
+    perm.compile_role_permissions = racing_compile
+    try:
+        assert perm.user_permissions(1) == 1 << perm.permission_bit('edit')
+    finally:
+        perm.compile_role_permissions = compile_role_permissions
+    # The grants compiled before the change are not used again
+    assert perm.user_permissions(1) == 0
+
+@raises(perm.RoleError)
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_assign_missing_role():
+    perm.assign(1, 'nonexistent')
+
+def closure_rows():
+    return sorted([(r.ancestor_id, r.descendant_id, r.paths)
+                   for r in database.select(perm.CLOSURE_TABLE)])
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_role_hierarchy():
+    for role in ['admin', 'moderator', 'editor']:
+        perm.create_role(role)
+    perm.create_permission('edit')
+    perm.grant('editor', 'edit')
+    perm.add_subrole('admin', 'moderator')
+    perm.add_subrole('moderator', 'editor')
+    perm.assign(1, 'admin')
+    assert perm.includes('admin', 'editor')
+    assert perm.has_role(1, 'editor')
+    assert perm.user_roles(1) == frozenset(['admin', 'moderator', 'editor'])
+    assert perm.has_permission(1, 'edit')
+    perm.remove_subrole('moderator', 'editor')
+    assert not perm.includes('admin', 'editor')
+    assert not perm.has_role(1, 'editor')
+    assert not perm.has_permission(1, 'edit')
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_role_closure_counts_paths():
+    admin, moderator, editor, writer = [perm.create_role(r) for r in
+                                        ['admin', 'moderator', 'editor',
+                                         'writer']]
+    perm.add_subrole('admin', 'moderator')
+    perm.add_subrole('admin', 'editor')
+    before = closure_rows()
+    perm.add_subrole('moderator', 'writer')
+    perm.add_subrole('editor', 'writer')
+    assert (admin, writer, 2) in closure_rows()
+    perm.remove_subrole('editor', 'writer')
+    assert perm.includes('admin', 'writer')
+    perm.remove_subrole('moderator', 'writer')
+    assert closure_rows() == before
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_delete_role_updates_closure():
+    admin, moderator, editor = [perm.create_role(r) for r in
+                                ['admin', 'moderator', 'editor']]
+    perm.add_subrole('admin', 'moderator')
+    perm.add_subrole('moderator', 'editor')
+    perm.delete_role('moderator')
+    assert closure_rows() == [(admin, admin, 1), (editor, editor, 1)]
+
+@raises(perm.RoleError)
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_role_cycle():
+    perm.create_role('admin')
+    perm.create_role('editor')
+    perm.add_subrole('admin', 'editor')
+    perm.add_subrole('editor', 'admin')
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_filter_allowed():
+    editor = perm.create_role('editor')
+    reviewer = perm.create_role('reviewer')
+    perm.create_permission('edit')
+    perm.create_permission('edit.own')
+    perm.create_permission('edit.role')
+    perm.grant('editor', 'edit.own')
+    perm.grant('reviewer', 'edit.role')
+    perm.assign(1, 'editor')
+    perm.assign(1, 'reviewer')
+    resources = [{'id': 1, 'owner_id': 1, 'role_id': None},
+                 {'id': 2, 'owner_id': 2, 'role_id': None},
+                 {'id': 3, 'owner_id': 2, 'role_id': reviewer},
+                 web.storage(id=4, owner_id=1, role_id=None),
+                 {'id': 5, 'owner_id': 2, 'role_id': editor}]
+    allowed = perm.filter_allowed(1, 'edit', resources)
+    assert [r['id'] for r in allowed] == [1, 3, 4]
+    allowed = perm.filter_allowed(1, 'edit', resources, role=None)
+    assert [r['id'] for r in allowed] == [1, 4]
+    assert perm.filter_allowed(2, 'edit', resources) == []
+    assert not perm.allowed(1, 'edit', resources[1])
+    assert not perm.allowed(1, 'view', resources[2])
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_role_ids_for_permission():
+    admin, editor, reviewer = [perm.create_role(r) for r in
+                               ['admin', 'editor', 'reviewer']]
+    perm.create_permission('edit.role')
+    perm.grant('editor', 'edit.role')
+    perm.add_subrole('admin', 'editor')
+    perm.assign(1, 'admin')
+    perm.assign(1, 'reviewer')
+    # admin has the permission through editor
+    assert perm.role_ids_for(1, 'edit.role') == frozenset([admin, editor])
+    assert perm.role_ids_for(1, 'nonexistent') == frozenset()
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_filter_allowed_with_global_permission():
+    perm.create_role('admin')
+    perm.create_permission('edit')
+    perm.grant('admin', 'edit')
+    perm.assign(1, 'admin')
+    resources = [{'owner_id': 2}, {'owner_id': 3}]
+    assert perm.filter_allowed(1, 'edit', resources) == resources
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_access_where():
+    editor = perm.create_role('editor')
+    reviewer = perm.create_role('reviewer')
+    perm.create_permission('edit')
+    perm.create_permission('edit.own')
+    perm.create_permission('edit.role')
+    perm.grant('editor', 'edit.own')
+    perm.grant('reviewer', 'edit.role')
+    perm.assign(1, 'editor')
+    perm.assign(1, 'reviewer')
+    database.query("""
+                   CREATE TEMPORARY TABLE posts (
+                     id               INTEGER PRIMARY KEY,
+                     owner_id         INTEGER,
+                     role_id          INTEGER
+                   );
+                   """)
+    try:
+        database.multiple_insert('posts', seqname=False, values=[
+            {'id': 1, 'owner_id': 1, 'role_id': None},
+            {'id': 2, 'owner_id': 2, 'role_id': None},
+            {'id': 3, 'owner_id': 2, 'role_id': reviewer},
+            {'id': 4, 'owner_id': 2, 'role_id': editor + 100},
+            {'id': 5, 'owner_id': 2, 'role_id': editor}])
+        def visible(user_id):
+            where = perm.access_where(user_id, 'edit')
+            return [r.id for r in database.select('posts', where=where,
+                                                  order='id')]
+        assert visible(1) == [1, 3]
+        assert visible(2) == []
+        where = web.db.SQLQuery.join([perm.access_where(1, 'edit'),
+                                      'id > 1'], ' AND ')
+        assert [r.id for r in database.select('posts', where=where)] == [3]
+    finally:
+        database.query('DROP TABLE posts')
+
+def test_user_set_algebra():
+    a = group.UserSet([1, 2, 3, 1000])
+    b = group.UserSet([2, 3, 4])
+    assert list(a | b) == [1, 2, 3, 4, 1000]
+    assert list(a & b) == [2, 3]
+    assert list(a - b) == [1, 1000]
+    assert list(a ^ b) == [1, 4, 1000]
+    assert len(a) == 4
+    assert 1000 in a and 5 not in a
+    assert not group.UserSet()
+    assert list(group.UserSet()) == []
+
+def test_user_set_bytes():
+    members = group.UserSet(range(0, 100000, 7))
+    data = members.to_bytes()
+    assert len(data) < 1000
+    assert group.UserSet.from_bytes(data) == members
+    assert group.UserSet.from_bytes(group.UserSet().to_bytes()) == group.UserSet()
+
+def test_user_set_large():
+    members = group.UserSet(xrange(0, 10 ** 6, 3))
+    assert len(members) == 333334
+    assert 999999 in members
+    assert 999998 not in members and 10 ** 7 not in members
+    assert -1 not in members
+    odd = group.UserSet(xrange(1, 10 ** 6, 2))
+    assert len(members & odd) == 166667
+    assert members.bits & odd.bits == (members & odd).bits
+
+def test_user_set_bits():
+    assert group.UserSet(bits=0b100101) == group.UserSet([0, 2, 5])
+    assert group.UserSet([0, 2, 5]).bits == 0b100101
+    assert list(group.UserSet([7], bits=1)) == [0, 7]
+
+@raises(ValueError)
+def test_user_set_negative_id():
+    group.UserSet([-1])
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_group_members():
+    users = []
+    for name in ['userone', 'usertwo', 'userthree']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create(activated=(name != 'usertwo'))
+        users.append(user)
+    group.create_group('a', users[:2])
+    group.create_group('b')
+    group.add_members('b', [user.id for user in users[1:]])
+    group._groups.clear()
+    assert list(group.get('a') & group.get('b')) == [users[1].id]
+    group.remove_members('b', [users[2]])
+    group._groups.clear()
+    assert list(group.get('b')) == [users[1].id]
+    active = group.get('a') & group.matching('active')
+    assert [user.username for user in active.users()] == ['userone']
+    active = group.matching('active', within=group.get('a'), batch_size=1)
+    assert [user.username for user in active.users()] == ['userone']
+    assert group.matching('active', within=[]) == group.UserSet()
+
+@raises(auth.UserAccountError)
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_group_unsaved_user():
+    group.create_group('a', [auth.User(username='userone',
+                                       email='userone@email.com')])
+
+@raises(group.GroupError)
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_group_missing():
+    group.get('nonexistent')
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_get_users():
+    ids = []
+    for name in ['userone', 'usertwo']:
+        user = auth.User(username=name, email='%s@email.com' % name)
+        user.create()
+        ids.append(user.id)
+    users = auth.User.get_users([ids[1], 999, ids[0]])
+    assert [user.username for user in users] == ['usertwo', 'userone']
+
+def with_breached_passwords(func):
+    def wrapper():
+        source = tempfile.mktemp()
+        target = tempfile.mktemp()
+        f = open(source, 'wb')
+        f.write('qwerty123\n')
+        f.close()
+        breach.build(source, target, hashed=False)
+        auth.breached_passwords = breach.Blocklist(target)
+        try:
+            func()
+        finally:
+            auth.breached_passwords.close()
+            auth.breached_passwords = None
+            os.remove(source)
+            os.remove(target)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+@raises(ValueError)
+@with_breached_passwords
+def test_breached_password_rejected():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.password = 'qwerty123'
+
+@with_breached_passwords
+def test_breached_password_forms():
+    reg_form = authforms.register_form()
+    assert not reg_form.validates(web.storify({
+        'username': 'myuser',
+        'email': 'valid@email.com',
+        'password': 'qwerty123',
+        'confirm': 'qwerty123',
+    }))
+    reset_form = authforms.pw_reset_form()
+    assert not reset_form.validates(web.storify({
+        'password': 'abc123',
+        'new': 'qwerty123',
+        'confirm': 'qwerty123'
+    }))
+    assert authforms.password_field.validate('qwerty123')
+
+@raises(ValueError)
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_blocked_email_domain():
+    auth.blocked_domains = domains.DomainBlocklist(domains=['mailinator.com'])
+    try:
+        user = auth.User(username='myuser', email='someone@mailinator.com')
+        user.create()
+    finally:
+        auth.blocked_domains = None
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_blocked_email_domain_change():
+    user = auth.User(username='myuser', email='someone@email.com')
+    user.create()
+    auth.blocked_domains = domains.DomainBlocklist(domains=['mailinator.com'])
+    try:
+        user.email = 'someone@mailinator.com'
+        assert_raises(ValueError, user.store)
+    finally:
+        auth.blocked_domains = None
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_blocked_email_domain_existing_account():
+    user = auth.User(username='myuser', email='someone@mailinator.com')
+    user.create()
+    web.ctx.auth_user_cache = {}
+    auth.blocked_domains = domains.DomainBlocklist(domains=['mailinator.com'])
+    try:
+        user = auth.User.get_user(username='myuser')
+        assert user.email == 'someone@mailinator.com'
+        user.activate()
+        user.store()
+        reg_form = authforms.register_form()
+        assert not reg_form.validates(web.storify({
+            'username': 'otheruser',
+            'email': 'other@mailinator.com',
+            'password': 'abc123',
+            'confirm': 'abc123',
+        }))
+    finally:
+        auth.blocked_domains = None
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_authenticate_uses_credential_cache():
+    auth.credential_cache = credentials.VerifiedCache()
+    try:
+        user = auth.User(username='myuser', email='valid@email.com')
+        user.password = 'abc123'
+        user.create(activated=True)
+        assert user.authenticate('abc123')
+        assert not user.authenticate('wrong')
+        assert len(auth.credential_cache) == 1
+        assert user.authenticate('abc123')
+        user.password = '123abc'
+        user.store()
+        assert len(auth.credential_cache) == 0
+        assert not user.authenticate('abc123')
+        assert user.authenticate('123abc')
+        auth.User.suspend(username='myuser')
+        assert len(auth.credential_cache) == 0
+    finally:
+        auth.credential_cache = None
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_api_keys():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create(activated=True)
+    key = user.create_api_key(scopes=['read', 'write'])
+    prefix, secret = key.split('.')
+    record = database.where(apikeys.KEYS_TABLE, prefix=prefix)[0]
+    assert secret not in record.secret_hash
+    assert auth.User.get_user_by_api_key(key).username == 'myuser'
+    assert auth.User.get_user_by_api_key(key, 'write') is not None
+    assert auth.User.get_user_by_api_key(key, 'admin') is None
+    assert auth.User.get_user_by_api_key(prefix + '.wrong') is None
+    assert auth.User.get_user_by_api_key('nonsense') is None
+    apikeys.revoke(prefix)
+    assert apikeys.verify(key) is None
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_api_key_revoked_elsewhere():
+    key = apikeys.create_key(1)
+    prefix = key.split('.')[0]
+    assert apikeys.verify(key) is not None
+    # Revoked by another process, whose cache is not shared
+    database.delete(apikeys.KEYS_TABLE, where='prefix = $prefix',
+                    vars={'prefix': prefix})
+    assert apikeys.verify(key) is not None
+    cache_ttl = apikeys.cache_ttl
+    apikeys.cache_ttl = 0
+    try:
+        apikeys._cache.clear()
+        other = apikeys.create_key(1)
+        assert apikeys.verify(other) is not None
+        database.delete(apikeys.KEYS_TABLE, where='prefix = $prefix',
+                        vars={'prefix': other.split('.')[0]})
+        assert apikeys.verify(other) is None
+    finally:
+        apikeys.cache_ttl = cache_ttl
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_api_key_expiry():
+    expired = apikeys.create_key(1, expires_at=datetime.datetime.now() -
+                                 datetime.timedelta(1))
+    assert apikeys.verify(expired) is None
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_api_key_last_used_coalesced():
+    key = apikeys.create_key(1)
+    prefix = key.split('.')[0]
+    assert apikeys.verify(key) is not None
+    apikeys.usage = apikeys.UsageTracker(apikeys.db)
+    try:
+        for i in range(10):
+            assert apikeys.verify(key) is not None
+        record = database.where(apikeys.KEYS_TABLE, prefix=prefix)[0]
+        assert record.last_used is None
+        apikeys.usage.flush()
+        record = database.where(apikeys.KEYS_TABLE, prefix=prefix)[0]
+        assert record.last_used is not None
+    finally:
+        apikeys.usage = None
+    assert apikeys.keys(1)[0].prefix == prefix
+
+def test_usage_tracker_registers_atexit_once():
+    registered = []
+    original = apikeys.atexit.register
+    apikeys.atexit.register = registered.append
+    tracker = apikeys.UsageTracker(None, flush_interval=60)
+    try:
+        tracker.start()
+        tracker.stop()
+        tracker.start()
+    finally:
+        apikeys.atexit.register = original
+        tracker.stop()
+    assert registered == [tracker.stop]
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_outbox_events():
+    auth.outbox_enabled = True
+    try:
+        user = auth.User(username='myuser', email='valid@email.com')
+        user.create()
+        user.activate()
+        user.store()
+        user.email = 'other@email.com'
+        user.store()
+        with auth.batch():
+            user.username = 'renamed'
+            user.store()
+        auth.User.suspend(username='renamed')
+        auth.User.delete(username='renamed')
+    finally:
+        auth.outbox_enabled = False
+    consumer = outbox.Consumer(database, 'search')
+    events = consumer.read()
+    assert [e.event for e in events] == ['create', 'activate', 'store',
+                                         'store', 'suspend', 'delete']
+    assert all([e.user_id == user.id for e in events])
+    assert events[2].data['fields'] == ['email']
+    assert events[2].data['email'] == 'other@email.com'
+    assert 'password' in events[0].data['fields']
+    assert '$' not in str(events[0].data)
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_outbox_written_when_batch_commits():
+    written = []
+    def recording_write(database, events):
+        written.append([e['event'] for e in events])
+        return write(database, events)
+    write = outbox.write
+    auth.outbox_enabled = True
+    outbox.write = recording_write
+    try:
+        with auth.batch():
+            user = auth.User(username='myuser', email='valid@email.com')
+            user.create()
+            auth.User.suspend(username='myuser')
+            # Nothing is written, and locked, until the block commits
+            assert written == []
+    finally:
+        outbox.write = write
+        auth.outbox_enabled = False
+    assert written == [['create', 'suspend']]
+    events = outbox.Consumer(database, 'search').read()
+    assert [e.event for e in events] == ['create', 'suspend']
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_outbox_rolled_back_with_change():
+    auth.outbox_enabled = True
+    try:
+        user = auth.User(username='myuser', email='valid@email.com')
+        user.create()
+        try:
+            with auth.batch():
+                user.activate()
+                user.store()
+                raise RuntimeError
+        except RuntimeError:
+            pass
+    finally:
+        auth.outbox_enabled = False
+    events = outbox.Consumer(database, 'search').read()
+    assert [e.event for e in events] == ['create']
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_outbox_write_failure_rolls_back_change():
+    user = auth.User(username='myuser', email='valid@email.com')
+    user.create()
+    def failing_write(database, events):
+        raise RuntimeError
+    original = outbox.write
+    auth.outbox_enabled = True
+    outbox.write = failing_write
+    try:
+        user.email = 'other@email.com'
+        assert_raises(RuntimeError, user.store)
+    finally:
+        outbox.write = original
+        auth.outbox_enabled = False
+    record = database.where(auth.TABLE, id=user.id)[0]
+    assert record.email == 'valid@email.com'
+    assert record.version == user._version
+
+@with_setup(setup=setup_table, teardown=teardown_table)
+def test_outbox_consumers():
+    outbox.write(database, [outbox.event('store', i, 'user%s' % i,
+                                         'user%s@email.com' % i, True)
+                            for i in range(5)])
+    search = outbox.Consumer(database, 'search')
+    billing = outbox.Consumer(database, 'billing')
+    assert outbox.compact(database) == 0
+    events = search.read(batch_size=3)
+    assert [e.user_id for e in events] == [0, 1, 2]
+    assert [e.user_id for e in search.read(batch_size=3)] == [0, 1, 2]
+    search.ack(events[-1].id)
+    assert [e.user_id for e in search.read()] == [3, 4]
+    billing.ack(events[0].id)
+    assert outbox.compact(database) == 1
+    search.ack(events[-1].id + 1)
+    assert search.position() == events[-1].id + 1
+    assert len(database.where(outbox.OFFSETS_TABLE, consumer='search')) == 1
+    assert [e.user_id for e in billing.read()] == [1, 2, 3, 4]
@@ -0,0 +1,71 @@
+import os
+import hashlib
+import tempfile
+
+from nose.tools import *
+
+from authenticationpy import breach
+
+passwords = ['password%s' % i for i in range(1000)]
+
+def make_blocklist(lines, **kwargs):
+    source = tempfile.mktemp()
+    target = tempfile.mktemp()
+    f = open(source, 'wb')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+    try:
+        count = breach.build(source, target, **kwargs)
+    finally:
+        os.remove(source)
+    return count, target
+
+def test_blocklist_from_plain_passwords():
+    count, path = make_blocklist(passwords, hashed=False, chunk_size=64)
+    try:
+        blocklist = breach.Blocklist(path)
+        assert count == len(blocklist) == len(passwords)
+        for password in passwords:
+            assert password in blocklist
+        assert 'not breached' not in blocklist
+        blocklist.close()
+    finally:
+        os.remove(path)
+
+def test_blocklist_from_hashes():
+    lines = ['%s:%s' % (hashlib.sha1(p).hexdigest().upper(), i)
+             for i, p in enumerate(passwords)]
+    count, path = make_blocklist(reversed(lines))
+    try:
+        blocklist = breach.Blocklist(path)
+        assert 'password42' in blocklist
+        assert 'password1000' not in blocklist
+        blocklist.close()
+    finally:
+        os.remove(path)
+
+def test_blocklist_removes_duplicates():
+    count, path = make_blocklist(['abc', 'abc', 'def'], hashed=False,
+                                 chunk_size=1)
+    try:
+        assert count == 2
+    finally:
+        os.remove(path)
+
+def test_empty_blocklist():
+    count, path = make_blocklist([], hashed=False)
+    try:
+        assert 'abc123' not in breach.Blocklist(path)
+    finally:
+        os.remove(path)
+
+@raises(ValueError)
+def test_blocklist_wrong_file():
+    path = tempfile.mktemp()
+    f = open(path, 'wb')
+    f.write('x' * 100)
+    f.close()
+    try:
+        breach.Blocklist(path)
+    finally:
+        os.remove(path)
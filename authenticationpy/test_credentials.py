@@ -0,0 +1,46 @@
+import time
+
+from nose.tools import *
+
+from authenticationpy import credentials
+
+def test_verified_cache():
+    cache = credentials.VerifiedCache()
+    assert not cache.check(1, 'secret', 'salt$hash')
+    cache.add(1, 'secret', 'salt$hash')
+    assert cache.check(1, 'secret', 'salt$hash')
+    assert not cache.check(1, 'wrong', 'salt$hash')
+    assert not cache.check(1, 'secret', 'salt$newhash')
+    assert not cache.check(2, 'secret', 'salt$hash')
+
+def test_verified_cache_keeps_no_cleartext():
+    cache = credentials.VerifiedCache()
+    cache.add(1, 'secret', 'salt$hash')
+    for digest in cache._entries:
+        assert 'secret' not in digest
+
+def test_verified_cache_expires():
+    cache = credentials.VerifiedCache(ttl=0.01)
+    cache.add(1, 'secret', 'salt$hash')
+    time.sleep(0.02)
+    assert not cache.check(1, 'secret', 'salt$hash')
+    assert len(cache) == 0
+
+def test_verified_cache_size():
+    cache = credentials.VerifiedCache(max_size=2)
+    cache.add(1, 'one', 'hash')
+    cache.add(2, 'two', 'hash')
+    assert cache.check(1, 'one', 'hash')
+    cache.add(3, 'three', 'hash')
+    assert len(cache) == 2
+    assert cache.check(1, 'one', 'hash')
+    assert not cache.check(2, 'two', 'hash')
+
+def test_verified_cache_forget():
+    cache = credentials.VerifiedCache()
+    cache.add(1, 'one', 'hash')
+    cache.add(1, 'other', 'hash')
+    cache.add(2, 'two', 'hash')
+    cache.forget(1)
+    assert len(cache) == 1
+    assert cache.check(2, 'two', 'hash')
@@ -0,0 +1,75 @@
+import os
+import time
+import tempfile
+
+from nose.tools import *
+
+from authenticationpy import domains
+
+def test_exact_domain():
+    blocklist = domains.DomainBlocklist(domains=['mailinator.com'])
+    assert 'mailinator.com' in blocklist
+    assert 'MailInator.com' in blocklist
+    assert 'a.mailinator.com' not in blocklist
+    assert 'inator.com' not in blocklist
+    assert 'com' not in blocklist
+
+def test_suffix_domain():
+    blocklist = domains.DomainBlocklist(domains=['.tempmail.net'])
+    assert 'tempmail.net' in blocklist
+    assert 'a.tempmail.net' in blocklist
+    assert 'a.b.tempmail.net' in blocklist
+    assert 'nottempmail.net' not in blocklist
+
+def test_wildcard_domain():
+    blocklist = domains.DomainBlocklist(domains=['*.example.com',
+                                                 'mx.*.example.org'])
+    assert 'mail.example.com' in blocklist
+    assert 'example.com' not in blocklist
+    assert 'a.mail.example.com' not in blocklist
+    assert 'mx.eu.example.org' in blocklist
+    assert 'mx.example.org' not in blocklist
+
+def test_is_blocked():
+    blocklist = domains.DomainBlocklist(domains=['# comment', '',
+                                                 'mailinator.com'])
+    assert blocklist.is_blocked('someone@mailinator.com')
+    assert not blocklist.is_blocked('someone@email.com')
+
+def test_reload():
+    path = tempfile.mktemp()
+    f = open(path, 'wb')
+    f.write('mailinator.com\n')
+    f.close()
+    try:
+        blocklist = domains.DomainBlocklist(path=path, check_interval=0)
+        assert 'mailinator.com' in blocklist
+        f = open(path, 'wb')
+        f.write('tempmail.net\n')
+        f.close()
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        assert 'tempmail.net' in blocklist
+        assert 'mailinator.com' not in blocklist
+    finally:
+        os.remove(path)
+
+def test_reload_keeps_entries_on_errors():
+    path = tempfile.mktemp()
+    f = open(path, 'wb')
+    f.write('mailinator.com\n')
+    f.close()
+    try:
+        blocklist = domains.DomainBlocklist(path=path, check_interval=0)
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        def unreadable(path, mode='r'):
+            raise IOError('File is being replaced')
+        domains.open = unreadable
+        try:
+            assert 'mailinator.com' in blocklist
+        finally:
+            del domains.open
+        os.remove(path)
+        assert 'mailinator.com' in blocklist
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,293 @@
+import psycopg2
+import web
+from nose.tools import *
+
+if 'authdb' not in web.config:
+    web.config.authdb = web.database(dbn='postgres', db='authenticationpy_test',
+                                     user='postgres')
+
+from authenticationpy import user_cache_hook, auth
+from authenticationpy import shard
+
+usernames = ['user%s' % i for i in range(1000)]
+
+SHARDS = 3
+TABLE = 'authenticationpy_users'
+
+# Schemas of the test database are used as shards, and the test database
+# itself holds the global index
+index_db = auth.db
+shards = [web.database(dbn='postgres', db='authenticationpy_test',
+                       user='postgres',
+                       options='-c search_path=authenticationpy_shard%s' % n)
+          for n in range(SHARDS)]
+
+def test_jump_hash_is_stable():
+    assert shard.jump_hash('myuser', 8) == shard.jump_hash('myuser', 8)
+
+def test_jump_hash_range():
+    for username in usernames:
+        assert 0 <= shard.jump_hash(username, 5) < 5
+
+def test_jump_hash_single_bucket():
+    assert shard.jump_hash('myuser', 1) == 0
+
+def test_jump_hash_uses_all_buckets():
+    buckets = set([shard.jump_hash(u, 4) for u in usernames])
+    assert buckets == set([0, 1, 2, 3])
+
+def test_jump_hash_moves_keys_only_to_new_bucket():
+    for username in usernames:
+        before = shard.jump_hash(username, 4)
+        after = shard.jump_hash(username, 5)
+        assert after == before or after == 4
+
+def usernames_on(number, count=1, buckets=SHARDS):
+    """ Returns ``count`` usernames that hash to shard ``number`` """
+    names = [u for u in usernames if shard.jump_hash(u, buckets) == number]
+    return names[:count]
+
+def setup_shards():
+    queries = ["""
+               DROP TABLE IF EXISTS authenticationpy_user_index CASCADE;
+               CREATE TABLE authenticationpy_user_index (
+                 id               SERIAL PRIMARY KEY,
+                 username         VARCHAR(40) NOT NULL UNIQUE,
+                 email            VARCHAR(80) NOT NULL UNIQUE,
+                 act_code         CHAR(64),
+                 shard            INTEGER NOT NULL
+               );
+               """]
+    for number in range(SHARDS):
+        queries.append("""
+                       DROP SCHEMA IF EXISTS authenticationpy_shard%(n)s CASCADE;
+                       CREATE SCHEMA authenticationpy_shard%(n)s;
+                       CREATE TABLE authenticationpy_shard%(n)s.authenticationpy_users (
+                         id               INTEGER PRIMARY KEY,
+                         username         VARCHAR(40) NOT NULL UNIQUE,
+                         email            VARCHAR(80) NOT NULL UNIQUE,
+                         password         CHAR(81) NOT NULL,
+                         pending_pwd      CHAR(81),
+                         act_code         CHAR(64),
+                         act_time         TIMESTAMP,
+                         act_type         CHAR(1),
+                         registered_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                         active           BOOLEAN DEFAULT 'false',
+                         last_login       TIMESTAMP,
+                         deleted_at       TIMESTAMP,
+                         version          INTEGER NOT NULL DEFAULT 0
+                       );
+                       """ % {'n': number})
+    index_db.query(''.join(queries))
+    user_cache_hook()
+
+def teardown_shards():
+    queries = ['DROP TABLE IF EXISTS authenticationpy_user_index CASCADE;']
+    for number in range(SHARDS):
+        queries.append('DROP SCHEMA IF EXISTS authenticationpy_shard%s '
+                       'CASCADE;' % number)
+    index_db.query(''.join(queries))
+
+def setup_router():
+    setup_shards()
+    auth.router = shard.ShardRouter(index_db, shards, TABLE)
+
+def teardown_router():
+    auth.router = None
+    teardown_shards()
+
+def insert_record(router, username):
+    """ Registers ``username`` and inserts its record on its shard """
+    email = '%s@email.com' % username
+    id = router.register(username, email)
+    router.db_for(username).insert(TABLE, seqname=False, id=id,
+                                   username=username, email=email,
+                                   password='secret')
+    return id
+
+def records(username):
+    """ Returns the shard numbers that hold a record for ``username`` """
+    return [n for n, database in enumerate(shards)
+            if database.where(TABLE, username=username)]
+
+@with_setup(setup=setup_shards, teardown=teardown_shards)
+def test_register_and_lookup():
+    router = shard.ShardRouter(index_db, shards, TABLE)
+    id = router.register('userone', 'userone@email.com')
+    entry = router.lookup(email='userone@email.com')
+    assert entry.id == id
+    assert entry.username == 'userone'
+    assert entry.shard == router.shard_for('userone')
+    assert router.db_for_id(id) is shards[entry.shard]
+    assert router.db_for_id(id + 1) is None
+    assert router.lookup(username='usertwo') is None
+    assert router.exists(username='userone')
+    assert router.exists(email='userone@email.com')
+    assert not router.exists(username='usertwo', email='usertwo@email.com')
+
+@raises(psycopg2.IntegrityError)
+@with_setup(setup=setup_shards, teardown=teardown_shards)
+def test_register_email_unique_across_shards():
+    router = shard.ShardRouter(index_db, shards, TABLE)
+    first, = usernames_on(0)
+    second, = usernames_on(1)
+    router.register(first, 'same@email.com')
+    router.register(second, 'same@email.com')
+
+@with_setup(setup=setup_shards, teardown=teardown_shards)
+def test_move():
+    router = shard.ShardRouter(index_db, shards, TABLE)
+    username, = usernames_on(0)
+    id = insert_record(router, username)
+    router.move(id, shards[0], shards[1], shard=1)
+    assert records(username) == [1]
+    assert router.lookup(id=id).shard == 1
+    # Moving a record that has already left the source does nothing
+    router.move(id, shards[0], shards[1], shard=1)
+    assert records(username) == [1]
+
+@with_setup(setup=setup_shards, teardown=teardown_shards)
+def test_move_repeats_interrupted_move():
+    router = shard.ShardRouter(index_db, shards, TABLE)
+    username, = usernames_on(0)
+    id = insert_record(router, username)
+    # A copy left on the target by a move that failed before the delete
+    shards[1].insert(TABLE, seqname=False, id=id, username=username,
+                     email='%s@email.com' % username, password='stale')
+    router.move(id, shards[0], shards[1], shard=1)
+    assert records(username) == [1]
+    assert shards[1].where(TABLE, id=id)[0].password.strip() == 'secret'
+
+@with_setup(setup=setup_shards, teardown=teardown_shards)
+def test_rebalance():
+    router = shard.ShardRouter(index_db, shards[:2], TABLE)
+    names = usernames[:30]
+    for username in names:
+        insert_record(router, username)
+    expected = len([u for u in names
+                    if shard.jump_hash(u, 2) != shard.jump_hash(u, 3)])
+    assert expected
+    assert router.rebalance(shards, batch_size=7) == expected
+    for username in names:
+        assert records(username) == [router.shard_for(username)]
+        assert router.lookup(username=username).shard == \
+               router.shard_for(username)
+    assert router.rebalance(shards) == 0
+
+
+class RecordingDatabase(object):
+    """ Database whose transactions record their commits and rollbacks """
+
+    def __init__(self, log, name, fail=False):
+        self.log = log
+        self.name = name
+        self.fail = fail
+
+    def transaction(self):
+        return RecordingTransaction(self)
+
+
+class RecordingTransaction(object):
+
+    def __init__(self, database):
+        self.database = database
+
+    def commit(self):
+        if self.database.fail:
+            raise RuntimeError()
+        self.database.log.append(('commit', self.database.name))
+
+    def rollback(self):
+        self.database.log.append(('rollback', self.database.name))
+
+
+def test_transactions_commit_in_order():
+    log = []
+    a, b, c = [RecordingDatabase(log, name) for name in 'abc']
+    transactions = auth._Transactions(a, b)
+    transactions.add(b, c)
+    transactions.commit()
+    assert log == [('commit', 'a'), ('commit', 'b'), ('commit', 'c')]
+
+def test_transactions_roll_back_rest_on_failed_commit():
+    log = []
+    a = RecordingDatabase(log, 'a')
+    b = RecordingDatabase(log, 'b', fail=True)
+    c = RecordingDatabase(log, 'c')
+    transactions = auth._Transactions(a, b, c)
+    assert_raises(RuntimeError, transactions.commit)
+    assert log == [('commit', 'a'), ('rollback', 'c'), ('rollback', 'b')]
+    transactions.rollback()
+    assert len(log) == 3
+
+@with_setup(setup=setup_router, teardown=teardown_router)
+def test_create_on_shard():
+    username, = usernames_on(2)
+    user = auth.User(username=username, email='%s@email.com' % username)
+    user.create()
+    assert records(username) == [2]
+    assert auth.router.lookup(id=user.id).username == username
+    user_cache_hook()
+    assert auth.User.get_user(username=username).id == user.id
+    user_cache_hook()
+    assert auth.User.get_user(email='%s@email.com' % username).id == user.id
+    assert auth.User.exists(email='%s@email.com' % username)
+
+@raises(auth.DuplicateEmailError)
+@with_setup(setup=setup_router, teardown=teardown_router)
+def test_create_duplicate_email_on_other_shard():
+    first, = usernames_on(0)
+    second, = usernames_on(1)
+    auth.User(username=first, email='same@email.com').create()
+    auth.User(username=second, email='same@email.com').create()
+
+@with_setup(setup=setup_router, teardown=teardown_router)
+def test_rename_moves_account():
+    old, = usernames_on(0)
+    new, = usernames_on(1)
+    user = auth.User(username=old, email='valid@email.com')
+    user.create()
+    user = auth.User.get_user(username=old)
+    user.username = new
+    user.store()
+    assert records(old) == []
+    assert records(new) == [1]
+    entry = auth.router.lookup(id=user.id)
+    assert entry.username == new
+    assert entry.shard == 1
+    user_cache_hook()
+    assert auth.User.get_user(username=new).id == user.id
+
+@with_setup(setup=setup_router, teardown=teardown_router)
+def test_stale_rename_rolls_back_shards():
+    old, = usernames_on(0)
+    new, = usernames_on(1)
+    user = auth.User(username=old, email='valid@email.com')
+    user.create()
+    first = auth.User.get_user(username=old)
+    user_cache_hook()
+    second = auth.User.get_user(username=old)
+    first.activate()
+    first.store()
+    second.username = new
+    assert_raises(auth.StaleUserError, second.store)
+    assert records(old) == [0]
+    assert records(new) == []
+    assert auth.router.lookup(id=user.id).username == old
+
+@with_setup(setup=setup_router, teardown=teardown_router)
+def test_batch_rolls_back_all_shards():
+    names = usernames_on(0) + usernames_on(1)
+    for username in names:
+        auth.User(username=username, email='%s@email.com' % username).create()
+    try:
+        with auth.batch():
+            for username in names:
+                user = auth.User.get_user(username=username)
+                user.activate()
+                user.store()
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    for database in shards:
+        assert not database.select(TABLE, where='active = true')
@@ -0,0 +1,159 @@
+""" Per-request tracing of the queries issued by authentication.py
+
+Tracing is meant for development and profiling. When enabled, every query
+issued by the ``auth`` module during a request is recorded together with its
+duration and the place in your code that caused it. Repeated queries, which
+usually mean that users are looked up in a loop (the N+1 problem), are
+flagged.
+
+"""
+
+import os
+import re
+import time
+import hashlib
+import traceback
+
+import web
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+WEB_DIR = os.path.dirname(os.path.abspath(web.__file__))
+AUTH_FILE = os.path.join(PACKAGE_DIR, 'auth.py')
+
+# Lists of parameters of different length have the same shape
+_list_re = re.compile(r'\(\s*%s(\s*,\s*%s)*\s*\)')
+
+
+class QueryTrace(object):
+    """ Queries recorded during a single request """
+
+    def __init__(self):
+        self.queries = []
+
+    def record(self, sql, params, duration, site=None):
+        """ Records a query
+
+        ``sql`` is the query with parameter placeholders, and ``params`` are
+        the parameter values. If ``site`` is omitted, the call site is found
+        by walking the stack.
+
+        """
+
+        self.queries.append(web.storage(
+            shape=_list_re.sub('(...)', ' '.join(sql.split())),
+            fingerprint=hashlib.md5(repr(list(params or []))).hexdigest()[:12],
+            duration=duration,
+            site=site or call_site()))
+
+    def repeated(self, threshold=2):
+        """ Returns the query shapes that were run ``threshold`` times or more
+
+        Each result has the ``shape``, the ``count`` of queries, whether some
+        of them were ``identical`` (same parameters), and the call ``sites``.
+
+        """
+
+        shapes = {}
+        order = []
+        for query in self.queries:
+            if query.shape not in shapes:
+                shapes[query.shape] = []
+                order.append(query.shape)
+            shapes[query.shape].append(query)
+
+        results = []
+        for shape in order:
+            queries = shapes[shape]
+            if len(queries) < threshold:
+                continue
+            fingerprints = [q.fingerprint for q in queries]
+            results.append(web.storage(
+                shape=shape,
+                count=len(queries),
+                identical=len(set(fingerprints)) < len(fingerprints),
+                sites=sorted(set([q.site for q in queries]))))
+        return results
+
+    @property
+    def total_time(self):
+        return sum([q.duration for q in self.queries])
+
+    def summary(self, threshold=2):
+        """ Returns a one-line summary suitable for a response header """
+        repeated = self.repeated(threshold)
+        return '%s queries, %.1f ms, %s repeated' % (
+            len(self.queries), self.total_time * 1000, len(repeated))
+
+def call_site():
+    """ Returns the innermost caller outside authentication.py and web.py """
+    for filename, line, function, text in reversed(traceback.extract_stack()):
+        path = os.path.abspath(filename)
+        if path.startswith(PACKAGE_DIR) or path.startswith(WEB_DIR):
+            continue
+        return '%s:%s in %s' % (filename, line, function)
+    return None
+
+def current():
+    """ Returns the trace of the current request, or None """
+    return web.ctx.get('auth_query_trace')
+
+def _issued_by_auth():
+    auth_file = os.path.splitext(AUTH_FILE)[0]
+    for frame in traceback.extract_stack():
+        if os.path.splitext(os.path.abspath(frame[0]))[0] == auth_file:
+            return True
+    return False
+
+def install(database):
+    """ Makes ``database`` record the queries issued by ``auth``
+
+    Installing more than once has no effect, so queries are never recorded
+    twice.
+
+    """
+
+    if '_authpy_execute' in database.__dict__:
+        return
+    execute = database._db_execute
+
+    def _db_execute(cur, sql_query):
+        trace = current()
+        if trace is None or not _issued_by_auth():
+            return execute(cur, sql_query)
+        start = time.time()
+        try:
+            return execute(cur, sql_query)
+        finally:
+            trace.record(sql_query.query(), sql_query.values(),
+                         time.time() - start)
+
+    database._authpy_execute = execute
+    database._db_execute = _db_execute
+
+def uninstall(database):
+    """ Stops recording the queries issued through ``database`` """
+    execute = database.__dict__.pop('_authpy_execute', None)
+    if execute is None:
+        return
+    if getattr(execute, '__self__', None) is database:
+        # The original was the class method, which is found again once the
+        # instance attribute is removed
+        del database._db_execute
+    else:
+        database._db_execute = execute
+
+def trace_hook():
+    """ Load hook that starts tracing the request """
+    web.ctx.auth_query_trace = QueryTrace()
+
+def trace_unloadhook(header='X-Auth-Queries', threshold=2):
+    """ Unload hook that adds the trace summary as a response header
+
+    Pass this function to ``web.unloadhook``. If ``header`` is ``None``, no
+    header is added.
+
+    """
+
+    trace = current()
+    if trace is not None and header:
+        web.header(header, trace.summary(threshold))